@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+import uuid
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+import content
+import db
+import metrics
+import migrations
+import responses
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+from schemas import id_errors
+from main import app, queries, rate_limiter, SCHEMA_CHECK, read_cache, cache_key, quarantined, swaggerui_blueprint, VIEWS, snippet_views, user_json, snippet_json, tag_json, snippettag_json, interaction_json, bounty_json, report_json, comment_status_json
+
+# async serving mode: run with `uvicorn asgi:application`
+# single-row reads are served here on the driver's execute_async futures so a worker
+# can keep many queries in flight; everything else is handed to the Flask app unchanged
+app.register_blueprint(swaggerui_blueprint)
+wsgi = WsgiToAsgi(app)
+log = logging.getLogger(__name__)
+
+cached_reads = {'users', 'snippets', 'tags', 'comments'}
+
+reads = {
+    'users': ('select_user', user_json, 'User'),
+    'snippets': ('select_snippet', snippet_json, 'Snippet'),
+    'tags': ('select_tag', tag_json, 'Tag'),
+    'snippettags': ('select_snippettag', snippettag_json, 'SnippetTag'),
+    'interactions': ('select_interaction', interaction_json, 'Interaction'),
+    'snippetbounties': ('select_snippetbounty', bounty_json, 'Bounty'),
+    'bugbounties': ('select_bugbounty', bounty_json, 'Bounty'),
+    'reports': ('select_report', report_json, 'Report'),
+    'comments': ('select_comment', comment_status_json, 'Comment'),
+}
+
+routes = Map([
+    Rule('/users/<string:user_id>', endpoint='users'),
+    Rule('/snippets/<string:snippet_id>', endpoint='snippets'),
+    Rule('/tags/<string:tag_id>', endpoint='tags'),
+    Rule('/snippettags/<string:snippet_id>/<string:tag_id>', endpoint='snippettags'),
+    Rule('/interactions/<string:interaction_id>', endpoint='interactions'),
+    Rule('/snippetbounties/<string:bounty_id>', endpoint='snippetbounties'),
+    Rule('/bugbounties/<string:bounty_id>', endpoint='bugbounties'),
+    Rule('/reports/<string:report_id>', endpoint='reports'),
+    Rule('/comments/<string:comment_id>', endpoint='comments'),
+], strict_slashes=False)
+adapter = routes.bind('')
+
+def _settle(future, result=None, error=None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def execute(name, params=None):
+    # bridge the driver's ResponseFuture (completed on its IO thread) onto the running event loop
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    response = queries.execute_async(name, params)
+    response.add_callbacks(
+        callback=lambda rows: loop.call_soon_threadsafe(_settle, future, rows),
+        errback=lambda error: loop.call_soon_threadsafe(_settle, future, None, error))
+    return future
+
+async def respond(send, payload, status, headers=None):
+    fields = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())] if status != 304 else []
+    fields.extend((name.lower().encode(), value.encode()) for name, value in (headers or {}).items())
+    await send({'type': 'http.response.start', 'status': status, 'headers': fields})
+    await send({'type': 'http.response.body', 'body': payload})
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def query(scope, name, default=None):
+    return parse_qs(scope['query_string'].decode('latin-1')).get(name, [default])[0]
+
+async def snippet_view(body, view):
+    # as main.snippet_views, with the Content read on the event loop like the row
+    if view == 'full' and 'Content' not in body and body['ContentHash']:
+        rows = await execute('select_snippet_content', [body['ContentHash']])
+        body = dict(body, Content=content.unpack(rows[0]) if rows else None)
+    return snippet_views([body], view)[0]
+
+async def validators(scope, endpoint, body):
+    # same ETag / Last-Modified as the Flask resources, so a 304 doesn't depend on which path served the GET;
+    # a snippet's Content is only read once it's known not to be a 304
+    view = query(scope, 'view', 'full') if endpoint == 'snippets' else None
+    headers = responses.snippet_validators(body, view) if view else None
+    payload = None
+    if headers is None:
+        payload = responses.dumps(body)
+        headers = {'ETag': responses.etag(payload)}
+    status = 304 if responses.not_modified(headers, header(scope, b'if-none-match'), header(scope, b'if-modified-since')) else 200
+    if status == 304:
+        payload = b''
+    elif payload is None:
+        payload = responses.dumps(await snippet_view(body, view))
+    return payload, status, headers
+
+async def read(scope, send, rule, args):
+    # under the same in-flight cap as the Flask app's requests; the loop can't block waiting for a slot,
+    # so a read that finds none free is shed at once
+    if not rate_limiter.enter(0):
+        metrics.rate_limited.inc(rule.rule, 503)
+        await respond(send, responses.dumps({'message': 'Server is busy, try again shortly'}), 503, {'Retry-After': '1'})
+        return
+    try:
+        await serve(scope, send, rule, args)
+    finally:
+        rate_limiter.leave()
+
+async def serve(scope, send, rule, args):
+    start = time.perf_counter()
+    endpoint = rule.endpoint
+    name, to_json, noun = reads[endpoint]
+    errors = id_errors(args)
+    if errors:
+        await respond(send, responses.dumps({'message': errors}), 400)
+        metrics.request_seconds.observe(time.perf_counter() - start, 'GET', rule.rule, 400)
+        return
+    headers = None
+    try:
+        key = cache_key(endpoint, *args.values()) if endpoint in cached_reads else None
+        body = read_cache.lookup(key) if key else None
+        if body is None:
+            rows = await execute(name, [uuid.UUID(value) for value in args.values()])
+            if rows:
+                body = to_json(rows[0])
+                if key:
+                    read_cache.fill(key, body)
+        if quarantined(body):
+            payload, status = responses.dumps({'message': '%s is quarantined by moderation' % noun}), 403
+        elif body is not None:
+            payload, status, headers = await validators(scope, endpoint, body)
+        else:
+            payload, status = responses.dumps({'message': '%s not found' % noun}), 404
+    except Exception as e:
+        log.exception('Error serving %s: %s', endpoint, e)
+        payload, status, headers = responses.dumps({'message': 'Internal Server Error'}), 500, None
+    await respond(send, payload, status, headers)
+    metrics.request_seconds.observe(time.perf_counter() - start, 'GET', rule.rule, status)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # connect, check the schema and prepare in the worker process before it takes traffic
+            if not await asyncio.get_running_loop().run_in_executor(None, lambda: migrations.verify(db.session(), SCHEMA_CHECK)):
+                await send({'type': 'lifespan.startup.failed', 'message': 'The live schema does not match migrations.py'})
+                return
+            await asyncio.get_running_loop().run_in_executor(None, queries.prepare_all)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            db.connection.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        try:
+            rule, args = adapter.match(scope['path'], method='GET', return_rule=True)
+        except NotFound:
+            pass
+        else:
+            # an unknown view is left to the Flask app to turn down
+            if rule.endpoint != 'snippets' or query(scope, 'view', 'full') in VIEWS:
+                return await read(scope, send, rule, args)
+    return await wsgi(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='127.0.0.1', port=5000)
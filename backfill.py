@@ -0,0 +1,122 @@
+import argparse
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from cassandra.concurrent import execute_concurrent
+import db
+import logs
+import migrations
+from queries import QueryRegistry
+
+# copies interactions and reports written before migration 3 into the day buckets, and bounties written
+# before migration 6 into SnippetBountiesBySnippet
+#   python backfill.py --tables interactions,reports,bounties --concurrency 100
+# Every row is written again to its by-ID table and to its bucket with what is left of the table's TTL,
+# counted from CreatedAt, so old rows expire on the same schedule as new ones. Rows already past the TTL
+# are left as they are, or deleted with --drop-expired. Every write is an upsert, so it can be run again
+#
+# SnippetStats only counts interactions from the release that added it on; the ones before are added with
+#   python backfill.py --tables '' --stats-before 2024-05-01T12:00:00
+# naming when that release went out. Counters can't be upserted, so this part must run exactly once
+
+# table: (scan, by-ID table, writes for a row given its TTL, delete for an expired row)
+TABLES = {
+    'interactions': ('scan_interactions', 'interactions',
+        lambda row, ttl: [
+            ('backfill_interaction', (row.interactionid, row.snippetid, row.userid, row.type, row.createdat, ttl)),
+            ('backfill_interaction_by_day', (row.snippetid, row.createdat.date(), row.createdat, row.interactionid, row.userid, row.type, ttl)),
+        ],
+        lambda row: ('delete_interaction', (row.interactionid,))),
+    'reports': ('scan_reports', 'reports',
+        lambda row, ttl: [
+            ('backfill_report', (row.reportid, row.snippetid, row.userid, row.reason, row.createdat, ttl)),
+            ('backfill_report_by_day', (row.createdat.date(), migrations.report_bucket(row.reportid), row.createdat, row.reportid, row.snippetid, row.userid, row.reason, ttl)),
+        ],
+        lambda row: ('delete_report', (row.reportid,))),
+    # bounties don't expire and are already in their by-ID table; one without a snippet has nowhere to go
+    'bounties': ('scan_snippetbounties', 'snippetbounties',
+        lambda row, ttl: [
+            ('backfill_bounty_by_snippet', (row.snippetid, row.createdat, row.bountyid, row.userid, row.amount, ttl)),
+        ] if row.snippetid else [],
+        lambda row: ('delete_snippetbounty', (row.bountyid,))),
+}
+
+def backfill(queries, name, concurrency=100, drop_expired=False):
+    # returns counts of what happened to the rows
+    scan, table, writes, delete = TABLES[name]
+    live = migrations.live_tables(queries.session).get(table)
+    ttl = int(live.options.get('default_time_to_live') or 0) if live is not None else 0
+    counts = {'copied': 0, 'expired': 0, 'dropped': 0, 'undated': 0, 'failed': 0}
+    now = datetime.now()
+
+    def statements():
+        for row in queries.execute(scan):
+            if row.createdat is None:
+                counts['undated'] += 1
+                continue
+            # 0 is no TTL, as with the table default
+            left = ttl - int((now - row.createdat).total_seconds()) if ttl else 0
+            if ttl and left <= 0:
+                counts['expired'] += 1
+                if drop_expired:
+                    counts['dropped'] += 1
+                    statement, params = delete(row)
+                    yield queries[statement], params
+                continue
+            counts['copied'] += 1
+            for statement, params in writes(row, left):
+                yield queries[statement], params
+
+    for success, result in execute_concurrent(queries.session, statements(), concurrency=concurrency, raise_on_first_error=False, results_generator=True):
+        if not success:
+            counts['failed'] += 1
+            if counts['failed'] == 1:
+                print('Failed to backfill some %s: %r' % (name, result))
+    return counts
+
+def backfill_stats(queries, before, concurrency=100):
+    # adds the interactions created before the counters were kept to SnippetStats, one increment per
+    # snippet and type; returns counts of what happened
+    deltas = Counter()
+    counts = {'counted': 0, 'later': 0, 'undated': 0, 'counters': 0, 'failed': 0}
+    for row in queries.execute('scan_interactions'):
+        if row.createdat is None or row.snippetid is None:
+            counts['undated'] += 1
+        elif row.createdat >= before:
+            counts['later'] += 1
+        else:
+            counts['counted'] += 1
+            deltas[(row.snippetid, row.type)] += 1
+    counts['counters'] = len(deltas)
+    for success, result in queries.execute_concurrent('increment_snippet_stat', [(delta, snippet_id, kind) for (snippet_id, kind), delta in deltas.items()], concurrency):
+        if not success:
+            counts['failed'] += 1
+            if counts['failed'] == 1:
+                print('Failed to backfill some snippet stats: %r' % (result,))
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy existing interactions, reports and bounties into the tables added for them')
+    parser.add_argument('--tables', default=','.join(TABLES), help='comma separated, from %s' % ', '.join(TABLES))
+    parser.add_argument('--concurrency', type=int, default=100, help='writes in flight')
+    parser.add_argument('--drop-expired', action='store_true', help='delete rows already older than the TTL')
+    parser.add_argument('--stats-before', type=datetime.fromisoformat, help='add the interactions created before this time to SnippetStats, once')
+    args = parser.parse_args()
+    logs.setup(os.environ)
+    queries = QueryRegistry(db.session)
+    failed = 0
+    for name in [name.strip() for name in args.tables.split(',') if name.strip()]:
+        if name not in TABLES:
+            raise SystemExit('No backfill for %s, pick from %s' % (name, ', '.join(TABLES)))
+        started = time.perf_counter()
+        counts = backfill(queries, name, args.concurrency, args.drop_expired)
+        failed += counts['failed']
+        print('Backfilled %s in %.1fs: %s' % (name, time.perf_counter() - started, ', '.join('%d %s' % (count, key) for key, count in counts.items())))
+    if args.stats_before:
+        started = time.perf_counter()
+        counts = backfill_stats(queries, args.stats_before, args.concurrency)
+        failed += counts['failed']
+        print('Backfilled snippet stats in %.1fs: %s' % (time.perf_counter() - started, ', '.join('%d %s' % (count, key) for key, count in counts.items())))
+    if failed:
+        raise SystemExit(1)
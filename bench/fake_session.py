@@ -0,0 +1,475 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+from cassandra.cluster import ResultSet
+from cassandra.query import named_tuple_factory
+from cassandra.query import BatchStatement, BoundStatement, PreparedStatement, SimpleStatement
+
+# in-memory stand-in for a cassandra Session, understands the CQL this repo sends
+
+def _split(text):
+    parts, depth, current = [], 0, ''
+    for ch in text:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        if ch == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += ch
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+class FakeTable():
+    def __init__(self, name, columns, partition_key, clustering_key, descending, default_ttl=None):
+        self.name = name
+        self.columns = columns
+        self.partition_key = partition_key
+        self.clustering_key = clustering_key
+        self.descending = descending
+        self.types = {}
+        self.options = {}
+        self.rows = {}
+        # {key: time the row expires} for rows written with a TTL; rows aren't expired, only TTL() reads it
+        self.expires = {}
+
+    def written(self, key, ttl):
+        if ttl:
+            self.expires[key] = time.time() + ttl
+        else:
+            self.expires.pop(key, None)
+
+    def ttl(self, row, column):
+        expires = self.expires.get(self.key(row))
+        if expires is None or row.get(column) is None:
+            return None
+        return max(int(expires - time.time()), 0)
+
+    def metadata(self):
+        # the parts of the driver's TableMetadata that migrations.py and transfer.py read
+        columns = dict((name, SimpleNamespace(name=name, cql_type=self.types.get(name, 'text'))) for name in self.columns)
+        return SimpleNamespace(name=self.name.split('.')[-1], columns=columns, options=self.options,
+            partition_key=[columns[name] for name in self.partition_key],
+            primary_key=[columns[name] for name in self.partition_key + self.clustering_key])
+
+    def key(self, row):
+        return tuple(row.get(c) for c in self.partition_key + self.clustering_key)
+
+    def sorted_rows(self, rows):
+        def sort_key(row):
+            return tuple(str(row.get(c)) for c in self.partition_key)
+        rows = sorted(rows, key=sort_key)
+        for column in reversed(self.clustering_key):
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=column in self.descending)
+            rows.sort(key=sort_key)
+        return rows
+
+class FakePrepared(PreparedStatement):
+    def __init__(self, query_string):
+        self.query_string = query_string
+        self.query_id = query_string
+        self.keyspace = None
+        self.routing_key_indexes = None
+        self.fetch_size = None
+        self.consistency_level = None
+        self.serial_consistency_level = None
+        self.custom_payload = None
+        self.is_idempotent = False
+        self.result_metadata = None
+        self.column_metadata = []
+
+    def bind(self, values):
+        return FakeBound(self, values)
+
+class FakeBound(BoundStatement):
+    routing_key = None
+
+    def __init__(self, prepared, values):
+        self.prepared_statement = prepared
+        self.values = list(values or ())
+        self.keyspace = None
+        self.custom_payload = None
+        self.fetch_size = prepared.fetch_size
+        self.paging_state = None
+        self.consistency_level = None
+        self.serial_consistency_level = None
+        self.is_idempotent = prepared.is_idempotent
+        self._routing_key = None
+        self.retry_policy = None
+        self.trace = None
+
+class FakeResponseFuture():
+    _continuous_paging_session = None
+    row_factory = staticmethod(named_tuple_factory)
+
+    def __init__(self, session, rows, columns, fetch_size, offset=0, error=None, query=None):
+        self.session = session
+        self.query = query
+        self.all_rows = rows
+        self._col_names = columns
+        self._col_types = None
+        self.fetch_size = fetch_size
+        self.offset = offset
+        self.error = error
+        self._callbacks = []
+        self.query_trace = None
+
+    @property
+    def has_more_pages(self):
+        return bool(self.fetch_size) and self.offset + self.fetch_size < len(self.all_rows)
+
+    @property
+    def _paging_state(self):
+        if self.has_more_pages:
+            return str(self.offset + self.fetch_size).encode()
+        return None
+
+    def page(self):
+        if self.fetch_size:
+            return self.all_rows[self.offset:self.offset + self.fetch_size]
+        return self.all_rows
+
+    def start_fetching_next_page(self):
+        self.offset += self.fetch_size
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return ResultSet(self, self.page())
+
+    def add_callback(self, fn, *args, **kwargs):
+        if self.error is None:
+            fn(self.page(), *args, **kwargs)
+        return self
+
+    def add_errback(self, fn, *args, **kwargs):
+        if self.error is not None:
+            fn(self.error, *args, **kwargs)
+        return self
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None, errback_args=(), errback_kwargs=None):
+        self.add_callback(callback, *callback_args, **(callback_kwargs or {}))
+        self.add_errback(errback, *errback_args, **(errback_kwargs or {}))
+
+    def clear_callbacks(self):
+        pass
+
+class FakeMetadata():
+    cluster_name = 'fake'
+
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def keyspaces(self):
+        keyspaces = {}
+        for name, table in self.session.tables.items():
+            keyspace = name.split('.')[0]
+            keyspaces.setdefault(keyspace, SimpleNamespace(name=keyspace, tables={})).tables[name.split('.')[-1]] = table.metadata()
+        return keyspaces
+
+class FakeSession():
+    def __init__(self):
+        self.tables = {}
+        self.cluster = SimpleNamespace(metadata=FakeMetadata(self))
+        self.lock = threading.RLock()
+        self.encoder = None
+        self.executed = 0
+
+    def prepare(self, query):
+        self.parse(query)
+        return FakePrepared(query)
+
+    def execute(self, query, parameters=None, timeout=None, trace=False, custom_payload=None, execution_profile=None, paging_state=None, host=None, execute_as=None):
+        return self.execute_async(query, parameters, paging_state=paging_state).result()
+
+    def execute_async(self, query, parameters=None, trace=False, custom_payload=None, timeout=None, execution_profile=None, paging_state=None, host=None, execute_as=None):
+        fetch_size = getattr(query, 'fetch_size', None)
+        if not isinstance(fetch_size, int):
+            fetch_size = None
+        try:
+            with self.lock:
+                rows, columns = self.run(query, parameters)
+        except Exception as e:
+            return FakeResponseFuture(self, [], None, None, error=e)
+        offset = int(paging_state.decode()) if paging_state else 0
+        return FakeResponseFuture(self, rows, columns, fetch_size, offset, query=query)
+
+    def submit(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def shutdown(self):
+        pass
+
+    def run(self, query, parameters):
+        self.executed += 1
+        if isinstance(query, BatchStatement):
+            for _, statement, values in query._statements_and_parameters:
+                self.run_cql(statement, list(values))
+            return [], None
+        if isinstance(query, BoundStatement):
+            return self.run_cql(query.prepared_statement.query_string, query.values)
+        if isinstance(query, (PreparedStatement, SimpleStatement)):
+            return self.run_cql(query.query_string, list(parameters or ()))
+        return self.run_cql(query, list(parameters or ()))
+
+    def parse(self, cql):
+        return cql.strip().rstrip(';')
+
+    def table(self, name):
+        name = name.lower()
+        if name not in self.tables:
+            raise Exception('unconfigured table %s' % name)
+        return self.tables[name]
+
+    def run_cql(self, cql, params):
+        cql = ' '.join(self.parse(cql).split())
+        params = list(params)
+        verb = cql.split(' ', 1)[0].upper()
+        if verb == 'CREATE':
+            return self.create(cql), None
+        if verb in ('ALTER', 'DROP', 'TRUNCATE'):
+            return self.alter(cql), None
+        if verb == 'SELECT':
+            return self.select(cql, params)
+        if verb == 'INSERT':
+            return self.insert(cql, params)
+        if verb == 'UPDATE':
+            return self.update(cql, params)
+        if verb == 'DELETE':
+            return self.delete(cql, params)
+        if verb == 'BEGIN':
+            return [], None
+        raise Exception('unsupported statement %s' % cql)
+
+    def create(self, cql):
+        m = re.match(r'CREATE TABLE (?:IF NOT EXISTS )?([\w.]+) \((.*?)\)(?: WITH (.*))?$', cql, re.I | re.S)
+        if not m:
+            return []
+        name = m.group(1).lower()
+        if name in self.tables:
+            return []
+        columns, partition_key, clustering_key, types = [], [], [], {}
+        for part in _split(m.group(2)):
+            words = part.split()
+            if words[0].upper() == 'PRIMARY':
+                inner = part[part.index('(') + 1:part.rindex(')')]
+                keys = _split(inner)
+                if keys[0].startswith('('):
+                    partition_key = [k.strip().lower() for k in keys[0].strip('()').split(',')]
+                else:
+                    partition_key = [keys[0].lower()]
+                clustering_key = [k.lower() for k in keys[1:]]
+            else:
+                columns.append(words[0].lower())
+                types[words[0].lower()] = words[1].lower()
+                if 'PRIMARY KEY' in part.upper():
+                    partition_key = [words[0].lower()]
+        descending = set()
+        options = m.group(3) or ''
+        order = re.search(r'CLUSTERING ORDER BY \((.*?)\)', options, re.I)
+        if order:
+            for part in order.group(1).split(','):
+                column, direction = part.split()
+                if direction.upper() == 'DESC':
+                    descending.add(column.lower())
+        self.tables[name] = FakeTable(name, columns, partition_key, clustering_key, descending)
+        self.tables[name].types = types
+        return []
+
+    def alter(self, cql):
+        m = re.match(r'ALTER TABLE ([\w.]+) ADD (\w+) (\w+)', cql, re.I)
+        if m:
+            table = self.table(m.group(1))
+            if m.group(2).lower() in table.columns:
+                raise Exception('column %s already exists' % m.group(2))
+            table.columns.append(m.group(2).lower())
+            table.types[m.group(2).lower()] = m.group(3).lower()
+        m = re.match(r'TRUNCATE (?:TABLE )?([\w.]+)', cql, re.I)
+        if m:
+            self.table(m.group(1)).rows.clear()
+            self.table(m.group(1)).expires.clear()
+        return []
+
+    def where(self, clause, params):
+        conditions = []
+        for part in re.split(r' AND ', clause, flags=re.I):
+            m = re.match(r'(token\([\w, ]+\)|\w+) *(=|>=|<=|>|<| IN ) *(\?|\S+)$', part.strip(), re.I)
+            if not m:
+                raise Exception('unsupported condition %s' % part)
+            column, op, value = m.group(1).lower(), m.group(2).strip().upper(), m.group(3)
+            value = params.pop(0) if value == '?' else _literal(value)
+            conditions.append((column, op, value))
+        return conditions
+
+    def matches(self, row, conditions):
+        for column, op, value in conditions:
+            if column.startswith('token('):
+                current = _token(row, column)
+            else:
+                current = row.get(column)
+            if op == '=' and current != value:
+                return False
+            if op == 'IN' and current not in value:
+                return False
+            if op in ('>', '>=', '<', '<='):
+                if current is None:
+                    return False
+                if op == '>' and not current > value:
+                    return False
+                if op == '>=' and not current >= value:
+                    return False
+                if op == '<' and not current < value:
+                    return False
+                if op == '<=' and not current <= value:
+                    return False
+        return True
+
+    def select(self, cql, params):
+        m = re.match(r'SELECT (.*?) FROM ([\w.]+)(?: WHERE (.*?))?(?: LIMIT (\?|\d+))?(?: ALLOW FILTERING)?$', cql, re.I)
+        if not m:
+            raise Exception('unsupported select %s' % cql)
+        table = self.table(m.group(2))
+        conditions = self.where(m.group(3), params) if m.group(3) else []
+        limit = m.group(4)
+        if limit == '?':
+            limit = params.pop(0)
+        elif limit:
+            limit = int(limit)
+        rows = table.sorted_rows([r for r in table.rows.values() if self.matches(r, conditions)])
+        if limit:
+            rows = rows[:limit]
+        selected = m.group(1).strip()
+        if selected == '*':
+            columns = list(table.columns)
+        else:
+            columns = [c.strip().lower() for c in _split(selected)]
+        if len(columns) == 1 and columns[0].startswith('count('):
+            Row = namedtuple('Row', ['count'])
+            return [Row(len(rows))], ['count']
+        names = [re.sub(r'\W', '_', c) for c in columns]
+        Row = namedtuple('Row', names, rename=True)
+        return [Row(*[table.ttl(row, c[4:-1].strip()) if c.startswith('ttl(') else _column(row, c) for c in columns]) for row in rows], names
+
+    def insert(self, cql, params):
+        m = re.match(r'INSERT INTO ([\w.]+) \((.*?)\) VALUES \((.*?)\)( IF NOT EXISTS)?(?: USING TTL (\?|\d+))?$', cql, re.I)
+        if not m:
+            raise Exception('unsupported insert %s' % cql)
+        table = self.table(m.group(1))
+        columns = [c.strip().lower() for c in m.group(2).split(',')]
+        values = [params.pop(0) if v.strip() == '?' else _literal(v.strip()) for v in _split(m.group(3))]
+        row = dict(zip(columns, values))
+        key = table.key(row)
+        ttl = (params.pop(0) if m.group(5) == '?' else int(m.group(5))) if m.group(5) else None
+        if m.group(4):
+            existing = table.rows.get(key)
+            if existing is not None:
+                return self.applied(False, existing, table)
+            table.rows[key] = row
+            table.written(key, ttl)
+            return self.applied(True)
+        table.rows.setdefault(key, {}).update(row)
+        table.written(key, ttl)
+        return [], None
+
+    def applied(self, applied, existing=None, table=None):
+        names = ['applied']
+        values = [applied]
+        if existing is not None:
+            for column in table.columns:
+                names.append(column)
+                values.append(existing.get(column))
+        Row = namedtuple('Row', names, rename=True)
+        return [Row(*values)], ['[applied]'] + names[1:]
+
+    def update(self, cql, params):
+        m = re.match(r'UPDATE ([\w.]+)(?: USING TTL (?:\?|\d+))? SET (.*?) WHERE (.*?)( IF EXISTS| IF .*)?$', cql, re.I)
+        if not m:
+            raise Exception('unsupported update %s' % cql)
+        ttl = params.pop(0) if ' USING TTL ?' in cql.upper() else None
+        table = self.table(m.group(1))
+        assignments = []
+        for part in _split(m.group(2)):
+            column, expression = [p.strip() for p in part.split('=', 1)]
+            counter = re.match(r'(\w+) *([+-]) *(\?|\d+)$', expression)
+            if counter:
+                value = params.pop(0) if counter.group(3) == '?' else int(counter.group(3))
+                assignments.append((column.lower(), counter.group(2), value))
+            else:
+                value = params.pop(0) if expression == '?' else _literal(expression)
+                assignments.append((column.lower(), '=', value))
+        conditions = self.where(m.group(3), params)
+        key_row = dict((c, v) for c, op, v in conditions if op == '=')
+        key = table.key(key_row)
+        condition = (m.group(4) or '').strip()
+        if condition.upper() == 'IF EXISTS' and key not in table.rows:
+            return self.applied(False)
+        if condition.upper().startswith('IF ') and condition.upper() != 'IF EXISTS':
+            checks = self.where(condition[3:], params)
+            existing = table.rows.get(key, {})
+            if not self.matches(existing, checks):
+                return self.applied(False, existing, table)
+        row = table.rows.setdefault(key, dict(key_row))
+        if ttl is not None:
+            table.written(key, ttl)
+        for column, op, value in assignments:
+            if op == '=':
+                row[column] = value
+            elif op == '+':
+                row[column] = (row.get(column) or 0) + value
+            else:
+                row[column] = (row.get(column) or 0) - value
+        if condition:
+            return self.applied(True)
+        return [], None
+
+    def delete(self, cql, params):
+        m = re.match(r'DELETE (?:(.*?) )?FROM ([\w.]+) WHERE (.*?)( IF EXISTS)?$', cql, re.I)
+        if not m:
+            raise Exception('unsupported delete %s' % cql)
+        table = self.table(m.group(2))
+        conditions = self.where(m.group(3), params)
+        for key in [k for k, r in table.rows.items() if self.matches(r, conditions)]:
+            if m.group(1):
+                for column in m.group(1).split(','):
+                    table.rows[key].pop(column.strip().lower(), None)
+            else:
+                del table.rows[key]
+                table.expires.pop(key, None)
+        return [], None
+
+def _column(row, column):
+    if column.startswith('token('):
+        return _token(row, column)
+    return row.get(column)
+
+def _token(row, column):
+    names = [c.strip().lower() for c in column[6:-1].split(',')]
+    value = hash(tuple(str(row.get(n)) for n in names)) & 0xFFFFFFFFFFFFFFFF
+    return value - 2 ** 63
+
+def _literal(value):
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1]
+    if value.lower() == 'null':
+        return None
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def install(connection):
+    # hands a FakeSession to db.Connection in place of a cluster and applies the migrations to it
+    import migrations
+    session = FakeSession()
+    connection.current, connection.pid = session, os.getpid()
+    migrations.migrate(session, {})
+    return session
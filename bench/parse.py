@@ -0,0 +1,55 @@
+import argparse
+import json
+import time
+import uuid
+from flask import Flask
+from flask_restful import reqparse
+from schemas import Schema, UUID, TEXT
+
+# CPU per request spent turning a snippet POST body into handler arguments:
+# a RequestParser built and run per request plus uuid.UUID on the ids (the old handlers),
+# against a Schema compiled once
+#   python -m bench.parse --iterations 20000
+
+app = Flask(__name__)
+schema = Schema(UserID=UUID, Title=TEXT, Content=TEXT, Language=TEXT)
+
+def with_reqparse():
+    parser = reqparse.RequestParser()
+    parser.add_argument('UserID', required=True)
+    parser.add_argument('Title', required=True)
+    parser.add_argument('Content', required=True)
+    parser.add_argument('Language', required=True)
+    args = parser.parse_args()
+    return uuid.UUID(args['UserID']), args
+
+def with_schema():
+    args = schema.parse()
+    return args['UserID'], args
+
+def measure(parse, body, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        with app.test_request_context('/snippets', method='POST', data=body, content_type='application/json'):
+            parse()
+    return (time.process_time() - start) / iterations
+
+def baseline(body, iterations):
+    # the request context alone, subtracted from both
+    start = time.process_time()
+    for _ in range(iterations):
+        with app.test_request_context('/snippets', method='POST', data=body, content_type='application/json'):
+            pass
+    return (time.process_time() - start) / iterations
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare per-request parsing CPU of reqparse and compiled schemas')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+    body = json.dumps({'UserID': str(uuid.uuid4()), 'Title': 'Hello', 'Content': 'print("Hello World")', 'Language': 'Python'})
+    context = baseline(body, args.iterations)
+    old = measure(with_reqparse, body, args.iterations) - context
+    new = measure(with_schema, body, args.iterations) - context
+    print('reqparse  %8.2f us/request' % (old * 1e6))
+    print('schema    %8.2f us/request' % (new * 1e6))
+    print('saved     %8.2f us/request (%.1fx)' % ((old - new) * 1e6, old / new if new > 0 else float('inf')))
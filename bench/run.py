@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+import httpx
+
+# load generator for the API, built from the flows in test.py
+#   python -m bench.run --target fake --mix get_snippet=80,create_comment=20 --concurrency 32 --duration 20 --out run.json
+# --target fake serves asgi.application in-process on bench/fake_session.py so nothing else needs to run;
+# any other target is a base URL, e.g. a server started with SCYLLA_LOCAL=1 against a local container
+# (docker run -p 9042:9042 scylladb/scylla, python migrations.py, uvicorn asgi:application --port 5000)
+
+class State():
+    # ids created during setup and by write scenarios, picked at random by read scenarios
+    def __init__(self):
+        self.users = []
+        self.snippets = []
+        self.tags = []
+        self.comments = []
+        self.interactions = []
+
+def body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {}
+
+async def create_user(client, state):
+    response = await client.post('/users', json={'Username': 'bench', 'Email': 'bench@gmail.com', 'PasswordHash': '12345678'})
+    if response.status_code == 201:
+        state.users.append(body(response)['UserID'])
+    return response
+
+async def get_user(client, state):
+    return await client.get('/users/' + random.choice(state.users))
+
+async def create_snippet(client, state):
+    response = await client.post('/snippets', json={'UserID': random.choice(state.users), 'Title': 'Bench', 'Content': 'print("Hello World")', 'Language': 'Python'})
+    if response.status_code == 201:
+        state.snippets.append(body(response)['SnippetID'])
+    return response
+
+async def get_snippet(client, state):
+    return await client.get('/snippets/' + random.choice(state.snippets))
+
+async def update_snippet(client, state):
+    return await client.put('/snippets/' + random.choice(state.snippets), json={'UserID': random.choice(state.users), 'Title': 'Bench 2', 'Content': 'print("Hello World!")', 'Language': 'Python'})
+
+async def list_user_snippets(client, state):
+    return await client.get('/users/%s/snippets' % random.choice(state.users))
+
+async def bulk_get_snippets(client, state):
+    return await client.get('/snippets', params={'ids': ','.join(random.sample(state.snippets, min(10, len(state.snippets))))})
+
+async def search_snippets(client, state):
+    return await client.get('/search', params=random.choice([{'q': 'hello'}, {'q': 'bench print', 'lang': 'Python'}, {'tag': 'bench'}]))
+
+async def trending_feed(client, state):
+    return await client.get('/feed/trending', params=random.choice([{}, {'lang': 'Python'}, {'tag': 'bench'}]))
+
+async def create_tag(client, state):
+    response = await client.post('/tags', json={'Name': 'bench'})
+    if response.status_code == 201:
+        state.tags.append(body(response)['TagID'])
+    return response
+
+async def get_tag(client, state):
+    return await client.get('/tags/' + random.choice(state.tags))
+
+async def create_snippet_tag(client, state):
+    return await client.post('/snippettags', json={'SnippetID': random.choice(state.snippets), 'TagID': random.choice(state.tags)})
+
+async def list_snippet_tags(client, state):
+    return await client.get('/snippets/%s/tags' % random.choice(state.snippets))
+
+async def create_interaction(client, state):
+    response = await client.post('/interactions', json={'SnippetID': random.choice(state.snippets), 'UserID': random.choice(state.users), 'Type': random.choice(['like', 'view'])})
+    if response.status_code in (201, 202):
+        state.interactions.append(body(response)['InteractionID'])
+    return response
+
+async def snippet_stats(client, state):
+    return await client.get('/snippets/%s/stats' % random.choice(state.snippets))
+
+async def snippet_page(client, state):
+    return await client.get('/snippets/%s/full' % random.choice(state.snippets))
+
+async def create_comment(client, state):
+    response = await client.post('/comments', json={'SnippetID': random.choice(state.snippets), 'UserID': random.choice(state.users), 'Content': 'This is a test comment'})
+    if response.status_code == 201:
+        state.comments.append(body(response)['CommentID'])
+    return response
+
+async def get_comment(client, state):
+    return await client.get('/comments/' + random.choice(state.comments))
+
+async def list_snippet_comments(client, state):
+    return await client.get('/snippets/%s/comments' % random.choice(state.snippets))
+
+SCENARIOS = dict((scenario.__name__, scenario) for scenario in [
+    create_user, get_user, create_snippet, get_snippet, update_snippet, list_user_snippets, bulk_get_snippets,
+    search_snippets, trending_feed, create_tag, get_tag, create_snippet_tag, list_snippet_tags, create_interaction, snippet_stats, snippet_page,
+    create_comment, get_comment, list_snippet_comments,
+])
+
+async def seed(client, state, count):
+    # every read scenario needs something to read
+    for scenario, times in [(create_user, count), (create_snippet, count), (create_tag, count), (create_comment, count), (create_interaction, count)]:
+        for _ in range(times):
+            response = await scenario(client, state)
+            if response.status_code >= 300:
+                raise Exception('Seeding with %s failed: %s %s' % (scenario.__name__, response.status_code, response.text))
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit('Unknown scenario %s, pick from %s' % (name, ', '.join(SCENARIOS)))
+        weights[name] = float(weight or 1)
+    return weights
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput': len(ordered) / elapsed if elapsed else 0.0,
+        'mean_ms': sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+    }
+
+async def drive(client, state, weights, concurrency, duration, requests):
+    names, cumulative = list(weights), list(weights.values())
+    latencies = dict((name, []) for name in names)
+    errors = dict((name, 0) for name in names)
+    sent = [0]
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline and (not requests or sent[0] < requests):
+            sent[0] += 1
+            name = random.choices(names, cumulative)[0]
+            start = time.perf_counter()
+            try:
+                response = await SCENARIOS[name](client, state)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies[name].append(time.perf_counter() - start)
+            if failed:
+                errors[name] += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - start
+    endpoints = dict((name, summarize(latencies[name], errors[name], elapsed)) for name in names)
+    total = summarize([latency for name in names for latency in latencies[name]], sum(errors.values()), elapsed)
+    return endpoints, total, elapsed
+
+def client_for(target, concurrency):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if target != 'fake':
+        return httpx.AsyncClient(base_url=target, limits=limits, timeout=30)
+    os.environ.setdefault('MODERATION_BACKEND', 'fake')
+    os.environ.setdefault('MODERATION_MAX_WAIT', '0')
+    os.environ.setdefault('SEARCH_INDEX', ':memory:')
+    os.environ.setdefault('SIMILAR_INDEX', ':memory:')
+    os.environ.setdefault('RATE_LIMITS', 'off')
+    os.environ.setdefault('TRENDING_STATE', '')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import db
+    from bench import fake_session
+    fake_session.install(db.connection)
+    import asgi
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi.application), base_url='http://bench', limits=limits, timeout=30)
+
+def compare(results, baseline):
+    print('\nvs %s' % baseline['started'])
+    for name, current in results['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before:
+            print('%-24s throughput %+7.1f%%  p99 %+7.1f%%' % (name,
+                (current['throughput'] / before['throughput'] - 1) * 100 if before['throughput'] else 0,
+                (current['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0))
+
+async def main(args):
+    random.seed(args.seed)
+    weights = parse_mix(args.mix)
+    state = State()
+    async with client_for(args.target, args.concurrency) as client:
+        await seed(client, state, args.seed_items)
+        endpoints, total, elapsed = await drive(client, state, weights, args.concurrency, args.duration, args.requests)
+    results = {
+        'started': datetime.now().isoformat(),
+        'target': args.target,
+        'mix': weights,
+        'concurrency': args.concurrency,
+        'elapsed': elapsed,
+        'total': total,
+        'endpoints': endpoints,
+    }
+    print('%-24s %8s %7s %10s %9s %9s %9s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, stats in list(endpoints.items()) + [('total', total)]:
+        print('%-24s %8d %7d %10.1f %9.2f %9.2f %9.2f' % (name, stats['requests'], stats['errors'], stats['throughput'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive weighted API scenarios and report per-endpoint throughput and latency')
+    parser.add_argument('--target', default='fake', help='"fake" for the in-memory session, or a base URL such as http://127.0.0.1:5000')
+    parser.add_argument('--mix', default='get_snippet=80,create_comment=20', help='scenario=weight pairs, scenarios: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests (0 for no limit)')
+    parser.add_argument('--seed-items', type=int, default=20, help='users, snippets, tags, comments and interactions created before the run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='a previous --out file to print the change against')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from responses import dumps, loads
+
+log = logging.getLogger(__name__)
+
+# bounded in-process tier: least recently used entries are evicted first, and every entry expires after ttl seconds
+class LRUCache():
+    def __init__(self, maxsize=10000, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+# shared tier backed by redis, values are stored as JSON encoded like the responses they become
+class RedisBackend():
+    def __init__(self, url, ttl=300):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else loads(value)
+
+    def set(self, key, value):
+        self.client.set(key, dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+# local stand-in for the shared tier, same interface as RedisBackend
+class DictBackend():
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            return loads(entry[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (dumps(value), time.monotonic() + self.ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class ReadThroughCache():
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def lookup(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.count('local_hits')
+            return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                log.warning('Shared cache get failed for %s: %s', key, e)
+                value = None
+            if value is not None:
+                self.count('shared_hits')
+                self.local.set(key, value)
+                return value
+        self.count('misses')
+        return None
+
+    def fill(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value)
+            except Exception as e:
+                log.warning('Shared cache set failed for %s: %s', key, e)
+
+    def get(self, key, load):
+        # load() returns the value to cache, or None when there is nothing to cache (e.g. not found)
+        value = self.lookup(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.fill(key, value)
+        return value
+
+    def invalidate(self, key):
+        self.count('invalidations')
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception as e:
+                log.warning('Shared cache delete failed for %s: %s', key, e)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['hits'] = stats['local_hits'] + stats['shared_hits']
+        stats['size'] = len(self.local)
+        return stats
+
+def from_env(env):
+    # CACHE_SHARED is a redis:// URL, "local" for the in-process stand-in, or unset for no shared tier
+    local = LRUCache(int(env.get('CACHE_SIZE', 10000)), float(env.get('CACHE_LOCAL_TTL', 5)))
+    shared_url = env.get('CACHE_SHARED')
+    shared_ttl = int(env.get('CACHE_SHARED_TTL', 300))
+    if not shared_url:
+        shared = None
+    elif shared_url == 'local':
+        shared = DictBackend(shared_ttl)
+    else:
+        shared = RedisBackend(shared_url, shared_ttl)
+    return ReadThroughCache(local, shared)
@@ -0,0 +1,217 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+# snippet Content is kept out of the Snippets row, compressed, in Devspace.SnippetContent under the SHA-256
+# of its UTF-8 bytes, so identical content is stored once however many snippets share it. The Snippets row
+# holds the hash, the size and a short Preview, which is all a listing or GET ?view=preview reads.
+# Content is written before the row pointing at it, and written again by every snippet that uses it, so
+# StoredAt tells gc which unreferenced content is too recent to be an orphan.
+#   python content.py pack   moves Content still inline in Snippets rows into SnippetContent
+#   python content.py gc     deletes content no snippet points at any more
+# Rows written before migration 4 keep their inline Content until packed, and are read as they are
+
+# decompressed bytes per chunk when streaming
+CHUNK = 64 * 1024
+
+class RawCodec():
+    name = 'none'
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def chunks(self, data):
+        for start in range(0, len(data), CHUNK):
+            yield data[start:start + CHUNK]
+
+class ZlibCodec():
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def chunks(self, data):
+        decompressor = zlib.decompressobj()
+        while data:
+            chunk = decompressor.decompress(data, CHUNK)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+class ZstdCodec():
+    # needs zstandard
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level
+
+    def compress(self, data):
+        # a compressor isn't safe to share between threads, and a new one costs little next to the data
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return self.zstandard.ZstdDecompressor().decompress(data)
+
+    def chunks(self, data):
+        yield from self.zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(data), write_size=CHUNK)
+
+CODECS = {'none': RawCodec, 'zlib': ZlibCodec, 'zstd': ZstdCodec}
+_codecs = {}
+
+def codec(name):
+    if name not in _codecs:
+        _codecs[name] = CODECS[name]()
+    return _codecs[name]
+
+def default_codec():
+    try:
+        codec('zstd')
+        return 'zstd'
+    except ImportError:
+        return 'zlib'
+
+# what the Snippets row and SnippetContent row are written with
+Packed = namedtuple('Packed', ['hash', 'size', 'preview', 'codec', 'data'])
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def unpack(row):
+    # the text of a select_snippet_content row
+    return codec(row.codec).decompress(row.data).decode()
+
+class ContentStore():
+    def __init__(self, queries, codec_name=None, min_size=512, preview_chars=280):
+        # content under min_size bytes, or that doesn't get smaller, is stored as it is
+        self.queries = queries
+        self.codec = codec(codec_name or default_codec())
+        self.min_size = min_size
+        self.preview_chars = preview_chars
+
+    def preview(self, text):
+        return text[:self.preview_chars]
+
+    def pack(self, text):
+        data = text.encode()
+        packed = self.codec.compress(data) if len(data) >= self.min_size else data
+        name = self.codec.name
+        if len(packed) >= len(data):
+            packed, name = data, RawCodec.name
+        return Packed(digest(data), len(data), self.preview(text), name, packed)
+
+    def params(self, packed):
+        return (packed.hash, packed.codec, packed.size, packed.data, datetime.now())
+
+    def write(self, packed):
+        self.queries.execute('insert_snippet_content', self.params(packed))
+
+    def text(self, content_hash):
+        # None if there's no content under the hash
+        row = self.queries.execute('select_snippet_content', [content_hash]).one()
+        return unpack(row) if row else None
+
+    def texts(self, hashes, concurrency=50):
+        # {hash: text} for those of hashes that are stored, read concurrently
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        for content_hash, (success, result) in zip(hashes, self.queries.execute_concurrent('select_snippet_content', [[content_hash] for content_hash in hashes], concurrency)):
+            if not success:
+                raise result
+            row = result.one()
+            if row:
+                found[content_hash] = unpack(row)
+        return found
+
+    def chunks(self, content_hash):
+        # (size, iterator of UTF-8 chunks), or None if there's no content under the hash
+        row = self.queries.execute('select_snippet_content', [content_hash]).one()
+        if row is None:
+            return None
+        return row.size, codec(row.codec).chunks(row.data)
+
+    def scan(self, window=100, name='scan_snippets'):
+        # (row, Content) for every snippet of the scan, content read a window of rows at a time
+        rows = []
+        for row in self.queries.execute(name):
+            rows.append(row)
+            if len(rows) == window:
+                yield from self.resolve(rows)
+                rows = []
+        yield from self.resolve(rows)
+
+    def resolve(self, rows):
+        texts = self.texts([row.contenthash for row in rows if row.contenthash])
+        for row in rows:
+            yield row, texts.get(row.contenthash) if row.contenthash else row.content
+
+    def pack_inline(self):
+        # moves Content still held in Snippets rows into SnippetContent; returns (packed, failed).
+        # The row is only changed if its Content is still the one packed, so a concurrent PUT wins
+        packed_count = failed = 0
+        for row in self.queries.execute('scan_snippets'):
+            if row.contenthash or row.content is None:
+                continue
+            packed = self.pack(row.content)
+            try:
+                self.write(packed)
+                if self.queries.execute('pack_snippet_content', (packed.hash, packed.size, packed.preview, row.snippetid, row.content)).was_applied:
+                    packed_count += 1
+            except Exception as e:
+                failed += 1
+                log.warning('Could not pack the content of snippet %s: %s', row.snippetid, e)
+        return packed_count, failed
+
+    def gc(self, grace=timedelta(days=1), concurrency=50):
+        # deletes content that no snippet points at and that hasn't been written for grace; returns the count
+        referenced = set(row.contenthash for row in self.queries.execute('scan_snippets') if row.contenthash)
+        cutoff = datetime.now() - grace
+        orphans = [row.contenthash for row in self.queries.execute('scan_snippet_content')
+            if row.contenthash not in referenced and (row.storedat is None or row.storedat < cutoff)]
+        results = self.queries.execute_concurrent('delete_snippet_content', [[content_hash] for content_hash in orphans], concurrency)
+        return sum(1 for success, _ in results if success)
+
+def from_env(env, queries):
+    # CONTENT_CODEC is zstd (when zstandard is installed, the default) or zlib or none; content under
+    # CONTENT_MIN_COMPRESS bytes isn't compressed; Preview is the first PREVIEW_CHARS characters
+    return ContentStore(queries, env.get('CONTENT_CODEC') or None, int(env.get('CONTENT_MIN_COMPRESS', 512)), int(env.get('PREVIEW_CHARS', 280)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the compressed snippet content table')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('pack', help='Move Content still inline in Snippets rows into SnippetContent')
+    gc_parser = commands.add_parser('gc', help='Delete content no snippet points at')
+    gc_parser.add_argument('--grace-hours', type=float, default=24, help='keep content written this recently even if unreferenced')
+    args = parser.parse_args()
+    import db
+    import logs
+    from queries import QueryRegistry
+    logs.setup(os.environ)
+    store = from_env(os.environ, QueryRegistry(db.session))
+    if args.command == 'pack':
+        packed, failed = store.pack_inline()
+        print('Packed the content of %d snippets, %d failed.' % (packed, failed))
+        if failed:
+            raise SystemExit(1)
+    else:
+        print('Deleted %d unreferenced contents.' % store.gc(timedelta(hours=args.grace_hours)))
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy, ConstantSpeculativeExecutionPolicy, HostDistance
+from cassandra.auth import PlainTextAuthProvider
+from dotenv import load_dotenv, find_dotenv
+_ = load_dotenv(find_dotenv())
+
+log = logging.getLogger(__name__)
+
+# execution profile for reads; writes use the default profile
+READS = 'reads'
+
+CLOUD_HOSTS = "node-0.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud,node-1.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud,node-2.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud"
+
+# SCYLLA_LOCAL=1 points at a single local Scylla/Cassandra container (docker run -p 9042:9042 scylladb/scylla)
+LOCAL = os.getenv('SCYLLA_LOCAL', '0') not in ('0', '', 'false')
+HOSTS = os.getenv('SCYLLA_HOSTS', '127.0.0.1' if LOCAL else CLOUD_HOSTS).split(',')
+PORT = int(os.getenv('SCYLLA_PORT', 9042))
+LOCAL_DC = os.getenv('SCYLLA_LOCAL_DC', 'datacenter1' if LOCAL else 'GCE_US_EAST_1')
+REPLICATION_FACTOR = int(os.getenv('SCYLLA_REPLICATION_FACTOR', 1 if LOCAL else 3))
+CONNECT_TIMEOUT = float(os.getenv('SCYLLA_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('SCYLLA_READ_TIMEOUT', 2))
+WRITE_TIMEOUT = float(os.getenv('SCYLLA_WRITE_TIMEOUT', 5))
+READ_CONSISTENCY = ConsistencyLevel.name_to_value[os.getenv('SCYLLA_READ_CONSISTENCY', 'LOCAL_ONE')]
+WRITE_CONSISTENCY = ConsistencyLevel.name_to_value[os.getenv('SCYLLA_WRITE_CONSISTENCY', 'LOCAL_QUORUM')]
+# a read that hasn't answered after SCYLLA_SPECULATIVE_DELAY_MS is also sent to the next replica (0 turns this off)
+SPECULATIVE_DELAY = float(os.getenv('SCYLLA_SPECULATIVE_DELAY_MS', 50)) / 1000
+SPECULATIVE_ATTEMPTS = int(os.getenv('SCYLLA_SPECULATIVE_ATTEMPTS', 1))
+EXECUTOR_THREADS = int(os.getenv('SCYLLA_EXECUTOR_THREADS', 2))
+# only protocol v1/v2 pool several connections per host, v3+ multiplex requests over one
+CORE_CONNECTIONS = os.getenv('SCYLLA_CORE_CONNECTIONS')
+MAX_CONNECTIONS = os.getenv('SCYLLA_MAX_CONNECTIONS')
+PROTOCOL_VERSION = os.getenv('SCYLLA_PROTOCOL_VERSION')
+
+def build_cluster():
+    balancing = TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=LOCAL_DC))
+    speculative = ConstantSpeculativeExecutionPolicy(SPECULATIVE_DELAY, SPECULATIVE_ATTEMPTS) if SPECULATIVE_DELAY > 0 else None
+    profiles = {
+        EXEC_PROFILE_DEFAULT: ExecutionProfile(load_balancing_policy=balancing, consistency_level=WRITE_CONSISTENCY, request_timeout=WRITE_TIMEOUT),
+        # speculative execution only applies to statements marked idempotent, see QueryRegistry
+        READS: ExecutionProfile(load_balancing_policy=balancing, consistency_level=READ_CONSISTENCY, request_timeout=READ_TIMEOUT, speculative_execution_policy=speculative),
+    }
+    username = os.getenv("SCYLLA")
+    auth_provider = PlainTextAuthProvider(username=username, password=os.getenv("SCYLLA_PASSWORD")) if username else None
+    options = {}
+    if PROTOCOL_VERSION:
+        options['protocol_version'] = int(PROTOCOL_VERSION)
+    cluster = Cluster(
+        execution_profiles=profiles,
+        contact_points=HOSTS,
+        port=PORT,
+        auth_provider=auth_provider,
+        connect_timeout=CONNECT_TIMEOUT,
+        executor_threads=EXECUTOR_THREADS,
+        **options)
+    if PROTOCOL_VERSION and int(PROTOCOL_VERSION) < 3:
+        if CORE_CONNECTIONS:
+            cluster.set_core_connections_per_host(HostDistance.LOCAL, int(CORE_CONNECTIONS))
+        if MAX_CONNECTIONS:
+            cluster.set_max_connections_per_host(HostDistance.LOCAL, int(MAX_CONNECTIONS))
+    return cluster
+
+class Connection():
+    # the session is opened on first use rather than at import, and again in a forked worker
+    # process since the driver's sockets and IO thread don't survive fork
+    def __init__(self):
+        self.cluster = None
+        self.current = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def session(self):
+        if self.current is not None and self.pid == os.getpid():
+            return self.current
+        with self.lock:
+            if self.current is None or self.pid != os.getpid():
+                cluster = build_cluster()
+                self.current = cluster.connect()
+                self.cluster, self.pid = cluster, os.getpid()
+                log.info('Connected to cluster %s', cluster.metadata.cluster_name)
+        return self.current
+
+    def shutdown(self):
+        with self.lock:
+            if self.cluster is not None and self.pid == os.getpid():
+                self.cluster.shutdown()
+            self.cluster = self.current = self.pid = None
+
+connection = Connection()
+
+def session():
+    return connection.session()
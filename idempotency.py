@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import uuid
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+# POSTs sent with an Idempotency-Key header run at most once per key. The first one claims the key in
+# Devspace.IdempotencyKeys with a lightweight transaction and its response is stored there; a retry is
+# answered with the stored response after a plain read, without running the handler again.
+# The claim only lives for lease seconds until the response is stored, so a worker that dies mid-request
+# doesn't hold the key for the whole TTL. Ids of what a keyed POST creates are derived from the key and
+# the request (see Claim.new_id), so a retry that does get past the table (the lease ran out first) writes
+# the same rows instead of new ones. Keys are stored scoped to the caller (see scoped), so two clients
+# that pick the same key never see each other's responses or share ids
+
+# ids derived from keys are UUIDv5 in this namespace
+NAMESPACE = uuid.UUID('3f0b8c52-6d41-4e2a-9d2b-5c1e7a0f4b18')
+MAX_KEY_LENGTH = 255
+# a response that says nothing about the request, so a retry should run it again
+RETRYABLE = (408, 429)
+
+class KeyInUse(Exception):
+    # the key is claimed by a request still running
+    pass
+
+class KeyMismatch(Exception):
+    # the key was used for a different request
+    pass
+
+def fingerprint(method, path, body):
+    return hashlib.sha256(b'%s %s\n%s' % (method.encode(), path.encode(), body)).hexdigest()
+
+def scoped(caller, key):
+    # the key as stored, so the same key from another caller is another key
+    return '%s %s' % (caller, key)
+
+class Claim():
+    def __init__(self, key, fingerprint, stored=True):
+        self.key = key
+        self.fingerprint = fingerprint
+        # False when the request runs unguarded because the table couldn't be read
+        self.stored = stored
+        self.ids = 0
+
+    def new_id(self):
+        # the n-th id the request asks for; the same request asks in the same order, and a different
+        # request under a reused key gets different ids
+        self.ids += 1
+        return uuid.uuid5(NAMESPACE, '%s\n%s\n%d' % (self.key, self.fingerprint, self.ids))
+
+class IdempotencyStore():
+    def __init__(self, queries, ttl=86400, lease=60):
+        self.queries = queries
+        self.ttl = ttl
+        self.lease = lease
+
+    def begin(self, key, fingerprint):
+        # a Claim for a new key, or the stored (status, body) of a finished request
+        row = self.queries.execute('select_idempotency_key', [key]).one()
+        if row is None:
+            result = self.queries.execute('claim_idempotency_key', (key, fingerprint, datetime.now(), self.lease))
+            if result.was_applied:
+                return Claim(key, fingerprint)
+            row = result.one()
+        if row.fingerprint != fingerprint:
+            raise KeyMismatch(key)
+        if row.status is None:
+            raise KeyInUse(key)
+        return row.status, row.body
+
+    def finish(self, claim, status, body):
+        # keeps the response for the TTL, or gives the key up if a retry should run the request again
+        if status >= 500 or status in RETRYABLE:
+            self.queries.execute('release_idempotency_key', [claim.key])
+        else:
+            self.queries.execute('complete_idempotency_key', (self.ttl, claim.fingerprint, status, body, datetime.now(), claim.key))
+
+def from_env(env, queries):
+    # IDEMPOTENCY_TTL_DAYS is how long a stored response is replayed, as in migrations.RETENTION;
+    # IDEMPOTENCY_LEASE_S how long a request may run before its key can be claimed again
+    return IdempotencyStore(queries, int(float(env.get('IDEMPOTENCY_TTL_DAYS', 1)) * 86400), int(env.get('IDEMPOTENCY_LEASE_S', 60)))
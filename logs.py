@@ -0,0 +1,32 @@
+import json
+import logging
+import sys
+
+# LOG_FORMAT=json writes one JSON object per line with any extra= fields merged in, anything else is plain text
+STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in STANDARD:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        extra = ' '.join('%s=%s' % (key, value) for key, value in vars(record).items() if key not in STANDARD)
+        return line + ' ' + extra if extra else line
+
+def setup(env):
+    handler = logging.StreamHandler(sys.stderr)
+    if env.get('LOG_FORMAT', 'text') == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(env.get('LOG_LEVEL', 'INFO').upper())
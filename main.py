@@ -1,18 +1,40 @@
-from flask import Flask, redirect, send_file
-from flask_restful import Resource, Api, reqparse
+from flask import Flask, Response, redirect, send_file, request, g
+from flask_restful import Resource, Api, abort
 from flask_swagger_ui import get_swaggerui_blueprint
+from werkzeug.middleware.proxy_fix import ProxyFix
 import uuid
-from datetime import datetime
-from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
-from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
-from cassandra.auth import PlainTextAuthProvider
-import openai
+import base64
+import concurrent.futures
+import binascii
+from datetime import date, datetime, timedelta
 import os
+import logging
+import random
+import time
 from dotenv import load_dotenv, find_dotenv
+import db
+from queries import QueryRegistry
+import cache
+import moderation
+import writebehind
+import metrics
+import logs
+import responses
+import search
+import trending
+import similar
+import content
+import idempotency
+import ratelimit
+import migrations
+from schemas import Schema, Optional, UUID, TEXT, INT, NUMBER, TIMESTAMP, check_ids
 _ = load_dotenv(find_dotenv())
 
-openai.api_key=os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI()
+logs.setup(os.environ)
+log = logging.getLogger(__name__)
+
+# snippet and comment text is moderated in batches off the request thread
+moderator = moderation.from_env(os.environ)
 
 SWAGGER_URL = '/api/docs'
 API_URL = 'http://127.0.0.1:5000/swagger'
@@ -25,21 +47,505 @@ swaggerui_blueprint = get_swaggerui_blueprint(
     },
 )
 
-# scylla cloud connection
-profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc='GCE_US_EAST_1')))
-cluster = Cluster(
-        execution_profiles={EXEC_PROFILE_DEFAULT: profile},
-        contact_points=[
-            "node-0.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud", "node-1.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud", "node-2.gce-us-east-1.c95c0e415ebf6dc3d47d.clusters.scylla.cloud"
-        ],
-        port=9042,
-        auth_provider = PlainTextAuthProvider(username=os.getenv("SCYLLA"), password=os.getenv("SCYLLA_PASSWORD")))
-session = cluster.connect()
+# the session is opened lazily per worker process, see db.py
+queries = QueryRegistry(db.session)
+
+# snippet Content is stored compressed and deduplicated in its own table, see content.py
+content_store = content.from_env(os.environ, queries)
+
+# requests past MAX_INFLIGHT in a process are shed with 503, writes over a user's per-route rate get 429, see ratelimit.py
+rate_limiter = ratelimit.from_env(os.environ)
+# kept answering under load so the shedding can be seen
+UNLIMITED = ('/metrics',)
+
+# a POST sent with an Idempotency-Key runs once, retries get the first response back, see idempotency.py
+idempotency_store = idempotency.from_env(os.environ, queries)
+
+# GET responses for users, snippets, tags and comments are cached, writes invalidate them
+read_cache = cache.from_env(os.environ)
 
-print('Connected to cluster %s' % cluster.metadata.cluster_name)
+# snippets are searchable through an FTS index on this host that follows every write below;
+# python search.py rebuilds it from Scylla
+search_index = search.from_env(os.environ)
+
+# GET /feed/trending is served from snapshots of scores kept up to date by the writes below, see trending.py
+trending_feed = trending.from_env(os.environ, search_index.facets, search_index.titles)
+
+# near-duplicate Content is detected on create and update against fingerprints on this host, see similar.py;
+# python similar.py fingerprints the existing snippets and reports the duplicates among them.
+# DUPLICATE_POLICY=flag lists the near-duplicates in the response, reject answers 409 instead, off skips the check
+similarity_index = similar.from_env(os.environ)
+DUPLICATE_POLICY = os.getenv('DUPLICATE_POLICY', 'flag')
+DUPLICATE_THRESHOLD = float(os.getenv('DUPLICATE_THRESHOLD', 0.85))
+
+# before taking traffic the live schema is compared with migrations.py: SCHEMA_CHECK=fail refuses to start on drift,
+# warn only logs it, off skips the check
+SCHEMA_CHECK = os.getenv('SCHEMA_CHECK', 'fail')
 
 app = Flask(__name__)
 api = Api(app)
+# PROXY_HOPS is how many proxies (load balancer, ingress) in front of the app append to X-Forwarded-For;
+# the client address is read that many entries from the end, so what a client puts there itself doesn't
+# count. 0 trusts no header and takes the address of the connection
+PROXY_HOPS = int(os.getenv('PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+api.representations['application/json'] = responses.output_json
+
+# a TRACE_SAMPLE_RATE share of requests is traced, and traced requests slower than TRACE_SLOW_MS
+# are logged with the statements they ran (TRACE_SLOW_MS=0 turns tracing off)
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', 0))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1))
+
+def route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    g.parse = 0.0
+    metrics.trace.statements = [] if TRACE_SLOW_MS and random.random() < TRACE_SAMPLE_RATE else None
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.start
+    metrics.request_seconds.observe(elapsed, request.method, route(), response.status_code)
+    statements, metrics.trace.statements = metrics.trace.statements, None
+    if statements is not None and elapsed * 1000 >= TRACE_SLOW_MS:
+        metrics.slow_requests.inc(route())
+        log.warning('Slow request %s %s', request.method, request.path, extra={
+            'route': route(), 'status': response.status_code, 'duration_ms': round(elapsed * 1000, 3),
+            'parse_ms': round(g.parse * 1000, 3), 'statements': statements})
+    return response
+
+def parse(schema):
+    with metrics.Timer(metrics.parse_seconds, route()) as timer:
+        args = schema.parse()
+    g.parse += timer.elapsed
+    return args
+
+@app.before_request
+def validate_ids():
+    # a malformed id in the path is a 400, not a 500 from uuid.UUID in the handler
+    if request.view_args:
+        check_ids(request.view_args)
+
+def callers():
+    # the address a write comes from (the client's behind PROXY_HOPS proxies), and the UserID it names if any;
+    # nothing authenticates the UserID, so the address is always charged too and varying it gets a client nowhere
+    body = request.get_json(silent=True)
+    user = body.get('UserID') if isinstance(body, dict) else None
+    return [request.remote_addr] + (['user:%s' % user] if user else [])
+
+def request_cost():
+    # a bulk write takes a token per item
+    body = request.get_json(silent=True)
+    items = body.get('Items') if isinstance(body, dict) else None
+    return len(items) if isinstance(items, list) and items else 1
+
+# admission runs in two parts around replay_idempotent: the in-flight cap before it, and the tokens after
+# it, so replaying a finished Idempotency-Key POST never costs tokens or gets a 429
+@app.before_request
+def admit():
+    g.admitted = False
+    if request.path in UNLIMITED:
+        return None
+    if not rate_limiter.enter():
+        metrics.rate_limited.inc(route(), 503)
+        return {'message': 'Server is busy, try again shortly'}, 503, {'Retry-After': '1'}
+    g.admitted = True
+    return None
+
+@app.teardown_request
+def release(error=None):
+    if g.pop('admitted', False):
+        rate_limiter.leave()
+
+@app.before_request
+def replay_idempotent():
+    g.idempotency = None
+    key = request.headers.get('Idempotency-Key')
+    if request.method != 'POST' or key is None:
+        return None
+    if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+        return {'message': 'Idempotency-Key must be 1 to %d characters' % idempotency.MAX_KEY_LENGTH}, 400
+    # the caller is the client address, the route is part of the fingerprint
+    key = idempotency.scoped(request.remote_addr, key)
+    fingerprint = idempotency.fingerprint(request.method, request.path, request.get_data())
+    try:
+        found = idempotency_store.begin(key, fingerprint)
+    except idempotency.KeyInUse:
+        metrics.idempotent_requests.inc('in_progress')
+        return {'message': 'A request with this Idempotency-Key is still running'}, 409, {'Retry-After': '1'}
+    except idempotency.KeyMismatch:
+        metrics.idempotent_requests.inc('mismatch')
+        return {'message': 'Idempotency-Key was already used for a different request'}, 422
+    except Exception as e:
+        # without the table the request runs unguarded, ids still come from the key and the request
+        log.warning('Idempotency-Key lookup failed: %s', e)
+        found = idempotency.Claim(key, fingerprint, stored=False)
+    if isinstance(found, idempotency.Claim):
+        metrics.idempotent_requests.inc('claimed')
+        g.idempotency = found
+        return None
+    metrics.idempotent_requests.inc('replayed')
+    status, body = found
+    return Response(body, status, mimetype='application/json', headers={'Idempotent-Replayed': 'true'})
+
+@app.before_request
+def limit_writes():
+    if request.method not in ('POST', 'PUT', 'DELETE') or request.path in UNLIMITED:
+        return None
+    wait = rate_limiter.take(route(), callers(), request_cost())
+    if wait:
+        metrics.rate_limited.inc(route(), 429)
+        return {'message': 'Too many requests, try again in %.1f seconds' % wait}, 429, {'Retry-After': ratelimit.retry_after(wait)}
+    return None
+
+@app.after_request
+def store_idempotent(response):
+    claim = g.get('idempotency')
+    if claim is not None and claim.stored:
+        try:
+            idempotency_store.finish(claim, response.status_code, response.get_data(as_text=True))
+        except Exception as e:
+            log.warning('Could not store the response for Idempotency-Key %s: %s', claim.key, e)
+    return response
+
+def new_id():
+    # the id of something a POST creates
+    claim = g.get('idempotency')
+    return claim.new_id() if claim is not None else uuid.uuid4()
+
+# row -> response body, shared by the Flask resources and the async app in asgi.py;
+# ids and timestamps stay native and are encoded by responses.dumps
+def user_json(user):
+    return {'UserID': user.userid, 'Username': user.username, 'Email': user.email}
+
+# rows written before moderation existed have no status and count as approved
+def snippet_json(snippet):
+    # what's cached: a Preview of the Content, which is read from SnippetContent for the full view,
+    # see snippet_views; rows from before content.py still hold their Content
+    body = {'SnippetID': snippet.snippetid, 'UserID': snippet.userid, 'Title': snippet.title, 'Language': snippet.language, 'CreatedAt': snippet.createdat, 'UpdatedAt': snippet.updatedat, 'ModerationStatus': snippet.moderationstatus or 'approved',
+        'ContentHash': snippet.contenthash, 'ContentSize': snippet.contentsize, 'Preview': snippet.preview}
+    if snippet.contenthash is None and snippet.content is not None:
+        body.update(Content=snippet.content, ContentSize=len(snippet.content.encode()), Preview=content_store.preview(snippet.content))
+    return body
+
+def snippet_views(bodies, view):
+    # view=preview leaves the Content out, full reads it for the bodies that don't hold it
+    if view == 'preview':
+        return [dict((name, value) for name, value in body.items() if name != 'Content') for body in bodies]
+    texts = content_store.texts([body['ContentHash'] for body in bodies if 'Content' not in body and body['ContentHash']])
+    full = []
+    for body in bodies:
+        body = dict((name, value) for name, value in body.items() if name != 'Preview')
+        if 'Content' not in body:
+            body['Content'] = texts.get(body['ContentHash'])
+            if body['Content'] is None:
+                log.warning('Content %s of snippet %s is missing', body['ContentHash'], body['SnippetID'])
+        full.append(body)
+    return full
+
+def snippet_summary_json(snippet):
+    return {'SnippetID': snippet.snippetid, 'UserID': snippet.userid, 'Title': snippet.title, 'Language': snippet.language, 'CreatedAt': snippet.createdat}
+
+def tag_json(tag):
+    return {'TagID': tag.tagid, 'Name': tag.tagname}
+
+def snippettag_json(snippettag):
+    return {'SnippetID': snippettag.snippetid, 'TagID': snippettag.tagid}
+
+def interaction_json(interaction):
+    return {'InteractionID': interaction.interactionid, 'SnippetID': interaction.snippetid, 'UserID': interaction.userid, 'Type': interaction.type, 'CreatedAt': interaction.createdat}
+
+def bounty_json(bounty):
+    return {'BountyID': bounty.bountyid, 'SnippetID': bounty.snippetid, 'UserID': bounty.userid, 'Amount': bounty.amount, 'CreatedAt': bounty.createdat}
+
+def report_json(report):
+    return {'ReportID': report.reportid, 'SnippetID': report.snippetid, 'UserID': report.userid, 'Reason': report.reason, 'CreatedAt': report.createdat}
+
+def comment_json(comment):
+    return {'CommentID': comment.commentid, 'SnippetID': comment.snippetid, 'UserID': comment.userid, 'Content': comment.content, 'CreatedAt': comment.createdat}
+
+def comment_status_json(comment):
+    return dict(comment_json(comment), ModerationStatus=comment.moderationstatus or 'approved')
+
+def quarantined(body):
+    return body is not None and body.get('ModerationStatus') == 'flagged'
+
+def cache_key(kind, id):
+    return '%s:%s' % (kind, uuid.UUID(id))
+
+def load_one(name, params, to_json):
+    row = queries.execute(name, params).one()
+    return to_json(row) if row else None
+
+def arrived(response_future):
+    # a concurrent.futures.Future done when the driver's future is, so several can be waited on at once;
+    # the driver's own result() is then there without waiting
+    done = concurrent.futures.Future()
+    response_future.add_callbacks(callback=lambda _: done.set_result(response_future), errback=lambda _: done.set_result(response_future))
+    return done
+
+DEFAULT_FETCH_SIZE = int(os.getenv('DEFAULT_FETCH_SIZE', 25))
+MAX_FETCH_SIZE = int(os.getenv('MAX_FETCH_SIZE', 100))
+
+def encode_cursor(paging_state):
+    return base64.urlsafe_b64encode(paging_state).decode() if paging_state else None
+
+PAGE_SCHEMA = Schema(location='args', fetch_size=Optional(INT, DEFAULT_FETCH_SIZE), cursor=Optional(TEXT))
+
+def list_page(name, params, to_json, key):
+    # pages through a partition with the driver's paging state, handed to clients as an opaque cursor
+    args = parse(PAGE_SCHEMA)
+
+    paging_state = None
+    if args['cursor']:
+        try:
+            paging_state = base64.urlsafe_b64decode(args['cursor'].encode())
+        except (ValueError, binascii.Error):
+            abort(400, message='Invalid cursor')
+    fetch_size = min(max(args['fetch_size'], 1), MAX_FETCH_SIZE)
+    rows, paging_state = queries.page(name, params, fetch_size, paging_state)
+    return {key: [to_json(row) for row in rows], 'NextCursor': encode_cursor(paging_state)}, 200
+
+MAX_RANGE_DAYS = int(os.getenv('MAX_RANGE_DAYS', 31))
+
+RANGE_SCHEMA = Schema(location='args', since=Optional(TIMESTAMP), until=Optional(TIMESTAMP), fetch_size=Optional(INT, DEFAULT_FETCH_SIZE), cursor=Optional(TEXT))
+
+def range_args(position):
+    # (since, until, day, fetch_size, position) of a ?since=&until= request; position(state) reads where
+    # in the day the cursor left off, None without a cursor
+    args = parse(RANGE_SCHEMA)
+
+    if args['cursor']:
+        try:
+            state = responses.loads(base64.urlsafe_b64decode(args['cursor'].encode()))
+            since, until, day = datetime.fromisoformat(state['Since']), datetime.fromisoformat(state['Until']), date.fromisoformat(state['Day'])
+            where = position(state)
+        except (ValueError, KeyError, TypeError, AttributeError, binascii.Error):
+            abort(400, message='Invalid cursor')
+    else:
+        until = args['until'] or datetime.now()
+        since = args['since'] or until - timedelta(days=1)
+        day, where = until.date(), None
+    if since >= until:
+        abort(400, message='since must be before until')
+    if until - since > timedelta(days=MAX_RANGE_DAYS):
+        abort(400, message='At most %d days per request' % MAX_RANGE_DAYS)
+    return since, until, day, min(max(args['fetch_size'], 1), MAX_FETCH_SIZE), where
+
+def range_cursor(since, until, day, **position):
+    state = dict({'Since': since.isoformat(), 'Until': until.isoformat(), 'Day': day.isoformat()}, **position)
+    return base64.urlsafe_b64encode(responses.dumps(state)).decode()
+
+def range_page(name, params, to_json, key):
+    # pages newest first through the day buckets from until (default now) back to since (default a day
+    # earlier), one partition at a time; the cursor carries the range, the day being read and the
+    # driver's paging state within it
+    since, until, day, fetch_size, paging_state = range_args(lambda state: base64.urlsafe_b64decode(state['Page'].encode()) if state['Page'] else None)
+    items = []
+    while day >= since.date() and len(items) < fetch_size:
+        rows, paging_state = queries.page(name, params + [day, since, until], fetch_size - len(items), paging_state)
+        items.extend(to_json(row) for row in rows)
+        if paging_state is None:
+            day -= timedelta(days=1)
+    cursor = None
+    if day >= since.date():
+        cursor = range_cursor(since, until, day, Page=encode_cursor(paging_state))
+    return {key: items, 'NextCursor': cursor}, 200
+
+def bucketed_range_page(name, buckets, id_of, to_json, key):
+    # range_page over days split into buckets partitions: each day's buckets are read at once and merged
+    # newest first. Paging states can't mark a place part way through a merge, so the cursor holds the
+    # CreatedAt of the last item returned and the ids returned at that instant, and the next page reads
+    # each bucket from that instant on, skipping those ids
+    def position(state):
+        return (datetime.fromisoformat(state['At']), set(state['Seen'])) if state['At'] else None
+
+    since, until, day, fetch_size, where = range_args(position)
+    at, seen = where or (None, set())
+    items = []
+    while day >= since.date() and len(items) < fetch_size:
+        want = fetch_size - len(items)
+        # timestamps have whole milliseconds, so a millisecond past at includes it
+        upper = at + timedelta(milliseconds=1) if at else until
+        # each bucket can hold up to len(seen) rows already returned ahead of the ones wanted
+        limit = want + len(seen)
+        futures = [queries.execute_async(name, [day, bucket, since, upper], limit) for bucket in range(buckets)]
+        pages = [future.result().current_rows for future in futures]
+        fresh = sorted((row for rows in pages for row in rows if not (row.createdat == at and str(id_of(row)) in seen)),
+            key=lambda row: row.createdat, reverse=True)
+        taken = fresh[:want]
+        items.extend(to_json(row) for row in taken)
+        if taken:
+            last = taken[-1].createdat
+            seen = (seen if last == at else set()) | set(str(id_of(row)) for row in taken if row.createdat == last)
+            at = last
+        if len(fresh) <= want and all(len(rows) < limit for rows in pages):
+            day, at, seen = day - timedelta(days=1), None, set()
+    cursor = None
+    if day >= since.date():
+        cursor = range_cursor(since, until, day, At=at.isoformat() if at else None, Seen=sorted(seen))
+    return {key: items, 'NextCursor': cursor}, 200
+
+MAX_BULK_ITEMS = int(os.getenv('MAX_BULK_ITEMS', 500))
+BULK_CONCURRENCY = int(os.getenv('BULK_CONCURRENCY', 50))
+
+def bulk_items(schema):
+    # validates each item of {"Items": [...]} on its own so one bad item doesn't fail the rest;
+    # returns the valid (index, args) pairs and a results list already holding the rejected items
+    start = time.perf_counter()
+    body = request.get_json(silent=True)
+    items = body.get('Items') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        abort(400, message='Items must be a non-empty list')
+    if len(items) > MAX_BULK_ITEMS:
+        abort(400, message='At most %d items per request' % MAX_BULK_ITEMS)
+
+    valid, results = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'Index': index, 'Status': 400, 'message': 'Item must be an object'})
+            continue
+        args, errors = schema.validate(item)
+        if errors:
+            results.append({'Index': index, 'Status': 400, 'message': errors})
+            continue
+        valid.append((index, args))
+        results.append(None)
+    g.parse += time.perf_counter() - start
+    metrics.parse_seconds.observe(time.perf_counter() - start, route())
+    return valid, results
+
+def bulk_response(valid, results, errors, created):
+    # errors maps positions in valid to the write error; created(args) gives the ids to echo back
+    for position, (index, args) in enumerate(valid):
+        if position in errors:
+            results[index] = {'Index': index, 'Status': 500, 'message': errors[position]}
+        else:
+            results[index] = dict({'Index': index, 'Status': 201}, **created(args))
+    status = 201 if all(result['Status'] == 201 for result in results) else 207
+    return {'Results': results}, status
+
+def bulk_get(ids, kind, name, to_json, key):
+    # ?ids=a,b,c: cached rows are served from the cache, the rest are read concurrently one key each
+    ids = list(dict.fromkeys(i.strip() for i in ids.split(',') if i.strip()))
+    if len(ids) > MAX_BULK_ITEMS:
+        abort(400, message='At most %d ids per request' % MAX_BULK_ITEMS)
+    try:
+        keys = [uuid.UUID(i) for i in ids]
+    except ValueError:
+        abort(400, message='ids must be comma separated UUIDs')
+
+    found, misses = {}, []
+    for key_id in keys:
+        body = read_cache.lookup(cache_key(kind, str(key_id)))
+        if body is None:
+            misses.append(key_id)
+        else:
+            found[key_id] = body
+    results = queries.execute_concurrent(name, [[key_id] for key_id in misses], BULK_CONCURRENCY)
+    for key_id, (success, result) in zip(misses, results):
+        if not success:
+            raise result
+        row = result.one()
+        if row:
+            found[key_id] = to_json(row)
+            read_cache.fill(cache_key(kind, str(key_id)), found[key_id])
+    found = dict((k, body) for k, body in found.items() if not quarantined(body))
+    return {key: [found[k] for k in keys if k in found], 'Missing': [str(k) for k in keys if k not in found]}, 200
+
+def moderate(kind, id, text, record):
+    # the write has already gone out as pending; record(flagged) runs on a moderation worker once the verdict arrives
+    def done(future):
+        try:
+            flagged = future.result()
+        except Exception as e:
+            log.warning('Moderation failed for %s %s, left pending: %s', kind, id, e)
+            return
+        try:
+            record(flagged)
+        except Exception as e:
+            log.warning('Could not record moderation verdict for %s %s: %s', kind, id, e)
+    ContentFilter.check_async(text).add_done_callback(done)
+
+def record_snippet_verdict(snippet_id, user_id, created_at, args, content_hash):
+    def record(flagged):
+        # only if the row still holds the Title and Content that were judged: a verdict arriving after a
+        # later PUT's (or after the snippet was deleted) is dropped, along with the index updates below.
+        # UpdatedAt moves with the status, it is what Last-Modified comes from
+        applied = queries.execute('set_snippet_status', ('flagged' if flagged else 'approved', datetime.now(), snippet_id, content_hash, args['Title'])).was_applied
+        if applied and flagged and created_at:
+            # quarantined: taken out of the author's listing, GET answers 403
+            queries.execute('delete_snippet_by_user', (user_id, created_at, snippet_id))
+        read_cache.invalidate(cache_key('snippets', str(snippet_id)))
+        if applied and flagged:
+            update_index(search_index.hide, snippet_id)
+            update_index(trending_feed.remove, snippet_id)
+        elif applied:
+            update_index(search_index.index, snippet_id, args['Title'], args['Content'], args['Language'])
+    return record
+
+def update_index(change, *params):
+    # the search index and trending feed trail Scylla rather than failing the write
+    try:
+        change(*params)
+    except Exception as e:
+        log.warning('Search index update failed: %s', e)
+
+def near_duplicates(fingerprint, exclude=None):
+    # ids of indexed snippets with about the same Content; an index that can't be read lets the write through
+    if fingerprint is None or DUPLICATE_POLICY == 'off':
+        return []
+    try:
+        return [snippet_id for snippet_id, _ in similarity_index.matches(fingerprint, DUPLICATE_THRESHOLD, exclude)]
+    except Exception as e:
+        log.warning('Similarity index lookup failed: %s', e)
+        return []
+
+def tag_name(tag_id):
+    tag = read_cache.get(cache_key('tags', str(tag_id)), lambda: load_one('select_tag', [uuid.UUID(str(tag_id))], tag_json))
+    return tag['Name'] if tag else None
+
+def record_comment_verdict(comment_id, snippet_id, created_at):
+    def record(flagged):
+        applied = queries.execute('set_comment_status', ('flagged' if flagged else 'approved', comment_id)).was_applied
+        if applied and flagged:
+            queries.execute('delete_comment_by_snippet', (snippet_id, created_at, comment_id))
+        read_cache.invalidate(cache_key('comments', str(comment_id)))
+        if applied and not flagged:
+            update_index(trending_feed.record, snippet_id, 'comment', 1, created_at.timestamp())
+    return record
+
+def resubmit_pending():
+    # snippets and comments still pending a sweep interval after they were written lost their verdict to
+    # a failed moderation call or a restart; they are sent to moderation again. A verdict that comes in
+    # twice is harmless, the status updates are conditional and the verdicts cached
+    cutoff = datetime.now() - timedelta(seconds=MODERATION_SWEEP_S)
+    resubmitted = 0
+    for row, text in content_store.scan(name='scan_snippet_moderation'):
+        if row.moderationstatus != 'pending' or text is None or (row.updatedat or row.createdat or cutoff) >= cutoff:
+            continue
+        args = {'Title': row.title or '', 'Content': text, 'Language': row.language}
+        moderate('Snippet', row.snippetid, args['Title'] + '\n' + text, record_snippet_verdict(row.snippetid, row.userid, row.createdat, args, row.contenthash))
+        resubmitted += 1
+    for row in queries.execute('scan_comment_moderation'):
+        if row.moderationstatus != 'pending' or row.content is None or (row.createdat or cutoff) >= cutoff:
+            continue
+        moderate('Comment', row.commentid, row.content, record_comment_verdict(row.commentid, row.snippetid, row.createdat))
+        resubmitted += 1
+    if resubmitted:
+        log.info('Sent %d pending snippets and comments to moderation again', resubmitted)
+
+# every MODERATION_SWEEP_S seconds (0 to turn it off) each worker looks for rows left pending, see above
+MODERATION_SWEEP_S = float(os.getenv('MODERATION_SWEEP_S', 600))
+pending_sweeper = moderation.Sweeper(resubmit_pending, MODERATION_SWEEP_S)
+
+@app.before_request
+def start_sweeper():
+    pending_sweeper.start()
 
 class Swagger(Resource):
     def get(self):
@@ -47,275 +553,686 @@ class Swagger(Resource):
         
 
 class UserResource(Resource):
+    schema = Schema(Username=TEXT, Email=TEXT, PasswordHash=TEXT)
+
     def get(self, user_id):
-        cql = "SELECT * FROM Devspace.Users WHERE UserID=%s"
-        user = session.execute(cql, [uuid.UUID(user_id)]).one()
+        user = read_cache.get(cache_key('users', user_id), lambda: load_one('select_user', [uuid.UUID(user_id)], user_json))
         if user:
-            return {'UserID': str(user.userid), 'Username': user.username, 'Email': user.email}, 200
+            return user, 200
         else:
             return {'message': 'User not found'}, 404
 
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('Username', required=True)
-        parser.add_argument('Email', required=True)
-        parser.add_argument('PasswordHash', required=True)
-        args = parser.parse_args()
-        print(args)
-
-        user_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Users (UserID, Username, Email, PasswordHash) VALUES (%s, %s, %s, %s)"
-        session.execute(cql, (user_id, args['Username'], args['Email'], args['PasswordHash']))
+        args = parse(self.schema)
+
+        user_id = new_id()
+        queries.execute('insert_user', (user_id, args['Username'], args['Email'], args['PasswordHash']))
         return {'message': 'User created successfully', 'UserID': str(user_id)}, 201
 
     def put(self, user_id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('Username', required=True)
-        parser.add_argument('Email', required=True)
-        parser.add_argument('PasswordHash', required=True)
-        args = parser.parse_args()
-
-        cql = "UPDATE Devspace.Users SET Username=%s, Email=%s, PasswordHash=%s WHERE UserID=%s"
-        session.execute(cql, (args['Username'], args['Email'], args['PasswordHash'], uuid.UUID(user_id)))
+        args = parse(self.schema)
+
+        queries.execute('update_user', (args['Username'], args['Email'], args['PasswordHash'], uuid.UUID(user_id)))
+        read_cache.invalidate(cache_key('users', user_id))
         return {'message': 'User updated successfully'}, 200
 
     def delete(self, user_id):
-        cql = "DELETE FROM Devspace.Users WHERE UserID=%s"
-        session.execute(cql, [uuid.UUID(user_id)])
+        queries.execute('delete_user', [uuid.UUID(user_id)])
+        read_cache.invalidate(cache_key('users', user_id))
         return {'message': 'User deleted successfully'}, 200
 
+VIEWS = ('full', 'preview')
+
 class SnippetResource(Resource):
-    def get(self, snippet_id):
-        cql = "SELECT * FROM Devspace.Snippets WHERE SnippetID=%s"
-        print(snippet_id)
-        snippet = session.execute(cql, [uuid.UUID(snippet_id)]).one()
-        if snippet:
-            return {'SnippetID': str(snippet.snippetid), 'UserID': str(snippet.userid), 'Title': snippet.title, 'Content': snippet.content, 'Language': snippet.language, 'CreatedAt': str(snippet.createdat), 'UpdatedAt': str(snippet.updatedat)}, 200
-        else:
+    schema = Schema(UserID=UUID, Title=TEXT, Content=TEXT, Language=TEXT)
+    view_schema = Schema(location='args', view=Optional(TEXT, 'full'))
+    list_schema = Schema(location='args', user=Optional(UUID), ids=Optional(TEXT), view=Optional(TEXT, 'full'))
+
+    def get(self, snippet_id=None):
+        if snippet_id is None:
+            return self.list()
+        args = parse(self.view_schema)
+
+        if args['view'] not in VIEWS:
+            abort(400, message='view must be one of %s' % ', '.join(VIEWS))
+        snippet = read_cache.get(cache_key('snippets', snippet_id), lambda: load_one('select_snippet', [uuid.UUID(snippet_id)], snippet_json))
+        if quarantined(snippet):
+            return {'message': 'Snippet is quarantined by moderation'}, 403
+        if not snippet:
             return {'message': 'Snippet not found'}, 404
+        headers = responses.snippet_validators(snippet, args['view'])
+        if responses.request_not_modified(headers):
+            return None, 304, headers
+        return snippet_views([snippet], args['view'])[0], 200, headers
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Title', required=True)
-        parser.add_argument('Content', required=True)
-        parser.add_argument('Language', required=True)
-        args = parser.parse_args()
-
-        snippet_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Snippets (SnippetID, UserID, Title, Content, Language, CreatedAt, UpdatedAt) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-        session.execute(cql, (snippet_id, uuid.UUID(args['UserID']), args['Title'], args['Content'], args['Language'], datetime.now(), datetime.now()))
-        return {'message': 'Snippet created successfully', 'SnippetID': str(snippet_id)}, 201
+        args = parse(self.schema)
+
+        # a retry under the same Idempotency-Key gets the same id, and isn't its own duplicate
+        snippet_id = new_id()
+        fingerprint = similar.signature(args['Content'])
+        duplicates = near_duplicates(fingerprint, str(snippet_id))
+        if duplicates and DUPLICATE_POLICY == 'reject':
+            return {'message': 'Snippet is a near-duplicate of an existing one', 'NearDuplicates': duplicates}, 409
+        user_id = args['UserID']
+        now = datetime.now()
+        # the content goes first, so no row ever points at content that isn't there
+        stored = content_store.pack(args['Content'])
+        content_store.write(stored)
+        queries.batch([
+            ('insert_snippet', (snippet_id, user_id, args['Title'], stored.hash, stored.size, stored.preview, args['Language'], now, now, 'pending')),
+            ('insert_snippet_by_user', (user_id, now, snippet_id, args['Title'], args['Language'])),
+        ])
+        moderate('Snippet', snippet_id, args['Title'] + '\n' + args['Content'], record_snippet_verdict(snippet_id, user_id, now, args, stored.hash))
+        if fingerprint is not None:
+            update_index(similarity_index.add, snippet_id, fingerprint)
+        body = {'message': 'Snippet created successfully', 'SnippetID': str(snippet_id)}
+        if duplicates:
+            body['NearDuplicates'] = duplicates
+        return body, 201
     
     def put(self, snippet_id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Title', required=True)
-        parser.add_argument('Content', required=True)
-        parser.add_argument('Language', required=True)
-        args = parser.parse_args()
-
-        cql = "UPDATE Devspace.Snippets SET UserID=%s, Title=%s, Content=%s, Language=%s, UpdatedAt=%s WHERE SnippetID=%s"
-        session.execute(cql, (uuid.UUID(args['UserID']), args['Title'], args['Content'], args['Language'], datetime.now(), uuid.UUID(snippet_id)))
-        return {'message': 'Snippet updated successfully'}, 200
+        args = parse(self.schema)
+
+        fingerprint = similar.signature(args['Content'])
+        duplicates = near_duplicates(fingerprint, snippet_id)
+        if duplicates and DUPLICATE_POLICY == 'reject':
+            return {'message': 'Snippet is a near-duplicate of an existing one', 'NearDuplicates': duplicates}, 409
+        user_id = args['UserID']
+        snippet = queries.execute('select_snippet', [uuid.UUID(snippet_id)]).one()
+        stored = content_store.pack(args['Content'])
+        content_store.write(stored)
+        statements = [('update_snippet', (user_id, args['Title'], stored.hash, stored.size, stored.preview, args['Language'], datetime.now(), 'pending', uuid.UUID(snippet_id)))]
+        if snippet and snippet.createdat:
+            if snippet.userid != user_id:
+                statements.append(('delete_snippet_by_user', (snippet.userid, snippet.createdat, snippet.snippetid)))
+            statements.append(('insert_snippet_by_user', (user_id, snippet.createdat, snippet.snippetid, args['Title'], args['Language'])))
+        queries.batch(statements)
+        read_cache.invalidate(cache_key('snippets', snippet_id))
+        created_at = snippet.createdat if snippet else None
+        moderate('Snippet', snippet_id, args['Title'] + '\n' + args['Content'], record_snippet_verdict(uuid.UUID(snippet_id), user_id, created_at, args, stored.hash))
+        if fingerprint is not None:
+            update_index(similarity_index.add, snippet_id, fingerprint)
+        else:
+            update_index(similarity_index.remove, snippet_id)
+        body = {'message': 'Snippet updated successfully'}
+        if duplicates:
+            body['NearDuplicates'] = duplicates
+        return body, 200
     
     def delete(self, snippet_id):
-        cql = "DELETE FROM Devspace.Snippets WHERE SnippetID=%s"
-        session.execute(cql, [uuid.UUID(snippet_id)])
+        snippet = queries.execute('select_snippet', [uuid.UUID(snippet_id)]).one()
+        statements = [('delete_snippet', [uuid.UUID(snippet_id)])]
+        if snippet and snippet.createdat:
+            statements.append(('delete_snippet_by_user', (snippet.userid, snippet.createdat, snippet.snippetid)))
+        queries.batch(statements)
+        read_cache.invalidate(cache_key('snippets', snippet_id))
+        update_index(search_index.remove, snippet_id)
+        update_index(similarity_index.remove, snippet_id)
+        update_index(trending_feed.remove, snippet_id)
         return {'message': 'Snippet deleted successfully'}, 200
+
+    def list(self):
+        args = parse(self.list_schema)
+
+        if args['view'] not in VIEWS:
+            abort(400, message='view must be one of %s' % ', '.join(VIEWS))
+        if args['ids']:
+            body, status = bulk_get(args['ids'], 'snippets', 'select_snippet', snippet_json, 'Snippets')
+            body['Snippets'] = snippet_views(body['Snippets'], args['view'])
+            return body, status
+        if args['user']:
+            return list_page('list_snippets_by_user', [args['user']], snippet_summary_json, 'Snippets')
+        abort(400, message='Pass either user or ids')
+
+class SnippetBulkResource(Resource):
+    def post(self):
+        valid, results = bulk_items(SnippetResource.schema)
+
+        now = datetime.now()
+        stored = [content_store.pack(args['Content']) for _, args in valid]
+        # contents first, then the rows of the items whose content was written
+        errors = queries.bulk([[(packed.hash, 'insert_snippet_content', content_store.params(packed))] for packed in stored], BULK_CONCURRENCY)
+        writes = []
+        for position, (_, args) in enumerate(valid):
+            args['SnippetID'] = new_id()
+            packed = stored[position]
+            writes.append([] if position in errors else [
+                (args['SnippetID'], 'insert_snippet', (args['SnippetID'], args['UserID'], args['Title'], packed.hash, packed.size, packed.preview, args['Language'], now, now, 'pending')),
+                (args['UserID'], 'insert_snippet_by_user', (args['UserID'], now, args['SnippetID'], args['Title'], args['Language'])),
+            ])
+        errors.update(queries.bulk(writes, BULK_CONCURRENCY))
+        for position, (_, args) in enumerate(valid):
+            if position not in errors:
+                moderate('Snippet', args['SnippetID'], args['Title'] + '\n' + args['Content'], record_snippet_verdict(args['SnippetID'], args['UserID'], now, args, stored[position].hash))
+                fingerprint = similar.signature(args['Content'])
+                if fingerprint is not None:
+                    update_index(similarity_index.add, args['SnippetID'], fingerprint)
+        return bulk_response(valid, results, errors, lambda args: {'SnippetID': str(args['SnippetID'])})
     
 class TagResource(Resource):
-    def get(self, tag_id):
-        cql = "SELECT * FROM Devspace.Tags WHERE TagID=%s"
-        tag = session.execute(cql, [uuid.UUID(tag_id)]).one()
+    schema = Schema(Name=TEXT)
+    ids_schema = Schema(location='args', ids=TEXT)
+
+    def get(self, tag_id=None):
+        if tag_id is None:
+            args = parse(self.ids_schema)
+            return bulk_get(args['ids'], 'tags', 'select_tag', tag_json, 'Tags')
+        tag = read_cache.get(cache_key('tags', tag_id), lambda: load_one('select_tag', [uuid.UUID(tag_id)], tag_json))
         if tag:
-            return {'TagID': str(tag.tagid), 'Name': tag.tagname}, 200
+            return tag, 200
         else:
             return {'message': 'Tag not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('Name', required=True)
-        args = parser.parse_args()
+        args = parse(self.schema)
 
-        tag_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Tags (TagID, TagName) VALUES (%s, %s)"
-        session.execute(cql, (tag_id, args['Name']))
+        tag_id = new_id()
+        queries.execute('insert_tag', (tag_id, args['Name']))
         return {'message': 'Tag created successfully', 'TagID': str(tag_id)}, 201
     
     def put(self, tag_id):
-        parser = reqparse.RequestParser()
-        parser.add_argument('Name', required=True)
-        args = parser.parse_args()
+        args = parse(self.schema)
 
-        cql = "UPDATE Devspace.Tags SET TagName=%s WHERE TagID=%s"
-        session.execute(cql, (args['Name'], uuid.UUID(tag_id)))
+        old = tag_name(tag_id)
+        queries.execute('update_tag', (args['Name'], uuid.UUID(tag_id)))
+        read_cache.invalidate(cache_key('tags', tag_id))
+        if old and old != args['Name']:
+            update_index(search_index.rename_tag, old, args['Name'])
         return {'message': 'Tag updated successfully'}, 200
     
     def delete(self, tag_id):
-        cql = "DELETE FROM Devspace.Tags WHERE TagID=%s"
-        session.execute(cql, [uuid.UUID(tag_id)])
+        old = tag_name(tag_id)
+        queries.execute('delete_tag', [uuid.UUID(tag_id)])
+        read_cache.invalidate(cache_key('tags', tag_id))
+        if old:
+            update_index(search_index.rename_tag, old, None)
         return {'message': 'Tag deleted successfully'}, 200
     
+class TagBulkResource(Resource):
+    def post(self):
+        valid, results = bulk_items(TagResource.schema)
+
+        writes = []
+        for _, args in valid:
+            args['TagID'] = new_id()
+            writes.append([(args['TagID'], 'insert_tag', (args['TagID'], args['Name']))])
+        errors = queries.bulk(writes, BULK_CONCURRENCY)
+        return bulk_response(valid, results, errors, lambda args: {'TagID': str(args['TagID'])})
+
 class SnippetTagResource(Resource):
+    schema = Schema(SnippetID=UUID, TagID=UUID)
+
     def get(self, snippet_id, tag_id):
-        cql = "SELECT * FROM Devspace.SnippetTags WHERE SnippetID=%s AND TagID=%s"
-        snippettags = session.execute(cql, [uuid.UUID(snippet_id), uuid.UUID(tag_id)]).one()
+        snippettags = queries.execute('select_snippettag', [uuid.UUID(snippet_id), uuid.UUID(tag_id)]).one()
         if snippettags:
-            return {'SnippetID': str(snippettags.snippetid), 'TagID': str(snippettags.tagid)}, 200
+            return snippettag_json(snippettags), 200
         else:
             return {'message': 'SnippetTag not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('TagID', required=True)
-        args = parser.parse_args()
+        args = parse(self.schema)
 
-        cql = "INSERT INTO Devspace.SnippetTags (SnippetID, TagID) VALUES (%s, %s)"
-        session.execute(cql, (uuid.UUID(args['SnippetID']), uuid.UUID(args['TagID'])))
+        snippet_id, tag_id = args['SnippetID'], args['TagID']
+        queries.batch([
+            ('insert_snippettag', (snippet_id, tag_id)),
+            ('insert_snippet_by_tag', (tag_id, snippet_id)),
+        ])
+        name = tag_name(tag_id)
+        if name:
+            update_index(search_index.add_tag, snippet_id, name)
         return {'message': 'SnippetTag created successfully'}, 201
     
     def delete(self, snippet_id, tag_id):
-        cql = "DELETE FROM Devspace.SnippetTags WHERE SnippetID=%s AND TagID=%s"
-        session.execute(cql, [uuid.UUID(snippet_id), uuid.UUID(tag_id)])
+        queries.batch([
+            ('delete_snippettag', [uuid.UUID(snippet_id), uuid.UUID(tag_id)]),
+            ('delete_snippet_by_tag', [uuid.UUID(tag_id), uuid.UUID(snippet_id)]),
+        ])
+        name = tag_name(tag_id)
+        if name:
+            update_index(search_index.remove_tag, snippet_id, name)
         return {'message': 'SnippetTag deleted successfully'}, 200
     
+class SnippetTagBulkResource(Resource):
+    def post(self):
+        valid, results = bulk_items(SnippetTagResource.schema)
+
+        writes = []
+        for _, args in valid:
+            writes.append([
+                (args['SnippetID'], 'insert_snippettag', (args['SnippetID'], args['TagID'])),
+                (args['TagID'], 'insert_snippet_by_tag', (args['TagID'], args['SnippetID'])),
+            ])
+        errors = queries.bulk(writes, BULK_CONCURRENCY)
+        for position, (_, args) in enumerate(valid):
+            name = tag_name(args['TagID']) if position not in errors else None
+            if name:
+                update_index(search_index.add_tag, args['SnippetID'], name)
+        return bulk_response(valid, results, errors, lambda args: {'SnippetID': str(args['SnippetID']), 'TagID': str(args['TagID'])})
+
+def write_interactions(events):
+    # flushes buffered interactions: rows go out as per-partition unlogged batches, then the
+    # counter deltas are summed per (snippet, type) so a burst of likes is one increment
+    writes, deltas = [], {}
+    for event in events:
+        interaction_id, snippet_id, user_id = uuid.UUID(event['InteractionID']), uuid.UUID(event['SnippetID']), uuid.UUID(event['UserID'])
+        created_at = datetime.fromisoformat(event['CreatedAt'])
+        writes.append([
+            (interaction_id, 'insert_interaction', (interaction_id, snippet_id, user_id, event['Type'], created_at)),
+            ((snippet_id, created_at.date()), 'insert_interaction_by_day', (snippet_id, created_at.date(), created_at, interaction_id, user_id, event['Type'])),
+        ])
+        deltas[(snippet_id, event['Type'])] = deltas.get((snippet_id, event['Type']), 0) + 1
+    errors = queries.bulk(writes, BULK_CONCURRENCY)
+    if errors:
+        # the inserts are idempotent, so the whole flush is retried
+        raise Exception('%d of %d interactions failed: %s' % (len(errors), len(events), next(iter(errors.values()))))
+    # counters are not idempotent: a failed increment is logged rather than retried
+    results = queries.execute_concurrent('increment_snippet_stat', [(delta, snippet_id, kind) for (snippet_id, kind), delta in deltas.items()], BULK_CONCURRENCY)
+    for success, result in results:
+        if not success:
+            log.warning('Could not update snippet stats: %s', result)
+
+# optional write-behind mode for interactions, see writebehind.py
+interaction_buffer = writebehind.from_env(os.environ, write_interactions, 'interactions')
+
+metrics.registry.collect('devspace_cache', read_cache.stats)
+metrics.registry.collect('devspace_moderation', moderator.stats)
+metrics.registry.collect('devspace_trending', trending_feed.stats)
+metrics.registry.collect('devspace_similarity', similarity_index.stats)
+metrics.registry.collect('devspace_admission', rate_limiter.stats)
+metrics.registry.collect('devspace_interaction_buffer', lambda: interaction_buffer.stats() if interaction_buffer else None)
+
 class InteractionResource(Resource):
+    schema = Schema(SnippetID=UUID, UserID=UUID, Type=TEXT)
+
     def get(self, interaction_id):
-        cql = "SELECT * FROM Devspace.Interactions WHERE InteractionID=%s"
-        interaction = session.execute(cql, [uuid.UUID(interaction_id)]).one()
+        interaction = queries.execute('select_interaction', [uuid.UUID(interaction_id)]).one()
         if interaction:
-            return {'InteractionID': str(interaction.interactionid), 'SnippetID': str(interaction.snippetid), 'UserID': str(interaction.userid), 'Type': interaction.type, 'CreatedAt': str(interaction.createdat)}, 200
+            return interaction_json(interaction), 200
         else:
             return {'message': 'Interaction not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Type', required=True)
-        args = parser.parse_args()
-
-        interaction_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Interactions (InteractionID, SnippetID, UserID, Type, CreatedAt) VALUES (%s, %s, %s, %s, %s)"
-        session.execute(cql, (interaction_id, uuid.UUID(args['SnippetID']), uuid.UUID(args['UserID']), args['Type'], datetime.now()))
+        args = parse(self.schema)
+
+        interaction_id = new_id()
+        snippet_id, user_id = args['SnippetID'], args['UserID']
+        now = datetime.now()
+        if interaction_buffer is not None:
+            event = {'InteractionID': str(interaction_id), 'SnippetID': str(snippet_id), 'UserID': str(user_id), 'Type': args['Type'], 'CreatedAt': now.isoformat()}
+            try:
+                interaction_buffer.add(event)
+            except writebehind.BufferFull:
+                return {'message': 'Interaction buffer is full, try again later'}, 503
+            update_index(trending_feed.record, snippet_id, args['Type'])
+            return {'message': 'Interaction accepted', 'InteractionID': str(interaction_id)}, 202
+        queries.batch([
+            ('insert_interaction', (interaction_id, snippet_id, user_id, args['Type'], now)),
+            ('insert_interaction_by_day', (snippet_id, now.date(), now, interaction_id, user_id, args['Type'])),
+        ])
+        # counters can't share a batch with regular writes
+        queries.execute('increment_snippet_stat', (1, snippet_id, args['Type']))
+        update_index(trending_feed.record, snippet_id, args['Type'])
         return {'message': 'Interaction created successfully', 'InteractionID': str(interaction_id)}, 201
     
     def delete(self, interaction_id):
-        cql = "DELETE FROM Devspace.Interactions WHERE InteractionID=%s"
-        session.execute(cql, [uuid.UUID(interaction_id)])
+        if interaction_buffer is not None:
+            interaction_buffer.discard('InteractionID', str(uuid.UUID(interaction_id)))
+        interaction = queries.execute('select_interaction', [uuid.UUID(interaction_id)]).one()
+        statements = [('delete_interaction', [uuid.UUID(interaction_id)])]
+        if interaction and interaction.createdat:
+            statements.append(('delete_interaction_by_day', (interaction.snippetid, interaction.createdat.date(), interaction.createdat, interaction.interactionid)))
+        queries.batch(statements)
+        if interaction:
+            queries.execute('increment_snippet_stat', (-1, interaction.snippetid, interaction.type))
+            if interaction.createdat:
+                update_index(trending_feed.record, interaction.snippetid, interaction.type, -1, interaction.createdat.timestamp())
         return {'message': 'Interaction deleted successfully'}, 200
     
 class SnippetBountyResource(Resource):
+    schema = Schema(SnippetID=UUID, UserID=UUID, Amount=INT)
+
     def get(self, bounty_id):
-        cql = "SELECT * FROM Devspace.SnippetBounties WHERE BountyID=%s"
-        bounty = session.execute(cql, [uuid.UUID(bounty_id)]).one()
+        bounty = queries.execute('select_snippetbounty', [uuid.UUID(bounty_id)]).one()
         if bounty:
-            return {'BountyID': str(bounty.bountyid), 'SnippetID': str(bounty.snippetid), 'UserID': str(bounty.userid), 'Amount': bounty.amount, 'CreatedAt': bounty.createdat}, 200
+            return bounty_json(bounty), 200
         else:
             return {'message': 'Bounty not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Amount', required=True)
-        args = parser.parse_args()
-
-        bounty_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.SnippetBounties (BountyID, SnippetID, UserID, Amount, CreatedAt) VALUES (%s, %s, %s, %s, %s)"
-        session.execute(cql, (bounty_id, uuid.UUID(args['SnippetID']), uuid.UUID(args['UserID']), args['Amount'], datetime.now()))
+        args = parse(self.schema)
+
+        bounty_id = new_id()
+        now = datetime.now()
+        queries.batch([
+            ('insert_snippetbounty', (bounty_id, args['SnippetID'], args['UserID'], args['Amount'], now)),
+            ('insert_bounty_by_snippet', (args['SnippetID'], now, bounty_id, args['UserID'], args['Amount'])),
+        ])
+        update_index(trending_feed.record, args['SnippetID'], 'bounty', trending.bounty_amount(args['Amount']))
         return {'message': 'Bounty created successfully', 'BountyID': str(bounty_id)}, 201
     
     def delete(self, bounty_id):
-        cql = "DELETE FROM Devspace.SnippetBounties WHERE BountyID=%s"
-        session.execute(cql, [uuid.UUID(bounty_id)])
+        bounty = queries.execute('select_snippetbounty', [uuid.UUID(bounty_id)]).one()
+        statements = [('delete_snippetbounty', [uuid.UUID(bounty_id)])]
+        if bounty and bounty.snippetid and bounty.createdat:
+            statements.append(('delete_bounty_by_snippet', (bounty.snippetid, bounty.createdat, bounty.bountyid)))
+        queries.batch(statements)
+        if bounty and bounty.createdat:
+            update_index(trending_feed.record, bounty.snippetid, 'bounty', -trending.bounty_amount(bounty.amount), bounty.createdat.timestamp())
         return {'message': 'Bounty deleted successfully'}, 200
     
 class BugBountyResource(Resource):
+    schema = Schema(SnippetID=UUID, UserID=UUID, Amount=INT)
+
     def get(self, bounty_id):
-        cql = "SELECT * FROM Devspace.BugBounties WHERE BountyID=%s"
-        bounty = session.execute(cql, [uuid.UUID(bounty_id)]).one()
+        bounty = queries.execute('select_bugbounty', [uuid.UUID(bounty_id)]).one()
         if bounty:
-            return {'BountyID': str(bounty.bountyid), 'SnippetID': str(bounty.snippetid), 'UserID': str(bounty.userid), 'Amount': bounty.amount, 'CreatedAt': bounty.createdat}, 200
+            return bounty_json(bounty), 200
         else:
             return {'message': 'Bounty not found'}, 404
         
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Amount', required=True)
-        args = parser.parse_args()
-
-        bounty_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.BugBounties (BountyID, SnippetID, UserID, Amount, CreatedAt) VALUES (%s, %s, %s, %s, %s)"
-        session.execute(cql, (bounty_id, uuid.UUID(args['SnippetID']), uuid.UUID(args['UserID']), args['Amount'], datetime.now()))
+        args = parse(self.schema)
+
+        bounty_id = new_id()
+        queries.execute('insert_bugbounty', (bounty_id, args['SnippetID'], args['UserID'], args['Amount'], datetime.now()))
         return {'message': 'Bounty created successfully', 'BountyID': str(bounty_id)}, 201
 
     def delete(self, bounty_id):
-        cql = "DELETE FROM Devspace.BugBounties WHERE BountyID=%s"
-        session.execute(cql, [uuid.UUID(bounty_id)])
+        queries.execute('delete_bugbounty', [uuid.UUID(bounty_id)])
         return {'message': 'Bounty deleted successfully'}, 200
     
 class ReportResource(Resource):
-    def get(self, report_id):
-        cql = "SELECT * FROM Devspace.Reports WHERE ReportID=%s"
-        report = session.execute(cql, [uuid.UUID(report_id)]).one()
+    schema = Schema(SnippetID=UUID, UserID=UUID, Reason=TEXT)
+
+    def get(self, report_id=None):
+        if report_id is None:
+            # GET /reports?since=&until= lists reports by time, newest first
+            return bucketed_range_page('list_reports_by_day', migrations.REPORT_BUCKETS, lambda row: row.reportid, report_json, 'Reports')
+        report = queries.execute('select_report', [uuid.UUID(report_id)]).one()
         if report:
-            return {'ReportID': str(report.reportid), 'SnippetID': str(report.snippetid), 'UserID': str(report.userid), 'Reason': report.reason, 'CreatedAt': report.createdat}, 200
+            return report_json(report), 200
         else:
             return {'message': 'Report not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Reason', required=True)
-        args = parser.parse_args()
-
-        report_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Reports (ReportID, SnippetID, UserID, Reason, CreatedAt) VALUES (%s, %s, %s, %s, %s)"
-        session.execute(cql, (report_id, uuid.UUID(args['SnippetID']), uuid.UUID(args['UserID']), args['Reason'], datetime.now()))
+        args = parse(self.schema)
+
+        report_id = new_id()
+        now = datetime.now()
+        queries.batch([
+            ('insert_report', (report_id, args['SnippetID'], args['UserID'], args['Reason'], now)),
+            ('insert_report_by_day', (now.date(), migrations.report_bucket(report_id), now, report_id, args['SnippetID'], args['UserID'], args['Reason'])),
+        ])
         return {'message': 'Report created successfully', 'ReportID': str(report_id)}, 201
     
     def delete(self, report_id):
-        cql = "DELETE FROM Devspace.Reports WHERE ReportID=%s"
-        session.execute(cql, [uuid.UUID(report_id)])
+        report = queries.execute('select_report', [uuid.UUID(report_id)]).one()
+        statements = [('delete_report', [uuid.UUID(report_id)])]
+        if report and report.createdat:
+            statements.append(('delete_report_by_day', (report.createdat.date(), migrations.report_bucket(report.reportid), report.createdat, report.reportid)))
+        queries.batch(statements)
         return {'message': 'Report deleted successfully'}, 200
     
 class CommentResource(Resource):
+    schema = Schema(SnippetID=UUID, UserID=UUID, Content=TEXT)
+
     def get(self, comment_id):
-        cql = "SELECT * FROM Devspace.Comments WHERE CommentID=%s"
-        comment = session.execute(cql, [uuid.UUID(comment_id)]).one()
+        comment = read_cache.get(cache_key('comments', comment_id), lambda: load_one('select_comment', [uuid.UUID(comment_id)], comment_status_json))
+        if quarantined(comment):
+            return {'message': 'Comment is quarantined by moderation'}, 403
         if comment:
-            return {'CommentID': str(comment.commentid), 'SnippetID': str(comment.snippetid), 'UserID': str(comment.userid), 'Content': comment.content, 'CreatedAt': comment.createdat}, 200
+            return comment, 200
         else:
             return {'message': 'Comment not found'}, 404
     
     def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('SnippetID', required=True)
-        parser.add_argument('UserID', required=True)
-        parser.add_argument('Content', required=True)
-        args = parser.parse_args()
-
-        comment_id = uuid.uuid4()
-        cql = "INSERT INTO Devspace.Comments (CommentID, SnippetID, UserID, Content, CreatedAt) VALUES (%s, %s, %s, %s, %s)"
-        session.execute(cql, (comment_id, uuid.UUID(args['SnippetID']), uuid.UUID(args['UserID']), args['Content'], datetime.now()))
+        args = parse(self.schema)
+
+        comment_id = new_id()
+        snippet_id, user_id = args['SnippetID'], args['UserID']
+        now = datetime.now()
+        queries.batch([
+            ('insert_comment', (comment_id, snippet_id, user_id, args['Content'], now, 'pending')),
+            ('insert_comment_by_snippet', (snippet_id, now, comment_id, user_id, args['Content'])),
+        ])
+        moderate('Comment', comment_id, args['Content'], record_comment_verdict(comment_id, snippet_id, now))
         return {'message': 'Comment created successfully', 'CommentID': str(comment_id)}, 201
     
     def delete(self, comment_id):
-        cql = "DELETE FROM Devspace.Comments WHERE CommentID=%s"
-        session.execute(cql, [uuid.UUID(comment_id)])
+        comment = queries.execute('select_comment', [uuid.UUID(comment_id)]).one()
+        statements = [('delete_comment', [uuid.UUID(comment_id)])]
+        if comment and comment.createdat:
+            statements.append(('delete_comment_by_snippet', (comment.snippetid, comment.createdat, comment.commentid)))
+        queries.batch(statements)
+        read_cache.invalidate(cache_key('comments', comment_id))
+        if comment and comment.createdat and (comment.moderationstatus or 'approved') == 'approved':
+            update_index(trending_feed.record, comment.snippetid, 'comment', -1, comment.createdat.timestamp())
         return {'message': 'Comment deleted successfully'}, 200
 
+# list endpoints, each pages through a single partition of a lookup table
+class UserSnippetListResource(Resource):
+    def get(self, user_id):
+        return list_page('list_snippets_by_user', [uuid.UUID(user_id)], snippet_summary_json, 'Snippets')
+
+class SnippetCommentListResource(Resource):
+    def get(self, snippet_id):
+        return list_page('list_comments_by_snippet', [uuid.UUID(snippet_id)], comment_json, 'Comments')
+
+class SnippetTagListResource(Resource):
+    def get(self, snippet_id):
+        return list_page('list_snippettags', [uuid.UUID(snippet_id)], snippettag_json, 'SnippetTags')
+
+class SnippetBountyListResource(Resource):
+    def get(self, snippet_id):
+        return list_page('list_bounties_by_snippet', [uuid.UUID(snippet_id)], bounty_json, 'Bounties')
+
+class SnippetInteractionListResource(Resource):
+    # ?since=&until= instead of one partition, see range_page
+    def get(self, snippet_id):
+        return range_page('list_interactions_by_day', [uuid.UUID(snippet_id)], interaction_json, 'Interactions')
+
+class TagSnippetListResource(Resource):
+    def get(self, tag_id):
+        return list_page('list_snippets_by_tag', [uuid.UUID(tag_id)], snippettag_json, 'SnippetTags')
+
+class ModerationStatusResource(Resource):
+    def get(self, kind, item_id):
+        if kind == 'snippets':
+            row = queries.execute('select_snippet_status', [uuid.UUID(item_id)]).one()
+        elif kind == 'comments':
+            row = queries.execute('select_comment_status', [uuid.UUID(item_id)]).one()
+        else:
+            return {'message': 'Only snippets and comments are moderated'}, 404
+        if row:
+            return {'ID': item_id, 'ModerationStatus': row.moderationstatus or 'approved'}, 200
+        else:
+            return {'message': 'Item not found'}, 404
+
+class ModerationStatsResource(Resource):
+    def get(self):
+        return moderator.stats(), 200
+
+class SnippetStatsResource(Resource):
+    def get(self, snippet_id):
+        rows = queries.execute('select_snippet_stats', [uuid.UUID(snippet_id)])
+        return {'SnippetID': snippet_id, 'Interactions': dict((row.type, row.count) for row in rows)}, 200
+
+class SearchResource(Resource):
+    schema = Schema(location='args', q=Optional(TEXT, ''), lang=Optional(TEXT), tag=Optional(TEXT), fetch_size=Optional(INT, DEFAULT_FETCH_SIZE), cursor=Optional(TEXT))
+
+    def get(self):
+        args = parse(self.schema)
+
+        if not (args['q'].strip() or args['lang'] or args['tag']):
+            abort(400, message='Pass at least one of q, lang or tag')
+        # the cursor is the offset of the next page
+        offset = 0
+        if args['cursor']:
+            try:
+                offset = max(int(base64.urlsafe_b64decode(args['cursor'].encode())), 0)
+            except (ValueError, binascii.Error):
+                abort(400, message='Invalid cursor')
+        fetch_size = min(max(args['fetch_size'], 1), MAX_FETCH_SIZE)
+        rows = search_index.search(args['q'], args['lang'], args['tag'], fetch_size + 1, offset)
+        cursor = base64.urlsafe_b64encode(str(offset + fetch_size).encode()).decode() if len(rows) > fetch_size else None
+        snippets = [{'SnippetID': snippet_id, 'Title': title, 'Language': language, 'Score': score} for snippet_id, title, language, score in rows[:fetch_size]]
+        return {'Snippets': snippets, 'NextCursor': cursor}, 200
+
+class SnippetContentResource(Resource):
+    # the Content alone as text/plain, decompressed as it is sent; the ETag is the content's hash
+    def get(self, snippet_id):
+        snippet = read_cache.get(cache_key('snippets', snippet_id), lambda: load_one('select_snippet', [uuid.UUID(snippet_id)], snippet_json))
+        if quarantined(snippet):
+            return {'message': 'Snippet is quarantined by moderation'}, 403
+        if not snippet:
+            return {'message': 'Snippet not found'}, 404
+        if 'Content' in snippet:
+            data = snippet['Content'].encode()
+            size, chunks = len(data), [data]
+        else:
+            found = content_store.chunks(snippet['ContentHash']) if snippet['ContentHash'] else None
+            if found is None:
+                return {'message': 'Snippet content not found'}, 404
+            size, chunks = found
+        headers = {'ETag': '"%s"' % (snippet['ContentHash'] or content.digest(snippet['Content'].encode()))}
+        if responses.request_not_modified(headers):
+            return None, 304, headers
+        return Response(chunks, mimetype='text/plain', headers=dict(headers, **{'Content-Length': str(size)}))
+
+FULL_PAGE_SIZE = int(os.getenv('FULL_PAGE_SIZE', 10))
+
+class SnippetFullResource(Resource):
+    # what a snippet page shows, in one request: the snippet, its author, its tags by name, its stats and
+    # the first page of its comments and bounties (the cursors continue them on their own endpoints).
+    # Every read is sent at once on the driver's async futures, and the ones that need another's result,
+    # the author and Content after the snippet and the tag names after the tags, as soon as it arrives, so
+    # the request takes about as long as the slowest chain of two reads rather than the sum of them all.
+    # Snippets, users and tags found in the read cache aren't read, and those read are cached
+    schema = Schema(location='args', view=Optional(TEXT, 'full'))
+
+    def get(self, snippet_id):
+        args = parse(self.schema)
+
+        if args['view'] not in VIEWS:
+            abort(400, message='view must be one of %s' % ', '.join(VIEWS))
+        key = uuid.UUID(snippet_id)
+        snippet = read_cache.lookup(cache_key('snippets', snippet_id))
+        if quarantined(snippet):
+            return {'message': 'Snippet is quarantined by moderation'}, 403
+        reads = {
+            'tags': queries.execute_async('list_snippettags', [key]),
+            'stats': queries.execute_async('select_snippet_stats', [key]),
+            'comments': queries.execute_async('list_comments_by_snippet', [key], FULL_PAGE_SIZE),
+            'bounties': queries.execute_async('list_bounties_by_snippet', [key], FULL_PAGE_SIZE),
+        }
+        # bodies found in the cache or read, and the reads whose row is cached once it arrives
+        found, fills = {}, {}
+        if snippet is None:
+            reads['snippet'] = queries.execute_async('select_snippet', [key])
+        else:
+            self.follow(snippet, args['view'], reads, found, fills)
+        tag_ids = []
+        waiting = dict((arrived(reads[name]), name) for name in ('snippet', 'tags') if name in reads)
+        for done in concurrent.futures.as_completed(waiting):
+            if waiting[done] == 'snippet':
+                row = reads['snippet'].result().one()
+                snippet = snippet_json(row) if row else None
+                if quarantined(snippet):
+                    return {'message': 'Snippet is quarantined by moderation'}, 403
+                if not snippet:
+                    return {'message': 'Snippet not found'}, 404
+                read_cache.fill(cache_key('snippets', snippet_id), snippet)
+                self.follow(snippet, args['view'], reads, found, fills)
+            else:
+                for row in reads['tags'].result():
+                    tag_ids.append(row.tagid)
+                    self.lookup(row.tagid, cache_key('tags', str(row.tagid)), tag_json, 'select_tag', [row.tagid], reads, found, fills)
+
+        for name, (cache_name, to_json) in fills.items():
+            row = reads[name].result().one()
+            found[name] = to_json(row) if row else None
+            if row:
+                read_cache.fill(cache_name, found[name])
+        if 'content' in reads:
+            rows = reads['content'].result().current_rows
+            snippet = dict(snippet, Content=content.unpack(rows[0]) if rows else None)
+        comments, bounties = reads['comments'].result(), reads['bounties'].result()
+        return {
+            'Snippet': snippet_views([snippet], args['view'])[0],
+            'Author': found.get('author'),
+            'Tags': [found.get(tag_id) or {'TagID': tag_id, 'Name': None} for tag_id in tag_ids],
+            'Interactions': dict((row.type, row.count) for row in reads['stats'].result()),
+            'Comments': [comment_json(row) for row in comments.current_rows],
+            'CommentsCursor': encode_cursor(comments.paging_state),
+            'Bounties': [bounty_json(row) for row in bounties.current_rows],
+            'BountiesCursor': encode_cursor(bounties.paging_state),
+        }, 200
+
+    def follow(self, snippet, view, reads, found, fills):
+        # the reads that need the snippet
+        if snippet['UserID']:
+            user_id = uuid.UUID(str(snippet['UserID']))
+            self.lookup('author', cache_key('users', str(user_id)), user_json, 'select_user', [user_id], reads, found, fills)
+        if view == 'full' and 'Content' not in snippet and snippet['ContentHash']:
+            reads['content'] = queries.execute_async('select_snippet_content', [snippet['ContentHash']])
+
+    def lookup(self, name, cache_name, to_json, query, params, reads, found, fills):
+        found[name] = read_cache.lookup(cache_name)
+        if found[name] is None:
+            reads[name] = queries.execute_async(query, params)
+            fills[name] = (cache_name, to_json)
+
+class SnippetSimilarResource(Resource):
+    schema = Schema(location='args', limit=Optional(INT, 10), min_similarity=Optional(NUMBER, 0.5))
+
+    def get(self, snippet_id):
+        args = parse(self.schema)
+
+        found = similarity_index.similar(str(uuid.UUID(snippet_id)), args['min_similarity'])
+        if found is None:
+            return {'message': 'Snippet not found'}, 404
+        found = found[:min(max(args['limit'], 1), MAX_FETCH_SIZE)]
+        # only snippets that are searchable, so quarantined and deleted ones aren't listed
+        titles = search_index.titles([similar_id for similar_id, _ in found]) if found else {}
+        snippets = [{'SnippetID': similar_id, 'Title': titles[similar_id][0], 'Language': titles[similar_id][1], 'Similarity': round(score, 3)}
+            for similar_id, score in found if similar_id in titles]
+        return {'SnippetID': snippet_id, 'Snippets': snippets}, 200
+
+class TrendingFeedResource(Resource):
+    schema = Schema(location='args', lang=Optional(TEXT), tag=Optional(TEXT))
+
+    def get(self):
+        args = parse(self.schema)
+
+        if args['lang'] and args['tag']:
+            abort(400, message='Pass at most one of lang or tag')
+        body, etag = trending_feed.feed(trending.scope(args['lang'], args['tag']))
+        headers = {'ETag': etag} if etag else {}
+        if responses.request_not_modified(headers):
+            return None, 304, headers
+        return body, 200, headers
+
+class CacheStatsResource(Resource):
+    def get(self):
+        return read_cache.stats(), 200
+
+class InteractionBufferStatsResource(Resource):
+    def get(self):
+        if interaction_buffer is None:
+            return {'message': 'Write-behind is disabled'}, 404
+        return interaction_buffer.stats(), 200
+
+class MetricsResource(Resource):
+    def get(self):
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 class ContentFilter():
     def content_safe(content):
-        moderation = client.moderations.create(input=content)
-        response = moderation.model_dump()
-        return not response['results'][0]['flagged']
+        return not moderator.submit(content).result()
+
+    def check_async(content):
+        return moderator.submit(content)
 
 api.add_resource(Swagger, '/swagger')
 api.add_resource(UserResource, '/users', '/users/<string:user_id>')
@@ -327,7 +1244,29 @@ api.add_resource(SnippetBountyResource, '/snippetbounties', '/snippetbounties/<s
 api.add_resource(BugBountyResource, '/bugbounties', '/bugbounties/<string:bounty_id>')
 api.add_resource(ReportResource, '/reports', '/reports/<string:report_id>')
 api.add_resource(CommentResource, '/comments', '/comments/<string:comment_id>')
+api.add_resource(SnippetBulkResource, '/snippets/bulk')
+api.add_resource(TagBulkResource, '/tags/bulk')
+api.add_resource(SnippetTagBulkResource, '/snippettags/bulk')
+api.add_resource(UserSnippetListResource, '/users/<string:user_id>/snippets')
+api.add_resource(SnippetCommentListResource, '/snippets/<string:snippet_id>/comments')
+api.add_resource(SnippetTagListResource, '/snippets/<string:snippet_id>/tags')
+api.add_resource(SnippetBountyListResource, '/snippets/<string:snippet_id>/bounties')
+api.add_resource(SnippetInteractionListResource, '/snippets/<string:snippet_id>/interactions')
+api.add_resource(SnippetStatsResource, '/snippets/<string:snippet_id>/stats')
+api.add_resource(SnippetSimilarResource, '/snippets/<string:snippet_id>/similar')
+api.add_resource(SnippetContentResource, '/snippets/<string:snippet_id>/content')
+api.add_resource(SnippetFullResource, '/snippets/<string:snippet_id>/full')
+api.add_resource(TagSnippetListResource, '/tags/<string:tag_id>/snippets')
+api.add_resource(ModerationStatsResource, '/moderation/stats')
+api.add_resource(ModerationStatusResource, '/moderation/<string:kind>/<string:item_id>')
+api.add_resource(SearchResource, '/search')
+api.add_resource(TrendingFeedResource, '/feed/trending')
+api.add_resource(CacheStatsResource, '/cache/stats')
+api.add_resource(InteractionBufferStatsResource, '/interactions/buffer/stats')
+api.add_resource(MetricsResource, '/metrics')
 
 if __name__ == '__main__':
+    if not migrations.verify(db.session(), SCHEMA_CHECK):
+        raise SystemExit(1)
     app.register_blueprint(swaggerui_blueprint)
     app.run(debug=True)
\ No newline at end of file
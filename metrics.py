@@ -0,0 +1,138 @@
+import bisect
+import threading
+import time
+
+# per-process metrics rendered in the Prometheus text format from /metrics
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in escaped)
+
+class Histogram():
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labelnames, labels, [('le', repr(bound))]), cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, _labels(self.labelnames, labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %r' % (self.name, _labels(self.labelnames, labels), total))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labels), count))
+        return lines
+
+class Counter():
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            lines.append('%s%s %r' % (self.name, _labels(self.labelnames, labels), value))
+        return lines
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, name, help, labelnames=(), buckets=BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, prefix, stats):
+        # stats() returns a dict of numbers (e.g. read_cache.stats), each rendered as a gauge named prefix_key
+        self.collectors.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self.collectors:
+            values = stats()
+            if values is None:
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE %s_%s gauge' % (prefix, key))
+                    lines.append('%s_%s %r' % (prefix, key, value))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+request_seconds = registry.histogram('devspace_request_duration_seconds', 'Request latency by route', ('method', 'route', 'status'))
+parse_seconds = registry.histogram('devspace_request_parse_seconds', 'Time spent parsing and validating request arguments', ('route',))
+query_seconds = registry.histogram('devspace_query_duration_seconds', 'Scylla latency by prepared statement', ('statement', 'kind'))
+query_errors = registry.counter('devspace_query_errors_total', 'Scylla requests that failed', ('statement', 'kind'))
+moderation_seconds = registry.histogram('devspace_moderation_duration_seconds', 'Moderation backend call latency', ('outcome',))
+moderation_lag = registry.histogram('devspace_moderation_lag_seconds', 'Time from submitting text to its verdict')
+rate_limited = registry.counter('devspace_rate_limited_total', 'Requests turned away, 429 for a user over a route limit and 503 when the process is full', ('route', 'status'))
+idempotent_requests = registry.counter('devspace_idempotent_requests_total', 'POSTs sent with an Idempotency-Key by what became of them', ('outcome',))
+slow_requests = registry.counter('devspace_slow_requests_total', 'Traced requests slower than TRACE_SLOW_MS', ('route',))
+
+# statements run on the current thread while a sampled request is being traced
+trace = threading.local()
+
+def record_query(name, kind, seconds, failed=False):
+    query_seconds.observe(seconds, name, kind)
+    if failed:
+        query_errors.inc(name, kind)
+    statements = getattr(trace, 'statements', None)
+    if statements is not None:
+        statements.append((name, round(seconds * 1000, 3)))
+
+class Timer():
+    # with Timer(histogram, *labels): ...
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, *self.labels)
@@ -0,0 +1,391 @@
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timezone
+import db
+import logs
+from queries import QUERIES
+
+log = logging.getLogger(__name__)
+
+# the keyspace only changes through the numbered migrations below: python migrations.py applies the ones
+# not yet recorded in Devspace.SchemaMigrations, in order. A migration that has shipped is never edited,
+# the next change is a new one. Statements must be safe to run again after a partial failure: CREATE ...
+# IF NOT EXISTS, and ALTER TABLE ... ADD is skipped when the column already exists, which also lets a
+# keyspace made by the old create_db.py pick up at migration 1.
+#
+# check() compares the live schema with the one the migrations describe and with the columns every
+# statement in queries.py uses, so a missing column fails the deploy instead of the writes that need it
+
+KEYSPACE = 'devspace'
+# DDL waits for schema agreement across the cluster, far longer than a write
+DDL_TIMEOUT = 60
+
+MIGRATIONS = [
+    (1, 'tables as create_db.py made them', [
+        """CREATE TABLE IF NOT EXISTS Devspace.Users (
+            UserID UUID PRIMARY KEY,
+            Username TEXT,
+            Email TEXT,
+            PasswordHash TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.Snippets (
+            SnippetID UUID PRIMARY KEY,
+            UserID UUID,
+            Title TEXT,
+            Content TEXT,
+            Language TEXT,
+            CreatedAt TIMESTAMP,
+            UpdatedAt TIMESTAMP,
+            ModerationStatus TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.Tags (
+            TagID UUID PRIMARY KEY,
+            TagName TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetTags (
+            SnippetID UUID,
+            TagID UUID,
+            PRIMARY KEY (SnippetID, TagID)
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.Interactions (
+            InteractionID UUID PRIMARY KEY,
+            SnippetID UUID,
+            UserID UUID,
+            Type TEXT,
+            CreatedAt TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetBounties (
+            BountyID UUID PRIMARY KEY,
+            SnippetID UUID,
+            UserID UUID,
+            Description TEXT,
+            Reward INT,
+            Status TEXT,
+            CreatedAt TIMESTAMP,
+            DueDate TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.BugBounties (
+            BountyID UUID PRIMARY KEY,
+            UserID UUID,
+            Description TEXT,
+            Reward INT,
+            Status TEXT,
+            CreatedAt TIMESTAMP,
+            DueDate TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.Reports (
+            ReportID UUID PRIMARY KEY,
+            SnippetID UUID,
+            ReportedByUserID UUID,
+            Reason TEXT,
+            CreatedAt TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS Devspace.Comments (
+            CommentID UUID PRIMARY KEY,
+            SnippetID UUID,
+            UserID UUID,
+            Content TEXT,
+            CreatedAt TIMESTAMP,
+            ModerationStatus TEXT
+        )""",
+        # lookup tables, one partition per access path, kept in step with the base tables by batched writes
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetsByUser (
+            UserID UUID,
+            CreatedAt TIMESTAMP,
+            SnippetID UUID,
+            Title TEXT,
+            Language TEXT,
+            PRIMARY KEY (UserID, CreatedAt, SnippetID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt DESC, SnippetID ASC)""",
+        """CREATE TABLE IF NOT EXISTS Devspace.CommentsBySnippet (
+            SnippetID UUID,
+            CreatedAt TIMESTAMP,
+            CommentID UUID,
+            UserID UUID,
+            Content TEXT,
+            PRIMARY KEY (SnippetID, CreatedAt, CommentID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt ASC, CommentID ASC)""",
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetsByTag (
+            TagID UUID,
+            SnippetID UUID,
+            PRIMARY KEY (TagID, SnippetID)
+        )""",
+        # per-snippet interaction counts by type, one partition read for a snippet's stats
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetStats (
+            SnippetID UUID,
+            Type TEXT,
+            Count COUNTER,
+            PRIMARY KEY (SnippetID, Type)
+        )""",
+    ]),
+    # the bounty and report endpoints have always written these; the old columns are left in place
+    (2, 'columns the bounty and report endpoints write', [
+        "ALTER TABLE Devspace.SnippetBounties ADD Amount INT",
+        "ALTER TABLE Devspace.BugBounties ADD SnippetID UUID",
+        "ALTER TABLE Devspace.BugBounties ADD Amount INT",
+        "ALTER TABLE Devspace.Reports ADD UserID UUID",
+    ]),
+    # interactions and reports by time: one partition per snippet per day (per day for reports), so a time
+    # range reads only the days it covers and whole days expire together under time-window compaction,
+    # see table_options; backfill.py copies the rows already in Interactions and Reports
+    (3, 'day-bucketed interactions and reports', [
+        """CREATE TABLE IF NOT EXISTS Devspace.InteractionsBySnippetDay (
+            SnippetID UUID,
+            Day DATE,
+            CreatedAt TIMESTAMP,
+            InteractionID UUID,
+            UserID UUID,
+            Type TEXT,
+            PRIMARY KEY ((SnippetID, Day), CreatedAt, InteractionID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt DESC, InteractionID ASC)""",
+        """CREATE TABLE IF NOT EXISTS Devspace.ReportsByDay (
+            Day DATE,
+            CreatedAt TIMESTAMP,
+            ReportID UUID,
+            SnippetID UUID,
+            UserID UUID,
+            Reason TEXT,
+            PRIMARY KEY (Day, CreatedAt, ReportID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt DESC, ReportID ASC)""",
+    ]),
+    # Content out of the Snippets row: compressed and stored once per distinct content under its SHA-256,
+    # see content.py. SSTable compression is off for it, the data is compressed already. Existing rows keep
+    # their inline Content until python content.py pack moves it
+    (4, 'deduplicated, compressed snippet content', [
+        "ALTER TABLE Devspace.Snippets ADD ContentHash TEXT",
+        "ALTER TABLE Devspace.Snippets ADD ContentSize INT",
+        "ALTER TABLE Devspace.Snippets ADD Preview TEXT",
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetContent (
+            ContentHash TEXT PRIMARY KEY,
+            Codec TEXT,
+            Size INT,
+            Data BLOB,
+            StoredAt TIMESTAMP
+        ) WITH compression = {'sstable_compression': ''}""",
+    ]),
+    # responses to POSTs sent with an Idempotency-Key, replayed to retries; rows expire, see RETENTION
+    (5, 'idempotency keys', [
+        """CREATE TABLE IF NOT EXISTS Devspace.IdempotencyKeys (
+            IdempotencyKey TEXT PRIMARY KEY,
+            Fingerprint TEXT,
+            Status INT,
+            Body TEXT,
+            CreatedAt TIMESTAMP
+        )""",
+    ]),
+    # a snippet's bounties newest first, for GET /snippets/<id>/bounties and /full; backfill.py copies
+    # the bounties already in SnippetBounties
+    (6, 'bounties by snippet', [
+        """CREATE TABLE IF NOT EXISTS Devspace.SnippetBountiesBySnippet (
+            SnippetID UUID,
+            CreatedAt TIMESTAMP,
+            BountyID UUID,
+            UserID UUID,
+            Amount INT,
+            PRIMARY KEY (SnippetID, CreatedAt, BountyID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt DESC, BountyID ASC)""",
+    ]),
+    # migration 1 creates these columns on a new keyspace, but a keyspace made by the original create_db.py
+    # predates moderation and has tables without them, which CREATE ... IF NOT EXISTS leaves as they are
+    (7, 'moderation status on tables from before moderation', [
+        "ALTER TABLE Devspace.Snippets ADD ModerationStatus TEXT",
+        "ALTER TABLE Devspace.Comments ADD ModerationStatus TEXT",
+    ]),
+    # ReportsByDay put a whole day's reports in one partition. This spreads each day over REPORT_BUCKETS
+    # partitions, picked by ReportID, that GET /reports reads together. ReportsByDay is no longer written
+    # and expires; python backfill.py --tables reports copies the reports into the buckets
+    (8, 'reports by day split into buckets', [
+        """CREATE TABLE IF NOT EXISTS Devspace.ReportsByDayBucket (
+            Day DATE,
+            Bucket INT,
+            CreatedAt TIMESTAMP,
+            ReportID UUID,
+            SnippetID UUID,
+            UserID UUID,
+            Reason TEXT,
+            PRIMARY KEY ((Day, Bucket), CreatedAt, ReportID)
+        ) WITH CLUSTERING ORDER BY (CreatedAt DESC, ReportID ASC)""",
+    ]),
+]
+
+# partitions per day of ReportsByDayBucket; rows are placed and read by it, so it can't change once written
+REPORT_BUCKETS = 8
+
+def report_bucket(report_id):
+    return report_id.int % REPORT_BUCKETS
+
+CREATE = re.compile(r'CREATE TABLE IF NOT EXISTS Devspace\.(\w+) \((.*)\)', re.I | re.S)
+ADD = re.compile(r'ALTER TABLE Devspace\.(\w+) ADD (\w+) (\w+)', re.I)
+# column definitions are one per line in the statements above
+COLUMN = re.compile(r'^\s+(\w+) (\w+)', re.M)
+# the shapes of statement in queries.py
+STATEMENTS = [
+    re.compile(r'SELECT (?P<columns>.+?) FROM (?P<table>[\w.]+)(?: WHERE (?P<where>.+))?$', re.I),
+    re.compile(r'INSERT INTO (?P<table>[\w.]+) \((?P<columns>[^)]+)\)', re.I),
+    re.compile(r'UPDATE (?P<table>[\w.]+)(?: USING TTL \?)? SET (?P<where>.+)$', re.I),
+    re.compile(r'DELETE FROM (?P<table>[\w.]+) WHERE (?P<where>.+)$', re.I),
+]
+# names on the left of a comparison or assignment
+OPERAND = re.compile(r'(\w+) *(?:=|<|>|\bIN\b)', re.I)
+ALIASES = {'varchar': 'text'}
+
+def expected():
+    # {table: {column: cql type}} as the migrations leave them, lower case like the driver's metadata
+    tables = {}
+    for _, _, statements in MIGRATIONS:
+        for statement in statements:
+            created = CREATE.match(statement)
+            if created:
+                tables.setdefault(created.group(1).lower(), dict(
+                    (name.lower(), kind.lower()) for name, kind in COLUMN.findall(created.group(2)) if name.upper() != 'PRIMARY'))
+            added = ADD.match(statement)
+            if added:
+                tables[added.group(1).lower()][added.group(2).lower()] = added.group(3).lower()
+    return tables
+
+def statement_columns(cql):
+    # (table, columns) a statement reads or writes
+    for pattern in STATEMENTS:
+        m = pattern.match(cql)
+        if m:
+            groups = m.groupdict()
+            columns = [name.strip() for name in (groups.get('columns') or '').split(',') if name.strip()]
+            columns += OPERAND.findall(groups.get('where') or '')
+            return m.group('table').lower().split('.')[-1], [name.lower() for name in columns]
+    return None, []
+
+def live_tables(session):
+    keyspace = session.cluster.metadata.keyspaces.get(KEYSPACE)
+    return keyspace.tables if keyspace is not None else {}
+
+def applied_versions(session):
+    if 'schemamigrations' not in live_tables(session):
+        return set()
+    return set(row.version for row in session.execute("SELECT Version FROM Devspace.SchemaMigrations"))
+
+def present(session, statement):
+    # an ALTER TABLE ... ADD whose column is already there
+    added = ADD.match(statement)
+    if not added:
+        return False
+    table = live_tables(session).get(added.group(1).lower())
+    return table is not None and added.group(2).lower() in table.columns
+
+# (setting, default days, tables): rows expire that many days after they are written, 0 keeps them forever
+RETENTION = [
+    ('INTERACTIONS_TTL_DAYS', 90, ('interactions', 'interactionsbysnippetday')),
+    ('REPORTS_TTL_DAYS', 365, ('reports', 'reportsbyday', 'reportsbydaybucket')),
+    ('IDEMPOTENCY_TTL_DAYS', 1, ('idempotencykeys',)),
+]
+
+def table_options(env):
+    # compaction and TTL of the high-volume tables are tuned per deployment, so they are set to match on
+    # every run rather than versioned. Every row of these tables gets the same TTL, so time-window
+    # compaction can drop whole expired SSTables instead of compacting them. Interaction counts live on
+    # in SnippetStats after the interactions expire
+    options = {}
+    for setting, default, tables in RETENTION:
+        days = float(env.get(setting, default))
+        if days > 0:
+            # about 30 windows across the TTL
+            compaction = {'class': 'TimeWindowCompactionStrategy', 'compaction_window_unit': 'DAYS', 'compaction_window_size': max(1, round(days / 30))}
+        else:
+            compaction = {'class': 'SizeTieredCompactionStrategy'}
+        for table in tables:
+            options[table] = {'default_time_to_live': int(days * 86400), 'compaction': compaction}
+    return options
+
+def _cql(value):
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join("'%s': '%s'" % item for item in value.items())
+    return str(value)
+
+def _same(live, wanted):
+    if isinstance(wanted, dict):
+        live = live or {}
+        return all(str(live.get(key, '')).split('.')[-1] == str(value) for key, value in wanted.items())
+    return str(live) == str(wanted)
+
+def set_options(session, options):
+    tables = live_tables(session)
+    for table, wanted in options.items():
+        live = getattr(tables.get(table), 'options', {})
+        changed = dict((name, value) for name, value in wanted.items() if not _same(live.get(name), value))
+        if changed:
+            session.execute("ALTER TABLE %s.%s WITH %s" % (KEYSPACE, table, ' AND '.join('%s = %s' % (name, _cql(value)) for name, value in changed.items())), timeout=DDL_TIMEOUT)
+            log.info('Set %s on %s', ', '.join(changed), table)
+
+def migrate(session, env=os.environ):
+    # returns the versions applied by this run
+    session.execute("CREATE KEYSPACE IF NOT EXISTS Devspace WITH REPLICATION = {'class': 'SimpleStrategy', 'replication_factor': %d}" % db.REPLICATION_FACTOR, timeout=DDL_TIMEOUT)
+    session.execute("CREATE TABLE IF NOT EXISTS Devspace.SchemaMigrations (Version INT PRIMARY KEY, Description TEXT, AppliedAt TIMESTAMP)", timeout=DDL_TIMEOUT)
+    applied = applied_versions(session)
+    record = session.prepare("INSERT INTO Devspace.SchemaMigrations (Version, Description, AppliedAt) VALUES (?, ?, ?)")
+    done = []
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            if not present(session, statement):
+                session.execute(statement, timeout=DDL_TIMEOUT)
+        session.execute(record, (version, description, datetime.now(timezone.utc)))
+        log.info('Applied migration %d: %s', version, description)
+        done.append(version)
+    set_options(session, table_options(env))
+    return done
+
+def check(session, queries=QUERIES):
+    # a list of the ways the live schema differs from what the migrations and queries expect, empty if none
+    problems = []
+    latest = MIGRATIONS[-1][0]
+    pending = [version for version, _, _ in MIGRATIONS if version not in applied_versions(session)]
+    if pending:
+        problems.append('migrations %s of %d are not applied' % (', '.join(map(str, pending)), latest))
+    tables = live_tables(session)
+    schema = expected()
+    for table, columns in schema.items():
+        if table not in tables:
+            problems.append('table %s.%s is missing' % (KEYSPACE, table))
+            continue
+        for column, kind in columns.items():
+            live = tables[table].columns.get(column)
+            if live is None:
+                problems.append('column %s.%s is missing' % (table, column))
+            elif ALIASES.get(live.cql_type, live.cql_type) != ALIASES.get(kind, kind):
+                problems.append('column %s.%s is %s, expected %s' % (table, column, live.cql_type, kind))
+    for name, cql in queries.items():
+        table, columns = statement_columns(cql)
+        if table is None:
+            continue
+        for column in columns:
+            if column not in schema.get(table, {}):
+                problems.append('query %s uses %s.%s, which no migration creates' % (name, table, column))
+            elif table in tables and column not in tables[table].columns:
+                problems.append('query %s uses %s.%s, which the live schema lacks' % (name, table, column))
+    return problems
+
+def verify(session, mode):
+    # run before taking traffic: SCHEMA_CHECK=fail (the default) refuses to start on drift, warn only logs it, off skips the check
+    if mode == 'off':
+        return True
+    problems = check(session)
+    for problem in problems:
+        log.error('Schema drift: %s', problem)
+    if problems:
+        log.error('python migrations.py applies pending migrations; SCHEMA_CHECK=warn starts anyway')
+    return not problems or mode != 'fail'
+
+if __name__ == '__main__':
+    # python migrations.py applies pending migrations and table options; python migrations.py check only reports drift
+    logs.setup(os.environ)
+    session = db.session()
+    if sys.argv[1:] != ['check']:
+        versions = migrate(session)
+        print('Applied migrations %s.' % ', '.join(map(str, versions)) if versions else 'Schema is up to date.')
+    problems = check(session)
+    for problem in problems:
+        print('Drift: %s' % problem)
+    if problems:
+        raise SystemExit(1)
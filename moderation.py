@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from cache import LRUCache
+import metrics
+
+log = logging.getLogger(__name__)
+
+# moderation backends take a list of texts and return one flagged verdict per text, in order
+class OpenAIBackend():
+    def __init__(self, api_key=None):
+        import openai
+        self.client = openai.OpenAI(api_key=api_key)
+
+    def check(self, texts):
+        moderation = self.client.moderations.create(input=texts)
+        response = moderation.model_dump()
+        return [result['flagged'] for result in response['results']]
+
+# offline stand-in: flags any text containing a blocked word
+class FakeBackend():
+    def __init__(self, blocked=('spam', 'scam'), delay=0):
+        self.blocked = [word.lower() for word in blocked]
+        self.delay = delay
+        self.calls = 0
+
+    def check(self, texts):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return [any(word in text.lower() for word in self.blocked) for text in texts]
+
+class ModerationBatcher():
+    # a pool of worker threads drains one queue; texts submitted within max_wait seconds of each other
+    # go to the backend as one list call, and verdicts are cached by content hash so repeated text is
+    # never sent twice. A failed backend call is retried up to max_attempts times before giving up
+    def __init__(self, backend, verdicts, max_batch=32, max_wait=0.05, workers=4, max_attempts=3):
+        self.backend = backend
+        self.verdicts = verdicts
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue()
+        self.enqueued = deque()
+        self.last_lag = 0.0
+        self.counters = {'submitted': 0, 'cache_hits': 0, 'batches': 0, 'checked': 0, 'flagged': 0, 'errors': 0, 'retries': 0, 'restarts': 0}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def submit(self, text):
+        # returns a Future resolving to True when the text is flagged
+        self.count('submitted')
+        future = Future()
+        key = hashlib.sha256(text.encode()).hexdigest()
+        verdict = self.verdicts.get(key)
+        if verdict is not None:
+            self.count('cache_hits')
+            future.set_result(verdict)
+            return future
+        self.ensure_workers()
+        self.put((key, text, future, 1, time.monotonic()))
+        return future
+
+    def put(self, item):
+        with self.lock:
+            self.enqueued.append(item[4])
+            self.queue.put(item)
+
+    def get(self, timeout=None):
+        item = self.queue.get(timeout=timeout)
+        with self.lock:
+            self.enqueued.popleft()
+        return item
+
+    def ensure_workers(self):
+        # started on first use, and again in a forked worker process where the parent's threads don't exist;
+        # a thread that died anyway is replaced
+        if self.threads and self.pid == os.getpid() and all(thread.is_alive() for thread in self.threads):
+            return
+        with self.lock:
+            if not self.threads or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.threads = [None] * self.workers
+            for i, thread in enumerate(self.threads):
+                if thread is None or not thread.is_alive():
+                    if thread is not None:
+                        self.counters['restarts'] += 1
+                    self.threads[i] = threading.Thread(target=self.run, name='moderation-%d' % i, daemon=True)
+                    self.threads[i].start()
+
+    def run(self):
+        while True:
+            batch = [self.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception as e:
+                # a bug past the backend call fails this batch, not the thread
+                log.exception('Moderation batch failed')
+                self.count('errors')
+                for _, _, future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def flush(self, batch):
+        texts = {}
+        for key, text, _, _, _ in batch:
+            texts.setdefault(key, text)
+        keys = list(texts)
+        start = time.perf_counter()
+        try:
+            results = dict(zip(keys, self.backend.check([texts[key] for key in keys])))
+        except Exception as e:
+            metrics.moderation_seconds.observe(time.perf_counter() - start, 'error')
+            self.count('errors')
+            retry = [item for item in batch if item[3] < self.max_attempts]
+            for _, _, future, attempt, _ in batch:
+                if attempt >= self.max_attempts:
+                    future.set_exception(e)
+            if retry:
+                time.sleep(min(0.1 * 2 ** retry[0][3], 2))
+            for key, text, future, attempt, submitted in retry:
+                self.count('retries')
+                self.put((key, text, future, attempt + 1, submitted))
+            return
+        metrics.moderation_seconds.observe(time.perf_counter() - start, 'ok')
+        self.count('batches')
+        self.count('checked', len(keys))
+        self.count('flagged', sum(1 for flagged in results.values() if flagged))
+        for key, flagged in results.items():
+            self.verdicts.set(key, flagged)
+        now = time.monotonic()
+        for key, _, future, _, submitted in batch:
+            self.last_lag = now - submitted
+            metrics.moderation_lag.observe(self.last_lag)
+            future.set_result(results[key])
+
+    def stats(self):
+        # pending is the queue depth, lag the age of the oldest queued text,
+        # last_lag how long the most recent verdict took from submit to result
+        with self.lock:
+            stats = dict(self.counters)
+            stats['lag'] = time.monotonic() - self.enqueued[0] if self.enqueued else 0.0
+        stats['pending'] = self.queue.qsize()
+        stats['last_lag'] = self.last_lag
+        stats['workers'] = self.workers
+        return stats
+
+class Sweeper():
+    # runs sweep() in a background thread of each worker process about every interval seconds, the first
+    # time within a minute of start; the waits are jittered so the workers of a host don't scan together
+    def __init__(self, sweep, interval):
+        self.sweep = sweep
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if not self.interval or (self.thread is not None and self.pid == os.getpid()):
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='moderation-sweep', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        time.sleep(random.uniform(0, min(self.interval, 60)))
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                log.warning('Moderation sweep failed: %s', e)
+            time.sleep(random.uniform(0.5, 1.5) * self.interval)
+
+def from_env(env):
+    # MODERATION_BACKEND=fake runs offline against FakeBackend, anything else calls OpenAI
+    if env.get('MODERATION_BACKEND') == 'fake':
+        blocked = [word for word in env.get('MODERATION_FAKE_BLOCKLIST', 'spam,scam').split(',') if word]
+        backend = FakeBackend(blocked)
+    else:
+        backend = OpenAIBackend(env.get('OPENAI_API_KEY'))
+    verdicts = LRUCache(int(env.get('MODERATION_CACHE_SIZE', 50000)), float(env.get('MODERATION_CACHE_TTL', 86400)))
+    return ModerationBatcher(backend, verdicts, int(env.get('MODERATION_MAX_BATCH', 32)), float(env.get('MODERATION_MAX_WAIT', 0.05)), int(env.get('MODERATION_WORKERS', 4)))
@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from cassandra.cluster import EXEC_PROFILE_DEFAULT
+from cassandra.concurrent import execute_concurrent, execute_concurrent_with_args
+from cassandra.query import BatchStatement, BatchType
+from db import READS
+import metrics
+
+log = logging.getLogger(__name__)
+
+# every CQL statement the API sends, keyed by name so handlers share one prepared copy
+QUERIES = {
+    'select_user': "SELECT UserID, Username, Email FROM Devspace.Users WHERE UserID=?",
+    'insert_user': "INSERT INTO Devspace.Users (UserID, Username, Email, PasswordHash) VALUES (?, ?, ?, ?)",
+    'update_user': "UPDATE Devspace.Users SET Username=?, Email=?, PasswordHash=? WHERE UserID=?",
+    'delete_user': "DELETE FROM Devspace.Users WHERE UserID=?",
+
+    'select_snippet': "SELECT SnippetID, UserID, Title, Content, ContentHash, ContentSize, Preview, Language, CreatedAt, UpdatedAt, ModerationStatus FROM Devspace.Snippets WHERE SnippetID=?",
+    'insert_snippet': "INSERT INTO Devspace.Snippets (SnippetID, UserID, Title, ContentHash, ContentSize, Preview, Language, CreatedAt, UpdatedAt, ModerationStatus) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    'update_snippet': "UPDATE Devspace.Snippets SET UserID=?, Title=?, Content=null, ContentHash=?, ContentSize=?, Preview=?, Language=?, UpdatedAt=?, ModerationStatus=? WHERE SnippetID=?",
+    # content is keyed by the SHA-256 of its bytes, see content.py
+    'select_snippet_content': "SELECT ContentHash, Codec, Size, Data FROM Devspace.SnippetContent WHERE ContentHash=?",
+    'insert_snippet_content': "INSERT INTO Devspace.SnippetContent (ContentHash, Codec, Size, Data, StoredAt) VALUES (?, ?, ?, ?, ?)",
+    'delete_snippet_content': "DELETE FROM Devspace.SnippetContent WHERE ContentHash=?",
+    'pack_snippet_content': "UPDATE Devspace.Snippets SET Content=null, ContentHash=?, ContentSize=?, Preview=? WHERE SnippetID=? IF Content=?",
+    'select_snippet_status': "SELECT SnippetID, ModerationStatus FROM Devspace.Snippets WHERE SnippetID=?",
+    'set_snippet_status': "UPDATE Devspace.Snippets SET ModerationStatus=?, UpdatedAt=? WHERE SnippetID=? IF ContentHash=? AND Title=?",
+    'delete_snippet': "DELETE FROM Devspace.Snippets WHERE SnippetID=?",
+    'insert_snippet_by_user': "INSERT INTO Devspace.SnippetsByUser (UserID, CreatedAt, SnippetID, Title, Language) VALUES (?, ?, ?, ?, ?)",
+    'delete_snippet_by_user': "DELETE FROM Devspace.SnippetsByUser WHERE UserID=? AND CreatedAt=? AND SnippetID=?",
+    'list_snippets_by_user': "SELECT UserID, CreatedAt, SnippetID, Title, Language FROM Devspace.SnippetsByUser WHERE UserID=?",
+
+    'select_tag': "SELECT TagID, TagName FROM Devspace.Tags WHERE TagID=?",
+    'insert_tag': "INSERT INTO Devspace.Tags (TagID, TagName) VALUES (?, ?)",
+    'update_tag': "UPDATE Devspace.Tags SET TagName=? WHERE TagID=?",
+    'delete_tag': "DELETE FROM Devspace.Tags WHERE TagID=?",
+
+    'select_snippettag': "SELECT SnippetID, TagID FROM Devspace.SnippetTags WHERE SnippetID=? AND TagID=?",
+    'insert_snippettag': "INSERT INTO Devspace.SnippetTags (SnippetID, TagID) VALUES (?, ?)",
+    'delete_snippettag': "DELETE FROM Devspace.SnippetTags WHERE SnippetID=? AND TagID=?",
+    'list_snippettags': "SELECT SnippetID, TagID FROM Devspace.SnippetTags WHERE SnippetID=?",
+    'insert_snippet_by_tag': "INSERT INTO Devspace.SnippetsByTag (TagID, SnippetID) VALUES (?, ?)",
+    'delete_snippet_by_tag': "DELETE FROM Devspace.SnippetsByTag WHERE TagID=? AND SnippetID=?",
+    'list_snippets_by_tag': "SELECT TagID, SnippetID FROM Devspace.SnippetsByTag WHERE TagID=?",
+
+    'select_interaction': "SELECT InteractionID, SnippetID, UserID, Type, CreatedAt FROM Devspace.Interactions WHERE InteractionID=?",
+    'insert_interaction': "INSERT INTO Devspace.Interactions (InteractionID, SnippetID, UserID, Type, CreatedAt) VALUES (?, ?, ?, ?, ?)",
+    'delete_interaction': "DELETE FROM Devspace.Interactions WHERE InteractionID=?",
+    'insert_interaction_by_day': "INSERT INTO Devspace.InteractionsBySnippetDay (SnippetID, Day, CreatedAt, InteractionID, UserID, Type) VALUES (?, ?, ?, ?, ?, ?)",
+    'delete_interaction_by_day': "DELETE FROM Devspace.InteractionsBySnippetDay WHERE SnippetID=? AND Day=? AND CreatedAt=? AND InteractionID=?",
+    'list_interactions_by_day': "SELECT SnippetID, CreatedAt, InteractionID, UserID, Type FROM Devspace.InteractionsBySnippetDay WHERE SnippetID=? AND Day=? AND CreatedAt >= ? AND CreatedAt < ?",
+    'increment_snippet_stat': "UPDATE Devspace.SnippetStats SET Count = Count + ? WHERE SnippetID=? AND Type=?",
+    'select_snippet_stats': "SELECT Type, Count FROM Devspace.SnippetStats WHERE SnippetID=?",
+
+    'select_snippetbounty': "SELECT BountyID, SnippetID, UserID, Amount, CreatedAt FROM Devspace.SnippetBounties WHERE BountyID=?",
+    'insert_snippetbounty': "INSERT INTO Devspace.SnippetBounties (BountyID, SnippetID, UserID, Amount, CreatedAt) VALUES (?, ?, ?, ?, ?)",
+    'delete_snippetbounty': "DELETE FROM Devspace.SnippetBounties WHERE BountyID=?",
+    'insert_bounty_by_snippet': "INSERT INTO Devspace.SnippetBountiesBySnippet (SnippetID, CreatedAt, BountyID, UserID, Amount) VALUES (?, ?, ?, ?, ?)",
+    'delete_bounty_by_snippet': "DELETE FROM Devspace.SnippetBountiesBySnippet WHERE SnippetID=? AND CreatedAt=? AND BountyID=?",
+    'list_bounties_by_snippet': "SELECT SnippetID, CreatedAt, BountyID, UserID, Amount FROM Devspace.SnippetBountiesBySnippet WHERE SnippetID=?",
+
+    'select_bugbounty': "SELECT BountyID, SnippetID, UserID, Amount, CreatedAt FROM Devspace.BugBounties WHERE BountyID=?",
+    'insert_bugbounty': "INSERT INTO Devspace.BugBounties (BountyID, SnippetID, UserID, Amount, CreatedAt) VALUES (?, ?, ?, ?, ?)",
+    'delete_bugbounty': "DELETE FROM Devspace.BugBounties WHERE BountyID=?",
+
+    'select_report': "SELECT ReportID, SnippetID, UserID, Reason, CreatedAt FROM Devspace.Reports WHERE ReportID=?",
+    'insert_report': "INSERT INTO Devspace.Reports (ReportID, SnippetID, UserID, Reason, CreatedAt) VALUES (?, ?, ?, ?, ?)",
+    'delete_report': "DELETE FROM Devspace.Reports WHERE ReportID=?",
+    'insert_report_by_day': "INSERT INTO Devspace.ReportsByDayBucket (Day, Bucket, CreatedAt, ReportID, SnippetID, UserID, Reason) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    'delete_report_by_day': "DELETE FROM Devspace.ReportsByDayBucket WHERE Day=? AND Bucket=? AND CreatedAt=? AND ReportID=?",
+    'list_reports_by_day': "SELECT ReportID, SnippetID, UserID, Reason, CreatedAt FROM Devspace.ReportsByDayBucket WHERE Day=? AND Bucket=? AND CreatedAt >= ? AND CreatedAt < ?",
+
+    'select_comment': "SELECT CommentID, SnippetID, UserID, Content, CreatedAt, ModerationStatus FROM Devspace.Comments WHERE CommentID=?",
+    'insert_comment': "INSERT INTO Devspace.Comments (CommentID, SnippetID, UserID, Content, CreatedAt, ModerationStatus) VALUES (?, ?, ?, ?, ?, ?)",
+    'select_comment_status': "SELECT CommentID, ModerationStatus FROM Devspace.Comments WHERE CommentID=?",
+    'set_comment_status': "UPDATE Devspace.Comments SET ModerationStatus=? WHERE CommentID=? IF EXISTS",
+    'delete_comment': "DELETE FROM Devspace.Comments WHERE CommentID=?",
+    'insert_comment_by_snippet': "INSERT INTO Devspace.CommentsBySnippet (SnippetID, CreatedAt, CommentID, UserID, Content) VALUES (?, ?, ?, ?, ?)",
+    'delete_comment_by_snippet': "DELETE FROM Devspace.CommentsBySnippet WHERE SnippetID=? AND CreatedAt=? AND CommentID=?",
+    'list_comments_by_snippet': "SELECT SnippetID, CreatedAt, CommentID, UserID, Content FROM Devspace.CommentsBySnippet WHERE SnippetID=?",
+
+    # full table scans for rebuilding the search index and for backfill.py, paged by the driver; left on
+    # the default profile since every page would outlast the speculative delay
+    'scan_snippets': "SELECT SnippetID, Title, Content, ContentHash, Language, ModerationStatus FROM Devspace.Snippets",
+    # the moderation sweep looks for rows still pending, see main.resubmit_pending
+    'scan_snippet_moderation': "SELECT SnippetID, UserID, CreatedAt, UpdatedAt, Title, Content, ContentHash, Language, ModerationStatus FROM Devspace.Snippets",
+    'scan_comment_moderation': "SELECT CommentID, SnippetID, CreatedAt, Content, ModerationStatus FROM Devspace.Comments",
+    # Idempotency-Key claims and the responses they replay, see idempotency.py
+    'select_idempotency_key': "SELECT IdempotencyKey, Fingerprint, Status, Body FROM Devspace.IdempotencyKeys WHERE IdempotencyKey=?",
+    'claim_idempotency_key': "INSERT INTO Devspace.IdempotencyKeys (IdempotencyKey, Fingerprint, CreatedAt) VALUES (?, ?, ?) IF NOT EXISTS USING TTL ?",
+    'complete_idempotency_key': "UPDATE Devspace.IdempotencyKeys USING TTL ? SET Fingerprint=?, Status=?, Body=?, CreatedAt=? WHERE IdempotencyKey=?",
+    'release_idempotency_key': "DELETE FROM Devspace.IdempotencyKeys WHERE IdempotencyKey=?",
+    'scan_snippet_content': "SELECT ContentHash, StoredAt FROM Devspace.SnippetContent",
+    'scan_snippettags': "SELECT SnippetID, TagID FROM Devspace.SnippetTags",
+    'scan_tags': "SELECT TagID, TagName FROM Devspace.Tags",
+    # backfill.py copies these into the day buckets, rewriting each row with what is left of its TTL
+    'scan_interactions': "SELECT InteractionID, SnippetID, UserID, Type, CreatedAt FROM Devspace.Interactions",
+    'scan_reports': "SELECT ReportID, SnippetID, UserID, Reason, CreatedAt FROM Devspace.Reports",
+    'backfill_interaction': "INSERT INTO Devspace.Interactions (InteractionID, SnippetID, UserID, Type, CreatedAt) VALUES (?, ?, ?, ?, ?) USING TTL ?",
+    'backfill_interaction_by_day': "INSERT INTO Devspace.InteractionsBySnippetDay (SnippetID, Day, CreatedAt, InteractionID, UserID, Type) VALUES (?, ?, ?, ?, ?, ?) USING TTL ?",
+    'backfill_report': "INSERT INTO Devspace.Reports (ReportID, SnippetID, UserID, Reason, CreatedAt) VALUES (?, ?, ?, ?, ?) USING TTL ?",
+    'backfill_report_by_day': "INSERT INTO Devspace.ReportsByDayBucket (Day, Bucket, CreatedAt, ReportID, SnippetID, UserID, Reason) VALUES (?, ?, ?, ?, ?, ?, ?) USING TTL ?",
+    # and the bounties written before migration 6 into their by-snippet table
+    'scan_snippetbounties': "SELECT BountyID, SnippetID, UserID, Amount, CreatedAt FROM Devspace.SnippetBounties",
+    'backfill_bounty_by_snippet': "INSERT INTO Devspace.SnippetBountiesBySnippet (SnippetID, CreatedAt, BountyID, UserID, Amount) VALUES (?, ?, ?, ?, ?) USING TTL ?",
+}
+
+# reads go to the READS execution profile and are marked idempotent so they can be speculatively retried
+READ_PREFIXES = ('select_', 'list_')
+
+class QueryRegistry():
+    # connect returns the current session; statements are prepared again whenever it hands back
+    # a different one, e.g. in a forked worker
+    def __init__(self, connect, queries=QUERIES):
+        self.connect = connect
+        self.queries = queries
+        self.prepared = {}
+        self.bound = None
+        self.lock = threading.Lock()
+
+    @property
+    def session(self):
+        session = self.connect()
+        if session is not self.bound:
+            with self.lock:
+                if session is not self.bound:
+                    self.prepared = {}
+                    self.bound = session
+        return session
+
+    def profile(self, name):
+        return READS if name.startswith(READ_PREFIXES) else EXEC_PROFILE_DEFAULT
+
+    def __getitem__(self, name):
+        session = self.session
+        statement = self.prepared.get(name)
+        if statement is None:
+            with self.lock:
+                statement = self.prepared.get(name)
+                if statement is None:
+                    statement = session.prepare(self.queries[name])
+                    statement.is_idempotent = name.startswith(READ_PREFIXES)
+                    self.prepared[name] = statement
+        return statement
+
+    def prepare_all(self):
+        # statements that fail here (e.g. a column missing from the live schema) are retried on first use
+        for name in self.queries:
+            try:
+                self[name]
+            except Exception as e:
+                log.warning('Could not prepare %s: %s', name, e)
+
+    def timed(self, name, kind, run):
+        start = time.perf_counter()
+        try:
+            result = run()
+        except Exception:
+            metrics.record_query(name, kind, time.perf_counter() - start, failed=True)
+            raise
+        metrics.record_query(name, kind, time.perf_counter() - start)
+        return result
+
+    def execute(self, name, params=None):
+        return self.timed(name, 'single', lambda: self.session.execute(self[name], params, execution_profile=self.profile(name)))
+
+    def execute_async(self, name, params=None, fetch_size=None):
+        # timed by the driver's callbacks on its IO thread; with fetch_size the result is the first page of
+        # that many rows, whose paging_state continues it as in page
+        statement = self[name]
+        if fetch_size:
+            statement = statement.bind(params)
+            statement.fetch_size = fetch_size
+            params = None
+        start = time.perf_counter()
+        future = self.session.execute_async(statement, params, execution_profile=self.profile(name))
+        future.add_callbacks(
+            callback=lambda _: metrics.record_query(name, 'async', time.perf_counter() - start),
+            errback=lambda _: metrics.record_query(name, 'async', time.perf_counter() - start, failed=True))
+        return future
+
+    def batch(self, statements, batch_type=BatchType.LOGGED):
+        # statements is a list of (name, params); logged by default so base and lookup tables stay in step
+        batch = BatchStatement(batch_type=batch_type)
+        for name, params in statements:
+            batch.add(self[name], params)
+        return self.timed('+'.join(sorted(set(name for name, _ in statements))), 'batch', lambda: self.session.execute(batch))
+
+    def page(self, name, params, fetch_size, paging_state=None):
+        # one page of rows plus the driver's paging state for the next page (None on the last page)
+        statement = self[name].bind(params)
+        statement.fetch_size = fetch_size
+        result = self.timed(name, 'page', lambda: self.session.execute(statement, paging_state=paging_state, execution_profile=self.profile(name)))
+        return result.current_rows, result.paging_state
+
+    def execute_concurrent(self, name, params_list, concurrency=50):
+        # one (success, result or error) per params, in order; keyed reads stay token-aware unlike IN (...)
+        return self.timed(name, 'concurrent', lambda: execute_concurrent_with_args(self.session, self[name], params_list, concurrency=concurrency, raise_on_first_error=False, execution_profile=self.profile(name)))
+
+    def bulk(self, writes, concurrency=50):
+        # writes holds, per item, a list of (partition, name, params). Statements for the same table and
+        # partition share one unlogged batch, every batch is sent concurrently, and the result maps the
+        # index of each item that had a statement fail to the error
+        groups = {}
+        for index, statements in enumerate(writes):
+            for partition, name, params in statements:
+                groups.setdefault((name, partition), []).append((index, params))
+        requests = []
+        for (name, _), entries in groups.items():
+            if len(entries) == 1:
+                requests.append((self[name], entries[0][1]))
+                continue
+            batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+            for _, params in entries:
+                batch.add(self[name], params)
+            requests.append((batch, None))
+        results = self.timed('+'.join(sorted(set(name for name, _ in groups))), 'bulk', lambda: execute_concurrent(self.session, requests, concurrency=concurrency, raise_on_first_error=False))
+        errors = {}
+        for entries, (success, result) in zip(groups.values(), results):
+            if not success:
+                for index, _ in entries:
+                    errors[index] = str(result)
+        return errors
@@ -0,0 +1,184 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# admission control in front of the API: at most max_inflight requests run in a worker process at once,
+# and writes (POST, PUT, DELETE) take tokens from a bucket per route and caller. A bucket holds up to burst
+# tokens and refills at rate tokens a second; a request that finds too few is answered 429 with how long
+# until there are enough. Buckets live in the worker's memory, or in redis to be shared by every worker
+# and host (each worker otherwise allows the full rate by itself)
+
+# {route: (tokens a second, burst)}; the write paths that fan out to moderation or carry money are tighter
+LIMITS = {
+    '/comments': (1, 10),
+    '/reports': (0.2, 5),
+    '/snippetbounties': (0.2, 5),
+    '/bugbounties': (0.2, 5),
+    '/snippets': (1, 20),
+    '/snippets/bulk': (10, 200),
+}
+DEFAULT_LIMIT = (5, 50)
+
+# a bucket is forgotten once it would have refilled anyway
+LUA_TAKE = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] + clock[2] / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = math.min(burst, (tonumber(state[1]) or burst) + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class LocalBuckets():
+    # this process's buckets; past maxsize the least recently used are dropped, and come back full
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost):
+        # seconds until cost tokens are there, 0 if they were taken
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self.buckets)
+
+class RedisBuckets():
+    # shared buckets, same interface as LocalBuckets; one script call per request, timed by redis' clock
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(LUA_TAKE)
+
+    def take(self, key, rate, burst, cost):
+        return float(self.script(keys=['ratelimit:' + key], args=[rate, burst, cost]))
+
+class RateLimiter():
+    def __init__(self, local, shared=None, limits=LIMITS, default=DEFAULT_LIMIT, max_inflight=128, wait=0.05):
+        # a limit is (tokens a second, burst), None for no limit; default covers the write routes not in limits
+        self.local = local
+        self.shared = shared
+        self.limits = limits
+        self.default = default
+        self.max_inflight = max_inflight
+        self.wait = wait
+        self.slots = threading.BoundedSemaphore(max_inflight) if max_inflight > 0 else None
+        self.inflight = 0
+        self.counters = {'admitted': 0, 'shed': 0, 'limited': 0, 'shared_errors': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    def enter(self, wait=None):
+        # False once max_inflight requests are running and none finishes within wait (self.wait by default)
+        if self.slots is not None and not self.slots.acquire(timeout=self.wait if wait is None else wait):
+            self.count('shed')
+            return False
+        with self.lock:
+            self.inflight += 1
+            self.counters['admitted'] += 1
+        return True
+
+    def leave(self):
+        with self.lock:
+            self.inflight -= 1
+        if self.slots is not None:
+            self.slots.release()
+
+    def limit(self, route):
+        return self.limits.get(route, self.default)
+
+    def take(self, route, callers, cost=1):
+        # seconds the caller should wait before trying again, 0 if the request may go ahead. Each of callers
+        # (e.g. the address and the user it claims to be) has its own bucket and every one is charged
+        limit = self.limit(route)
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        # a request bigger than the bucket goes through when the bucket is full
+        cost = min(cost, burst)
+        wait = max(self.take_one('%s %s' % (route, who), rate, burst, cost) for who in callers)
+        if wait:
+            self.count('limited')
+        return wait
+
+    def take_one(self, key, rate, burst, cost):
+        if self.shared is not None:
+            try:
+                return self.shared.take(key, rate, burst, cost)
+            except Exception as e:
+                self.count('shared_errors')
+                log.warning('Shared rate limit failed for %s, limiting in this process: %s', key, e)
+        return self.local.take(key, rate, burst, cost)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['inflight'] = self.inflight
+        stats['max_inflight'] = self.max_inflight
+        stats['buckets'] = len(self.local)
+        for route, limit in sorted(self.limits.items()):
+            if limit is not None:
+                name = re.sub(r'\W+', '_', route).strip('_')
+                stats['%s_per_second' % name], stats['%s_burst' % name] = limit
+        return stats
+
+def retry_after(wait):
+    return str(max(1, math.ceil(wait)))
+
+def parse_limit(text):
+    # "rate:burst", or off / 0 for no limit
+    if text.strip().lower() in ('off', '0', ''):
+        return None
+    rate, _, burst = text.partition(':')
+    rate = float(rate)
+    return rate, float(burst) if burst else max(1.0, rate)
+
+def from_env(env):
+    # RATE_LIMITS overrides routes, e.g. "/comments=0.5:5,/reports=off", and RATE_LIMIT_DEFAULT the other
+    # write routes ("rate:burst", tokens a second); RATE_LIMITS=off turns the per-user limits off.
+    # RATE_LIMIT_SHARED is a redis:// URL, "local" for the in-process stand-in, or unset for per-process buckets.
+    # MAX_INFLIGHT requests run at once per process (0 for no cap), the next waits ADMISSION_WAIT_MS for a slot
+    limits, default = dict(LIMITS), DEFAULT_LIMIT
+    configured = env.get('RATE_LIMITS', '').strip()
+    if configured.lower() == 'off':
+        limits, default = {}, None
+    else:
+        for item in configured.split(','):
+            if item.strip():
+                route, _, limit = item.partition('=')
+                limits[route.strip()] = parse_limit(limit)
+        if env.get('RATE_LIMIT_DEFAULT'):
+            default = parse_limit(env['RATE_LIMIT_DEFAULT'])
+    shared_url = env.get('RATE_LIMIT_SHARED')
+    if not shared_url:
+        shared = None
+    elif shared_url == 'local':
+        shared = LocalBuckets()
+    else:
+        shared = RedisBuckets(shared_url)
+    return RateLimiter(LocalBuckets(), shared, limits, default, int(env.get('MAX_INFLIGHT', 128)), float(env.get('ADMISSION_WAIT_MS', 50)) / 1000)
@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime, timezone
+import orjson
+from flask import make_response, request
+from werkzeug.http import http_date, parse_date, parse_etags
+
+# every JSON body goes through dumps: UUIDs as canonical strings, timestamps as ISO 8601 in UTC
+# (Scylla hands back naive UTC datetimes), anything else orjson doesn't know (e.g. Decimal) as str
+OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+def dumps(data):
+    return orjson.dumps(data, default=str, option=OPTIONS)
+
+def loads(data):
+    return orjson.loads(data)
+
+def etag(body):
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def timestamp(value):
+    # a datetime from a row, or the string it was encoded to in the shared cache
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value is None:
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def snippet_validators(snippet, view='full'):
+    # a snippet only changes through PUT or a moderation verdict, which both set UpdatedAt, so the validators
+    # come from those fields without serializing the body; each view is its own representation.
+    # Last-Modified is left off while the verdict is pending: it has whole seconds, and the verdict can
+    # land in the same second as the write
+    headers = {'ETag': etag(dumps([snippet['SnippetID'], snippet['UpdatedAt'], snippet['ModerationStatus']] + ([view] if view != 'full' else [])))}
+    updated = timestamp(snippet['UpdatedAt'])
+    if updated is not None and snippet['ModerationStatus'] != 'pending':
+        headers['Last-Modified'] = http_date(updated)
+    return headers
+
+def not_modified(headers, if_none_match, if_modified_since):
+    # headers holds the ETag / Last-Modified of the current representation,
+    # the other two are the raw request headers; If-None-Match wins when both are sent
+    if if_none_match:
+        return 'ETag' in headers and parse_etags(if_none_match).contains_weak(headers['ETag'].strip('"'))
+    if if_modified_since and 'Last-Modified' in headers:
+        since = parse_date(if_modified_since)
+        return since is not None and parse_date(headers['Last-Modified']) <= since
+    return False
+
+def request_not_modified(headers):
+    return not_modified(headers, request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'))
+
+def output_json(data, code, headers=None):
+    # flask_restful representation for application/json; successful GETs without validators of
+    # their own get an ETag over the body so pollers can revalidate for a 304
+    headers = dict(headers or {})
+    if code == 304:
+        response = make_response(b'', 304)
+    else:
+        body = dumps(data)
+        if code == 200 and request.method in ('GET', 'HEAD') and 'ETag' not in headers:
+            headers['ETag'] = etag(body)
+            if request_not_modified(headers):
+                body, code = b'', 304
+        response = make_response(body, code)
+        if code != 304:
+            response.mimetype = 'application/json'
+    response.headers.extend(headers)
+    return response
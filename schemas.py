@@ -0,0 +1,106 @@
+import uuid
+from datetime import datetime, timezone
+from flask import request
+from flask_restful import abort
+
+# request schemas are declared once per resource and compiled to a tuple of (name, convert, error, required, default);
+# parse() reads the JSON body once, falls back to the form and query string like reqparse did,
+# and reports every bad field in a single 400 of the form {"message": {"Field": "reason"}}
+
+MISSING = 'Missing required parameter in the JSON body or the post body or the query string'
+
+def _uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(value)
+
+def _text(value):
+    return value if isinstance(value, str) else str(value)
+
+def _int(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return int(value)
+
+def _timestamp(value):
+    # ISO 8601; naive UTC like the timestamps the driver hands back
+    value = datetime.fromisoformat(value)
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+UUID = (_uuid, 'Must be a UUID')
+TEXT = (_text, None)
+INT = (_int, 'Must be an integer')
+NUMBER = (float, 'Must be a number')
+TIMESTAMP = (_timestamp, 'Must be an ISO 8601 timestamp')
+
+class Optional():
+    def __init__(self, kind, default=None):
+        self.kind = kind
+        self.default = default
+
+class _Form():
+    # request.values parses the form on first access, so it is only touched for fields the JSON body lacks
+    def get(self, name):
+        return request.values.get(name)
+
+FORM = _Form()
+
+class Schema():
+    # Schema(SnippetID=UUID, Title=TEXT, fetch_size=Optional(INT, 25), location='args')
+    def __init__(self, location='body', **fields):
+        self.location = location
+        compiled = []
+        for name, kind in fields.items():
+            required, default = True, None
+            if isinstance(kind, Optional):
+                required, default, kind = False, kind.default, kind.kind
+            convert, error = kind
+            compiled.append((name, convert, error, required, default))
+        self.fields = tuple(compiled)
+
+    def sources(self):
+        if self.location == 'args':
+            return (request.args,)
+        body = request.get_json(silent=True)
+        return (body, FORM) if isinstance(body, dict) else (FORM,)
+
+    def validate(self, *sources):
+        # returns (args, errors) without aborting, for callers that report per item
+        args, errors = {}, {}
+        for name, convert, error, required, default in self.fields:
+            value = None
+            for source in sources:
+                value = source.get(name)
+                if value is not None:
+                    break
+            if value is None:
+                if required:
+                    errors[name] = MISSING
+                else:
+                    args[name] = default
+                continue
+            try:
+                args[name] = convert(value)
+            except (TypeError, ValueError):
+                errors[name] = error or 'Invalid value'
+        return args, errors
+
+    def parse(self):
+        args, errors = self.validate(*self.sources())
+        if errors:
+            abort(400, message=errors)
+        return args
+
+def id_errors(values):
+    # path segments named *_id must be UUIDs
+    return dict((name, UUID[1]) for name, value in values.items() if name.endswith('_id') and not valid_uuid(value))
+
+def check_ids(values):
+    errors = id_errors(values)
+    if errors:
+        abort(400, message=errors)
+
+def valid_uuid(value):
+    try:
+        uuid.UUID(value)
+    except (TypeError, ValueError):
+        return False
+    return True
@@ -0,0 +1,218 @@
+import contextlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import content
+
+log = logging.getLogger(__name__)
+
+# full-text index over snippet Title, Content, Language and tag names, kept in SQLite FTS5 so it lives on
+# disk and is shared by every worker process on the host. docs holds one narrow row per snippet for the
+# lang and tag filters (doc_tags), which would be slow as FTS terms since popular ones match most snippets;
+# docs_fts holds the text, under the same rowid. A snippet whose text is hidden (flagged by moderation,
+# or tagged before its verdict came in) keeps its docs row and tags but has no text indexed
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, snippet_id TEXT UNIQUE NOT NULL, title TEXT, language TEXT, tags TEXT NOT NULL DEFAULT '')",
+    "CREATE INDEX IF NOT EXISTS docs_language ON docs (language COLLATE NOCASE, id)",
+    "CREATE TABLE IF NOT EXISTS doc_tags (tag TEXT COLLATE NOCASE NOT NULL, doc_id INTEGER NOT NULL, PRIMARY KEY (tag, doc_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS doc_tags_doc ON doc_tags (doc_id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(title, content, language, tags, tokenize=\"unicode61 tokenchars '_'\")",
+    # a title match counts ten times a content match, language and tags twice
+    "INSERT INTO docs_fts (docs_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 2.0, 2.0)')",
+]
+
+TOKEN = re.compile(r'\w+')
+MAX_TERMS = 16
+TAG_SEPARATOR = '\n'
+
+def _quote(text):
+    return '"%s"' % text.replace('"', '""')
+
+class Store():
+    # a SQLite database shared by the worker processes on this host, created from schema on first use;
+    # ":memory:" keeps it in this process only, e.g. for the benchmark
+    schema = []
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writer = threading.Lock()
+        self.anchor = None
+        self.pid = None
+
+    def connection(self):
+        # one connection per thread, opened again in a forked worker; an in-memory index has just the one
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.pid == os.getpid():
+            return conn
+        with self.lock:
+            if self.pid != os.getpid():
+                self.local = threading.local()
+                self.anchor = self.open()
+                for statement in self.schema:
+                    self.anchor.execute(statement)
+                self.pid = os.getpid()
+        conn = self.local.conn = self.anchor if self.path == ':memory:' else self.open()
+        return conn
+
+    def open(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        if self.path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        with self.writer:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+class SearchIndex(Store):
+    schema = SCHEMA
+
+    def __init__(self, path, candidates=500):
+        Store.__init__(self, path)
+        self.candidates = candidates
+
+    def index(self, snippet_id, title, content, language):
+        with self.transaction() as conn:
+            doc_id, tags = conn.execute(
+                "INSERT INTO docs (snippet_id, title, language) VALUES (?, ?, ?) "
+                "ON CONFLICT (snippet_id) DO UPDATE SET title=excluded.title, language=excluded.language RETURNING id, tags",
+                (str(snippet_id), title, language)).fetchone()
+            conn.execute("DELETE FROM docs_fts WHERE rowid=?", (doc_id,))
+            conn.execute("INSERT INTO docs_fts (rowid, title, content, language, tags) VALUES (?, ?, ?, ?, ?)", (doc_id, title, content, language, tags))
+
+    def hide(self, snippet_id):
+        with self.transaction() as conn:
+            row = conn.execute("UPDATE docs SET title=NULL, language=NULL WHERE snippet_id=? RETURNING id", (str(snippet_id),)).fetchone()
+            if row:
+                conn.execute("DELETE FROM docs_fts WHERE rowid=?", row)
+
+    def remove(self, snippet_id):
+        with self.transaction() as conn:
+            row = conn.execute("DELETE FROM docs WHERE snippet_id=? RETURNING id", (str(snippet_id),)).fetchone()
+            if row:
+                conn.execute("DELETE FROM docs_fts WHERE rowid=?", row)
+                conn.execute("DELETE FROM doc_tags WHERE doc_id=?", row)
+
+    def retag(self, snippet_id, change):
+        # change(tags) returns the new list of tag names for the snippet
+        with self.transaction() as conn:
+            row = conn.execute("SELECT id, tags FROM docs WHERE snippet_id=?", (str(snippet_id),)).fetchone()
+            tags = change([tag for tag in (row[1] if row else '').split(TAG_SEPARATOR) if tag])
+            if row is None:
+                doc_id = conn.execute("INSERT INTO docs (snippet_id, tags) VALUES (?, ?)", (str(snippet_id), TAG_SEPARATOR.join(tags))).lastrowid
+            else:
+                doc_id = row[0]
+                conn.execute("UPDATE docs SET tags=? WHERE id=?", (TAG_SEPARATOR.join(tags), doc_id))
+                conn.execute("UPDATE docs_fts SET tags=? WHERE rowid=?", (TAG_SEPARATOR.join(tags), doc_id))
+                conn.execute("DELETE FROM doc_tags WHERE doc_id=?", (doc_id,))
+            conn.executemany("INSERT OR IGNORE INTO doc_tags (tag, doc_id) VALUES (?, ?)", [(tag, doc_id) for tag in tags])
+
+    def add_tag(self, snippet_id, name):
+        self.retag(snippet_id, lambda tags: tags if name in tags else tags + [name])
+
+    def remove_tag(self, snippet_id, name):
+        self.retag(snippet_id, lambda tags: [tag for tag in tags if tag != name])
+
+    def rename_tag(self, old, new):
+        # new=None drops the tag everywhere
+        rows = self.connection().execute("SELECT d.snippet_id FROM doc_tags t JOIN docs d ON d.id = t.doc_id WHERE t.tag = ?", (old,)).fetchall()
+        for (snippet_id,) in rows:
+            self.retag(snippet_id, lambda tags: [new if tag == old else tag for tag in tags if tag != old or new is not None])
+
+    def search(self, q='', language=None, tag=None, limit=25, offset=0):
+        # returns [(snippet_id, title, language, score)] best first; at least one of q, language or tag is needed.
+        # bm25 has to score every match, so only the newest self.candidates matches that pass the filters
+        # are ranked: a query costs about the same on a million snippets as on a thousand.
+        # Without q, results are simply newest first
+        words = [_quote(word) for word in TOKEN.findall(q.lower())][:MAX_TERMS]
+        if q.strip() and not words:
+            return []
+        filters, params = ['d.title IS NOT NULL'], []
+        if language:
+            filters.append('d.language = ? COLLATE NOCASE')
+            params.append(language)
+        if words:
+            if tag:
+                filters.append('EXISTS (SELECT 1 FROM doc_tags t WHERE t.tag = ? AND t.doc_id = d.id)')
+                params.append(tag)
+            sql = ("SELECT * FROM (SELECT d.snippet_id, d.title, d.language, -docs_fts.rank AS score "
+                "FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid WHERE docs_fts MATCH ? AND %s "
+                "ORDER BY docs_fts.rowid DESC LIMIT ?) ORDER BY score DESC LIMIT ? OFFSET ?") % ' AND '.join(filters)
+            params = [' AND '.join(words)] + params + [self.candidates]
+        elif tag:
+            sql = ("SELECT d.snippet_id, d.title, d.language, 0.0 FROM doc_tags t JOIN docs d ON d.id = t.doc_id "
+                "WHERE t.tag = ? AND %s ORDER BY t.doc_id DESC LIMIT ? OFFSET ?") % ' AND '.join(filters)
+            params = [tag] + params
+        else:
+            sql = "SELECT d.snippet_id, d.title, d.language, 0.0 FROM docs d WHERE %s ORDER BY d.id DESC LIMIT ? OFFSET ?" % ' AND '.join(filters)
+        params.extend([limit, offset])
+        return self.connection().execute(sql, params).fetchall()
+
+    def facets(self, snippet_id):
+        # (language, tags) of a searchable snippet, None while it is pending, hidden or unknown
+        row = self.connection().execute("SELECT language, tags FROM docs WHERE snippet_id=? AND title IS NOT NULL", (str(snippet_id),)).fetchone()
+        return (row[0], [tag for tag in row[1].split(TAG_SEPARATOR) if tag]) if row else None
+
+    def titles(self, snippet_ids):
+        # {snippet_id: (title, language)} for the searchable ones among snippet_ids
+        snippet_ids = [str(snippet_id) for snippet_id in snippet_ids]
+        rows = self.connection().execute(
+            "SELECT snippet_id, title, language FROM docs WHERE title IS NOT NULL AND snippet_id IN (%s)" % ','.join('?' * len(snippet_ids)), snippet_ids)
+        return dict((snippet_id, (title, language)) for snippet_id, title, language in rows)
+
+    def stats(self):
+        indexed, hidden = self.connection().execute("SELECT count(title), count(*) - count(title) FROM docs").fetchone()
+        return {'indexed': indexed, 'hidden': hidden}
+
+    def rebuild(self, queries):
+        # reindexes every approved snippet from Scylla, for a new host or an index that fell behind. A pending
+        # one only gets its hidden docs row and tags, as a tag added before its verdict leaves it; the verdict
+        # fills in the text
+        names = dict((row.tagid, row.tagname) for row in queries.execute('scan_tags'))
+        tags = {}
+        for row in queries.execute('scan_snippettags'):
+            if row.tagid in names:
+                tags.setdefault(row.snippetid, []).append(names[row.tagid])
+        count = 0
+        with self.transaction() as conn:
+            for table in ('docs', 'docs_fts', 'doc_tags'):
+                conn.execute("DELETE FROM %s" % table)
+            for row, text in content.ContentStore(queries).scan():
+                if row.moderationstatus == 'flagged':
+                    continue
+                snippet_tags = tags.get(row.snippetid, [])
+                if row.moderationstatus == 'pending':
+                    doc_id = conn.execute("INSERT INTO docs (snippet_id, tags) VALUES (?, ?)", (str(row.snippetid), TAG_SEPARATOR.join(snippet_tags))).lastrowid
+                else:
+                    doc_id = conn.execute("INSERT INTO docs (snippet_id, title, language, tags) VALUES (?, ?, ?, ?)",
+                        (str(row.snippetid), row.title, row.language, TAG_SEPARATOR.join(snippet_tags))).lastrowid
+                    conn.execute("INSERT INTO docs_fts (rowid, title, content, language, tags) VALUES (?, ?, ?, ?, ?)",
+                        (doc_id, row.title, text, row.language, TAG_SEPARATOR.join(snippet_tags)))
+                    count += 1
+                conn.executemany("INSERT OR IGNORE INTO doc_tags (tag, doc_id) VALUES (?, ?)", [(tag, doc_id) for tag in snippet_tags])
+        return count
+
+def from_env(env):
+    # SEARCH_INDEX is the SQLite file shared by the workers on this host, or ":memory:";
+    # SEARCH_CANDIDATES is how many of the newest matches are ranked
+    return SearchIndex(env.get('SEARCH_INDEX', 'search.db'), int(env.get('SEARCH_CANDIDATES', 500)))
+
+if __name__ == '__main__':
+    # python search.py rebuilds the index from Scylla
+    import db
+    from queries import QueryRegistry
+    count = from_env(os.environ).rebuild(QueryRegistry(db.session))
+    print('Indexed %d snippets.' % count)
@@ -0,0 +1,191 @@
+import argparse
+import hashlib
+import heapq
+import json
+import multiprocessing
+import operator
+import os
+import random
+import re
+import struct
+import zlib
+import content
+from search import Store
+
+# near-duplicate detection over snippet Content. A snippet's fingerprint is a MinHash signature of the set
+# of its 3-word shingles (lower-cased words, so spacing and case don't count): PERMUTATIONS minimums, and
+# the share of positions two signatures agree on estimates the Jaccard similarity of their shingle sets.
+# The signature is also cut into BANDS bands of ROWS values and each band hashed to a bucket (LSH): only
+# snippets sharing a bucket are compared, so a lookup reads a few index entries rather than every snippet.
+# With 32 bands of 4, a pair at 0.5 similarity shares a bucket 87% of the time, at 0.8 always, at 0.3 23%.
+# A long snippet is signed from the MAX_SHINGLES of its shingles with the lowest CRC only: the sample is
+# picked by hash, so two long snippets keep the same shingles where they overlap and still compare the same
+# way, and only the sample goes through blake2b and the PERMUTATIONS x MAX_SHINGLES XORs
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS fingerprints (id INTEGER PRIMARY KEY, snippet_id TEXT UNIQUE NOT NULL, signature BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, key INTEGER NOT NULL, doc_id INTEGER NOT NULL, PRIMARY KEY (band, key, doc_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS buckets_doc ON buckets (doc_id)",
+]
+
+PERMUTATIONS = 128
+BANDS, ROWS = 32, 4
+SHINGLE = 3
+MAX_SHINGLES = 2048
+# a bucket as common as boilerplate can get is only read this far, newest first
+BUCKET_LIMIT = 1000
+WORD = re.compile(r'\w+')
+# each permutation XORs the 64-bit shingle hash with its own mask; the minimum is kept to 32 bits
+MASKS = [random.Random(seed).getrandbits(64) for seed in range(PERMUTATIONS)]
+LOW = 0xFFFFFFFF
+PACK = struct.Struct('<%dI' % PERMUTATIONS)
+
+def shingles(text):
+    words = WORD.findall(text.lower())
+    if len(words) <= SHINGLE:
+        return {' '.join(words)} if words else set()
+    return set(' '.join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1))
+
+def signature(text):
+    # None for text without a word in it
+    sample = [shingle.encode() for shingle in shingles(text or '')]
+    if len(sample) > MAX_SHINGLES:
+        sample = heapq.nsmallest(MAX_SHINGLES, sample, key=zlib.crc32)
+    hashes = [int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'little') for shingle in sample]
+    if not hashes:
+        return None
+    return tuple(min(map(mask.__xor__, hashes)) & LOW for mask in MASKS)
+
+def bands(sig):
+    packed = PACK.pack(*sig)
+    width = ROWS * 4
+    return [(band, int.from_bytes(hashlib.blake2b(packed[band * width:(band + 1) * width], digest_size=8).digest(), 'little', signed=True))
+        for band in range(BANDS)]
+
+def similarity(a, b):
+    return sum(map(operator.eq, a, b)) / PERMUTATIONS
+
+def _fingerprint(item):
+    snippet_id, content = item
+    return snippet_id, signature(content)
+
+class SimilarityIndex(Store):
+    schema = SCHEMA
+
+    def __init__(self, path, candidates=200):
+        # at most candidates snippets sharing buckets with a signature are compared with it in full
+        Store.__init__(self, path)
+        self.candidates = candidates
+
+    def add(self, snippet_id, sig):
+        with self.transaction() as conn:
+            self.insert(conn, str(snippet_id), sig)
+
+    def insert(self, conn, snippet_id, sig):
+        doc_id = conn.execute(
+            "INSERT INTO fingerprints (snippet_id, signature) VALUES (?, ?) ON CONFLICT (snippet_id) DO UPDATE SET signature=excluded.signature RETURNING id",
+            (snippet_id, PACK.pack(*sig))).fetchone()[0]
+        conn.execute("DELETE FROM buckets WHERE doc_id=?", (doc_id,))
+        conn.executemany("INSERT OR IGNORE INTO buckets (band, key, doc_id) VALUES (?, ?, ?)", [(band, key, doc_id) for band, key in bands(sig)])
+
+    def remove(self, snippet_id):
+        with self.transaction() as conn:
+            row = conn.execute("DELETE FROM fingerprints WHERE snippet_id=? RETURNING id", (str(snippet_id),)).fetchone()
+            if row:
+                conn.execute("DELETE FROM buckets WHERE doc_id=?", row)
+
+    def matches(self, sig, threshold, exclude=None):
+        # [(snippet_id, similarity)] at or above threshold, most similar first, for a signature that needn't be indexed
+        keys = bands(sig)
+        per_band = "SELECT doc_id FROM (SELECT doc_id FROM buckets WHERE band=? AND key=? ORDER BY doc_id DESC LIMIT %d)" % BUCKET_LIMIT
+        rows = self.connection().execute(
+            "SELECT f.snippet_id, f.signature FROM fingerprints f JOIN (SELECT doc_id, count(*) AS shared FROM (%s) "
+            "GROUP BY doc_id ORDER BY shared DESC LIMIT ?) c ON c.doc_id = f.id" % ' UNION ALL '.join([per_band] * len(keys)),
+            [value for key in keys for value in key] + [self.candidates])
+        found = []
+        for snippet_id, blob in rows:
+            if snippet_id != exclude:
+                score = similarity(sig, PACK.unpack(blob))
+                if score >= threshold:
+                    found.append((snippet_id, score))
+        found.sort(key=lambda item: item[1], reverse=True)
+        return found
+
+    def similar(self, snippet_id, threshold):
+        # matches for an indexed snippet, None if it isn't
+        row = self.connection().execute("SELECT signature FROM fingerprints WHERE snippet_id=?", (str(snippet_id),)).fetchone()
+        if row is None:
+            return None
+        return self.matches(PACK.unpack(row[0]), threshold, str(snippet_id))
+
+    def stats(self):
+        return {'fingerprints': self.connection().execute("SELECT count(*) FROM fingerprints").fetchone()[0]}
+
+    def rebuild(self, queries, processes=None):
+        # fingerprints every snippet in Scylla, hashing in worker processes while the scan pages in
+        rows = ((str(row.snippetid), text) for row, text in content.ContentStore(queries).scan())
+        count = 0
+        pool = multiprocessing.get_context('spawn').Pool(processes) if processes != 1 else None
+        try:
+            fingerprints = pool.imap(_fingerprint, rows, chunksize=256) if pool else map(_fingerprint, rows)
+            with self.transaction() as conn:
+                conn.execute("DELETE FROM fingerprints")
+                conn.execute("DELETE FROM buckets")
+                for snippet_id, sig in fingerprints:
+                    if sig is not None:
+                        self.insert(conn, snippet_id, sig)
+                        count += 1
+        finally:
+            if pool:
+                pool.terminate()
+        return count
+
+    def duplicates(self, threshold):
+        # groups of snippet ids that are near-duplicates of each other, largest first. Each bucket holding
+        # more than one snippet is read once, and its members are compared with its first one
+        conn = self.connection()
+        parent = {}
+
+        def root(doc_id):
+            while parent.get(doc_id, doc_id) != doc_id:
+                parent[doc_id] = parent.get(parent[doc_id], parent[doc_id])
+                doc_id = parent[doc_id]
+            return doc_id
+
+        buckets = conn.execute("SELECT group_concat(doc_id) FROM buckets GROUP BY band, key HAVING count(*) > 1")
+        for (members,) in buckets:
+            doc_ids = [int(doc_id) for doc_id in members.split(',')][:BUCKET_LIMIT]
+            signatures = dict((doc_id, PACK.unpack(blob)) for doc_id, blob in conn.execute(
+                "SELECT id, signature FROM fingerprints WHERE id IN (%s)" % ','.join('?' * len(doc_ids)), doc_ids))
+            first = doc_ids[0]
+            for doc_id in doc_ids[1:]:
+                if root(doc_id) != root(first) and similarity(signatures[first], signatures[doc_id]) >= threshold:
+                    parent[root(doc_id)] = root(first)
+        groups = {}
+        for doc_id in parent:
+            groups.setdefault(root(doc_id), set([root(doc_id)])).add(doc_id)
+        names = {}
+        for doc_ids in groups.values():
+            names.update(conn.execute("SELECT id, snippet_id FROM fingerprints WHERE id IN (%s)" % ','.join('?' * len(doc_ids)), list(doc_ids)))
+        return sorted(([names[doc_id] for doc_id in sorted(doc_ids)] for doc_ids in groups.values()), key=len, reverse=True)
+
+def from_env(env):
+    # SIMILAR_INDEX is the SQLite file shared by the workers on this host, or ":memory:";
+    # SIMILAR_CANDIDATES is how many bucket-sharing snippets are compared in full per lookup
+    return SimilarityIndex(env.get('SIMILAR_INDEX', 'similar.db'), int(env.get('SIMILAR_CANDIDATES', 200)))
+
+if __name__ == '__main__':
+    # python similar.py fingerprints every snippet in Scylla and reports the near-duplicates among them
+    parser = argparse.ArgumentParser(description='Fingerprint the existing snippets and group the near-duplicates')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes hashing content, 1 to run in this one')
+    parser.add_argument('--threshold', type=float, default=float(os.environ.get('DUPLICATE_THRESHOLD', 0.85)), help='estimated Jaccard similarity')
+    parser.add_argument('--out', help='file to write the groups to as JSON')
+    args = parser.parse_args()
+    import db
+    from queries import QueryRegistry
+    index = from_env(os.environ)
+    print('Fingerprinted %d snippets.' % index.rebuild(QueryRegistry(db.session), args.processes))
+    groups = index.duplicates(args.threshold)
+    print('%d groups of near-duplicates, %d snippets that repeat another.' % (len(groups), sum(len(group) - 1 for group in groups)))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(groups, f, indent=4)
@@ -1,6 +1,7 @@
 import requests
 import uuid
 import json
+import time
 
 # Base URL of the Flask application
 BASE_URL = "http://127.0.0.1:5000"
@@ -19,6 +20,25 @@ def test_get_user(user_id):
     assert response.json()["Username"] == "test"
     assert response.json()["Email"] == "test@gmail.com"
 
+def test_metrics(user_id):
+    # A request shows up in /metrics: its route's request count goes up and its latency is recorded
+    series = 'devspace_request_duration_seconds_%s{method="GET",route="/users/<string:user_id>",status="200"'
+
+    def count():
+        for line in requests.get(BASE_URL + "/metrics").text.splitlines():
+            if line.startswith(series % "count"):
+                return float(line.split()[-1])
+        return 0.0
+
+    before = count()
+    test_get_user(user_id)
+    response = requests.get(BASE_URL + "/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert count() == before + 1
+    assert series % "sum" in response.text
+    assert (series % "bucket") + ',le="+Inf"}' in response.text
+
 def test_update_user(user_id):
     # Update the user
     response = requests.put(BASE_URL + "/users/" + user_id, json={"Username": "test2", "Email": "test2@gmail.com", "PasswordHash": "12345678"})
@@ -41,6 +61,29 @@ def test_create_snippet(user_id):
     snippet_id = response.json()["SnippetID"]
     return snippet_id
 
+def test_list_user_snippets(user_id, snippet_id):
+    # The new snippet is listed under its author
+    response = requests.get(BASE_URL + "/users/" + user_id + "/snippets")
+    assert response.status_code == 200
+    assert snippet_id in [s["SnippetID"] for s in response.json()["Snippets"]]
+
+def test_page_user_snippets(user_id, snippet_id):
+    # Page through the user's snippets one at a time with the returned cursor
+    extra = [test_create_snippet(user_id) for _ in range(2)]
+    seen = []
+    params = {"user": user_id, "fetch_size": 1}
+    while True:
+        response = requests.get(BASE_URL + "/snippets", params=params)
+        assert response.status_code == 200
+        assert len(response.json()["Snippets"]) <= 1
+        seen += [s["SnippetID"] for s in response.json()["Snippets"]]
+        if not response.json()["NextCursor"]:
+            break
+        params["cursor"] = response.json()["NextCursor"]
+    assert set([snippet_id] + extra) <= set(seen)
+    for extra_id in extra:
+        requests.delete(BASE_URL + "/snippets/" + extra_id)
+
 def test_get_snippet(snippet_id):
     # Get the snippet
     response = requests.get(BASE_URL + "/snippets/" + snippet_id)
@@ -49,6 +92,69 @@ def test_get_snippet(snippet_id):
     assert response.json()["Content"] == "test"
     assert response.json()["Language"] == "test"
 
+def test_get_snippet_bad_id():
+    # An id that isn't a UUID is the client's mistake, 400 and not a 500
+    response = requests.get(BASE_URL + "/snippets/not-a-uuid")
+    assert response.status_code == 400
+    response = requests.get(BASE_URL + "/snippets/not-a-uuid/comments")
+    assert response.status_code == 400
+
+def test_snippet_content(user_id):
+    # Large content is stored once for identical snippets, previewed without the content, and streamed on its own
+    text = "".join("line %d of a large snippet\n" % i for i in range(10000))
+    snippet_ids = []
+    for _ in range(2):
+        response = requests.post(BASE_URL + "/snippets", json={"UserID": user_id, "Title": "large", "Content": text, "Language": "text"})
+        assert response.status_code == 201
+        snippet_ids.append(response.json()["SnippetID"])
+    previews = [requests.get(BASE_URL + "/snippets/" + i, params={"view": "preview"}).json() for i in snippet_ids]
+    assert previews[0]["ContentHash"] == previews[1]["ContentHash"]
+    assert "Content" not in previews[0]
+    assert text.startswith(previews[0]["Preview"]) and previews[0]["ContentSize"] == len(text.encode())
+    response = requests.get(BASE_URL + "/snippets/" + snippet_ids[0])
+    assert response.json()["Content"] == text
+    response = requests.get(BASE_URL + "/snippets/" + snippet_ids[0] + "/content")
+    assert response.status_code == 200
+    assert response.text == text
+    response = requests.get(BASE_URL + "/snippets/" + snippet_ids[0] + "/content", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    response = requests.get(BASE_URL + "/snippets/" + snippet_ids[0], params={"view": "nope"})
+    assert response.status_code == 400
+    for snippet_id in snippet_ids:
+        test_delete_snippet(snippet_id)
+
+def test_snippet_moderation(snippet_id):
+    # New snippets are readable while moderation runs in the background
+    response = requests.get(BASE_URL + "/moderation/snippets/" + snippet_id)
+    assert response.status_code == 200
+    assert response.json()["ModerationStatus"] in ("pending", "approved")
+    response = requests.get(BASE_URL + "/moderation/stats")
+    assert response.status_code == 200
+    assert "pending" in response.json() and "lag" in response.json()
+
+def test_snippet_conditional_get(user_id):
+    # A snippet's ETag and Last-Modified answer a repeated GET with 304 until the snippet changes
+    response = requests.post(BASE_URL + "/snippets", json={"UserID": user_id, "Title": "cached", "Content": "cached", "Language": "text"})
+    snippet_id = response.json()["SnippetID"]
+    for _ in range(50):
+        if requests.get(BASE_URL + "/moderation/snippets/" + snippet_id).json()["ModerationStatus"] == "approved":
+            break
+        time.sleep(0.1)
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id)
+    assert response.status_code == 200
+    etag, modified = response.headers["ETag"], response.headers["Last-Modified"]
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id, headers={"If-Modified-Since": modified})
+    assert response.status_code == 304
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id, params={"view": "preview"}, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    requests.put(BASE_URL + "/snippets/" + snippet_id, json={"UserID": user_id, "Title": "cached", "Content": "changed", "Language": "text"})
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["Content"] == "changed"
+    test_delete_snippet(snippet_id)
+
 def test_update_snippet(snippet_id, user_id):
     # Update the snippet
     response = requests.put(BASE_URL + "/snippets/" + snippet_id, json={"UserID": user_id, "Title": "test2", "Content": "test2", "Language": "test2"})
@@ -65,6 +171,13 @@ def test_delete_snippet(snippet_id):
     response = requests.get(BASE_URL + "/snippets/" + snippet_id)
     assert response.status_code == 404
 
+def test_cache_stats(snippet_id):
+    # A repeated read is served from the cache
+    before = requests.get(BASE_URL + "/cache/stats").json()
+    test_get_snippet(snippet_id)
+    after = requests.get(BASE_URL + "/cache/stats").json()
+    assert after["hits"] > before["hits"]
+
 def test_create_tag():
     # Create a new tag
     response = requests.post(BASE_URL + "/tags", json={"Name": "test"})
@@ -85,6 +198,19 @@ def test_update_tag(tag_id):
     response = requests.get(BASE_URL + "/tags/" + tag_id)
     assert response.json()["Name"] == "test2"
 
+def test_idempotent_create():
+    # A retried POST with the same Idempotency-Key gets the first response back instead of creating a second tag
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    first = requests.post(BASE_URL + "/tags", json={"Name": "once"}, headers=headers)
+    assert first.status_code == 201
+    retry = requests.post(BASE_URL + "/tags", json={"Name": "once"}, headers=headers)
+    assert retry.status_code == 201
+    assert retry.json()["TagID"] == first.json()["TagID"]
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    response = requests.post(BASE_URL + "/tags", json={"Name": "other"}, headers=headers)
+    assert response.status_code == 422
+    test_delete_tag(first.json()["TagID"])
+
 def test_delete_tag(tag_id):
     # Delete the tag
     response = requests.delete(BASE_URL + "/tags/" + tag_id)
@@ -97,11 +223,134 @@ def test_create_snippet_tag(snippet_id, tag_id):
     response = requests.post(BASE_URL + "/snippettags", json={"SnippetID": snippet_id, "TagID": tag_id})
     assert response.status_code == 201
 
+def test_list_snippet_tags(snippet_id, tag_id):
+    # The tag is listed on the snippet and the snippet under the tag
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/tags")
+    assert response.status_code == 200
+    assert tag_id in [t["TagID"] for t in response.json()["SnippetTags"]]
+    response = requests.get(BASE_URL + "/tags/" + tag_id + "/snippets")
+    assert response.status_code == 200
+    assert snippet_id in [t["SnippetID"] for t in response.json()["SnippetTags"]]
+
 def test_delete_snippet_tag(snippet_id, tag_id):
     # Delete the snippet tag
     response = requests.delete(BASE_URL + "/snippettags/" + snippet_id + "/" + tag_id)
     assert response.status_code == 200
 
+def test_search_snippets(snippet_id):
+    # The snippet is searchable by text, language and tag once moderation has approved it
+    for _ in range(50):
+        if requests.get(BASE_URL + "/moderation/snippets/" + snippet_id).json()["ModerationStatus"] == "approved":
+            break
+        time.sleep(0.1)
+    for params in [{"q": "test2"}, {"q": "test2", "lang": "test2"}, {"tag": "test2"}]:
+        response = requests.get(BASE_URL + "/search", params=params)
+        assert response.status_code == 200
+        assert snippet_id in [s["SnippetID"] for s in response.json()["Snippets"]]
+    response = requests.get(BASE_URL + "/search", params={"q": "test2", "lang": "nolanguage"})
+    assert snippet_id not in [s["SnippetID"] for s in response.json()["Snippets"]]
+    response = requests.get(BASE_URL + "/search")
+    assert response.status_code == 400
+
+def test_similar_snippets(snippet_id, user_id):
+    # Reposting the same content lists the original as a near-duplicate, and each shows up as similar to the other
+    response = requests.post(BASE_URL + "/snippets", json={"UserID": user_id, "Title": "copy", "Content": "test2", "Language": "test2"})
+    assert response.status_code == 201
+    assert snippet_id in response.json()["NearDuplicates"]
+    copy_id = response.json()["SnippetID"]
+    response = requests.get(BASE_URL + "/snippets/" + copy_id + "/similar")
+    assert response.status_code == 200
+    assert snippet_id in [s["SnippetID"] for s in response.json()["Snippets"]]
+    response = requests.get(BASE_URL + "/snippets/" + str(uuid.uuid4()) + "/similar")
+    assert response.status_code == 404
+    test_delete_snippet(copy_id)
+
+def test_bulk_snippet_tags(snippet_id):
+    # Create tags and link them to the snippet in bulk, one bad item is reported on its own
+    response = requests.post(BASE_URL + "/tags/bulk", json={"Items": [{"Name": "bulk1"}, {"Name": "bulk2"}]})
+    assert response.status_code == 201
+    tag_ids = [r["TagID"] for r in response.json()["Results"]]
+    response = requests.get(BASE_URL + "/tags", params={"ids": ",".join(tag_ids)})
+    assert response.status_code == 200
+    assert [t["Name"] for t in response.json()["Tags"]] == ["bulk1", "bulk2"]
+    items = [{"SnippetID": snippet_id, "TagID": tag_id} for tag_id in tag_ids] + [{"SnippetID": snippet_id, "TagID": "not-a-uuid"}]
+    response = requests.post(BASE_URL + "/snippettags/bulk", json={"Items": items})
+    assert response.status_code == 207
+    assert [r["Status"] for r in response.json()["Results"]] == [201, 201, 400]
+    for tag_id in tag_ids:
+        test_delete_snippet_tag(snippet_id, tag_id)
+        test_delete_tag(tag_id)
+
+def test_bulk_get_snippets(snippet_id):
+    # Fetch several snippets by id in one request
+    missing_id = str(uuid.uuid4())
+    response = requests.get(BASE_URL + "/snippets", params={"ids": snippet_id + "," + missing_id})
+    assert response.status_code == 200
+    assert [s["SnippetID"] for s in response.json()["Snippets"]] == [snippet_id]
+    assert response.json()["Missing"] == [missing_id]
+
+def test_write_behind_spill():
+    # A write-behind buffer whose process dies leaves its spill behind, and the next one replays only the
+    # events that were neither flushed nor discarded (runs on the write-behind module, no server needed)
+    import os
+    import tempfile
+    import writebehind
+    spill = tempfile.mkdtemp()
+    written, replayed = [], []
+    buffer = writebehind.WriteBehindBuffer(written.extend, spill, "test", max_events=3, flush_interval=3600)
+    for i in range(3):
+        buffer.add({"ID": i})
+    for _ in range(100):
+        if buffer.stats()["flushed"] == 3:
+            break
+        time.sleep(0.01)
+    assert written == [{"ID": 0}, {"ID": 1}, {"ID": 2}]
+    buffer.add({"ID": 3})
+    buffer.add({"ID": 4})
+    buffer.discard("ID", 4)
+    assert buffer.stats()["pending"] == 1
+    # the spill as a crashed process leaves it: under a pid that no longer runs
+    for name in os.listdir(spill):
+        os.rename(os.path.join(spill, name), os.path.join(spill, name.replace("-%d-" % os.getpid(), "-999999999-")))
+    after = writebehind.WriteBehindBuffer(replayed.extend, spill, "test", max_events=3, flush_interval=3600)
+    after.start()
+    assert after.stats()["replayed"] == 1
+    after.flush()
+    assert replayed == [{"ID": 3}]
+    assert [name for name in os.listdir(spill) if "-999999999-" in name] == []
+
+def test_transfer_round_trip():
+    # transfer.py exports tables and imports them back, rows with what was left of their TTL and counters as
+    # increments (runs on bench/fake_session.py, no server or cluster needed; the connection is handed back after)
+    import argparse
+    import tempfile
+    from datetime import datetime
+    import db
+    import transfer
+    from bench import fake_session
+    saved = db.connection.current, db.connection.pid
+    session = fake_session.install(db.connection)
+    try:
+        kept, lasting, snippet_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        insert = session.prepare("INSERT INTO Devspace.Reports (ReportID, SnippetID, UserID, Reason, CreatedAt) VALUES (?, ?, ?, ?, ?) USING TTL ?")
+        session.execute(insert, (kept, snippet_id, uuid.uuid4(), "spam", datetime(2024, 5, 1, 12, 0), 3600))
+        session.execute(insert, (lasting, snippet_id, uuid.uuid4(), "off topic", datetime(2024, 5, 1, 12, 1), 0))
+        session.execute(session.prepare("UPDATE Devspace.SnippetStats SET Count = Count + ? WHERE SnippetID=? AND Type=?"), (3, snippet_id, "like"))
+        directory = tempfile.mkdtemp()
+        transfer.export(argparse.Namespace(out=directory, tables=["reports", "snippetstats"], format="jsonl", splits=4, fetch_size=1, processes=1))
+        session.execute("TRUNCATE Devspace.Reports")
+        session.execute("TRUNCATE Devspace.SnippetStats")
+        assert transfer.load(argparse.Namespace(input=directory, tables=None, concurrency=8, processes=1)) == 0
+        rows = dict((row.reportid, row) for row in session.execute("SELECT ReportID, Reason, CreatedAt, TTL(Reason) FROM Devspace.Reports"))
+        assert sorted(rows) == sorted([kept, lasting])
+        # timestamps are exported as UTC
+        assert rows[kept].reason == "spam" and rows[kept].createdat.replace(tzinfo=None) == datetime(2024, 5, 1, 12, 0)
+        assert 3500 < rows[kept][3] <= 3600
+        assert rows[lasting][3] is None
+        assert [row.count for row in session.execute("SELECT Count FROM Devspace.SnippetStats")] == [3]
+    finally:
+        db.connection.current, db.connection.pid = saved
+
 def test_create_interaction(snippet_id, user_id):
     # Create a new interaction
     response = requests.post(BASE_URL + "/interactions", json={"SnippetID": snippet_id, "UserID": user_id, "Type": "like"})
@@ -115,6 +364,55 @@ def test_get_interaction(interaction_id):
     assert response.status_code == 200
     assert response.json()["Type"] == "like"
 
+def test_list_snippet_interactions(snippet_id, interaction_id):
+    # The interaction is listed on its snippet
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/interactions")
+    assert response.status_code == 200
+    assert interaction_id in [i["InteractionID"] for i in response.json()["Interactions"]]
+
+def test_range_snippet_interactions(snippet_id, interaction_id):
+    # Interactions are read by time range, one day bucket at a time
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/interactions", params={"since": "2000-01-01T00:00:00", "until": "2000-01-02T00:00:00"})
+    assert response.status_code == 200
+    assert response.json()["Interactions"] == []
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/interactions", params={"since": "2000-01-02T00:00:00", "until": "2000-01-01T00:00:00"})
+    assert response.status_code == 400
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/interactions", params={"since": "2000-01-01T00:00:00", "until": "2001-01-01T00:00:00"})
+    assert response.status_code == 400
+    # A three day range pages through every bucket
+    until = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() + 60))
+    since = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() - 3 * 86400))
+    found, cursor = [], None
+    while True:
+        response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/interactions", params={"since": since, "until": until, "fetch_size": 1, "cursor": cursor})
+        assert response.status_code == 200
+        found += [i["InteractionID"] for i in response.json()["Interactions"]]
+        cursor = response.json()["NextCursor"]
+        if not cursor:
+            break
+    assert interaction_id in found
+
+def test_snippet_stats(snippet_id, likes):
+    # Interaction counts per type come from one counter partition
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/stats")
+    assert response.status_code == 200
+    assert response.json()["Interactions"].get("like", 0) == likes
+
+def test_trending_feed(snippet_id):
+    # The liked snippet shows up in the trending feed once the next snapshot is taken
+    for _ in range(150):
+        response = requests.get(BASE_URL + "/feed/trending")
+        assert response.status_code == 200
+        if snippet_id in [s["SnippetID"] for s in response.json()["Snippets"]]:
+            break
+        time.sleep(0.1)
+    else:
+        assert False, "snippet not trending"
+    response = requests.get(BASE_URL + "/feed/trending", params={"lang": "test2"})
+    assert snippet_id in [s["SnippetID"] for s in response.json()["Snippets"]]
+    response = requests.get(BASE_URL + "/feed/trending", params={"lang": "test2", "tag": "test2"})
+    assert response.status_code == 400
+
 def test_delete_interaction(interaction_id):
     # Delete the interaction
     response = requests.delete(BASE_URL + "/interactions/" + interaction_id)
@@ -126,7 +424,7 @@ def test_create_snippet_bounty(snippet_id, user_id):
     # Create a new snippet bounty
     response = requests.post(BASE_URL + "/snippetbounties", json={"SnippetID": snippet_id, "UserID": user_id, "Amount": 10})
     assert response.status_code == 201
-    bounty_id = response
+    bounty_id = response.json()["BountyID"]
     return bounty_id
 
 def test_get_snippet_bounty(bounty_id):
@@ -135,6 +433,12 @@ def test_get_snippet_bounty(bounty_id):
     assert response.status_code == 200
     assert response.json()["Amount"] == 10
 
+def test_list_snippet_bounties(snippet_id, bounty_id):
+    # The bounty is listed on its snippet
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/bounties")
+    assert response.status_code == 200
+    assert bounty_id in [b["BountyID"] for b in response.json()["Bounties"]]
+
 def test_delete_snippet_bounty(bounty_id):
     # Delete the snippet bounty
     response = requests.delete(BASE_URL + "/snippetbounties/" + bounty_id)
@@ -146,7 +450,7 @@ def test_create_bug_bounty(snippet_id, user_id):
     # Create a new bug bounty
     response = requests.post(BASE_URL + "/bugbounties", json={"SnippetID": snippet_id, "UserID": user_id, "Amount": 10})
     assert response.status_code == 201
-    bounty_id = response
+    bounty_id = response.json()["BountyID"]
     return bounty_id
 
 def test_get_bug_bounty(bounty_id):
@@ -175,6 +479,24 @@ def test_get_report(report_id):
     assert response.status_code == 200
     assert response.json()["Reason"] == "test"
 
+def test_list_reports(report_id):
+    # Recent reports are listed newest first
+    response = requests.get(BASE_URL + "/reports")
+    assert response.status_code == 200
+    assert report_id in [r["ReportID"] for r in response.json()["Reports"]]
+    # a page at a time across the day's buckets, each report once
+    seen, cursor = [], None
+    for _ in range(100):
+        response = requests.get(BASE_URL + "/reports", params={"fetch_size": 1, "cursor": cursor} if cursor else {"fetch_size": 1})
+        assert response.status_code == 200
+        seen += [r["ReportID"] for r in response.json()["Reports"]]
+        cursor = response.json()["NextCursor"]
+        if not cursor:
+            break
+    assert report_id in seen and len(seen) == len(set(seen))
+    response = requests.get(BASE_URL + "/reports", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
 def test_delete_report(report_id):
     # Delete the report
     response = requests.delete(BASE_URL + "/reports/" + report_id)
@@ -182,6 +504,45 @@ def test_delete_report(report_id):
     response = requests.get(BASE_URL + "/reports/" + report_id)
     assert response.status_code == 404
 
+def test_rate_limit_by_address(snippet_id):
+    # A new UserID on every report doesn't get around the limit, the address is charged as well; replaying
+    # a finished Idempotency-Key POST costs nothing, so it is still answered once the caller is limited
+    key = str(uuid.uuid4())
+    body = {"SnippetID": snippet_id, "UserID": str(uuid.uuid4()), "Reason": "spam"}
+    response = requests.post(BASE_URL + "/reports", json=body, headers={"Idempotency-Key": key})
+    assert response.status_code == 201
+    report_ids, limited = [response.json()["ReportID"]], None
+    for _ in range(20):
+        response = requests.post(BASE_URL + "/reports", json={"SnippetID": snippet_id, "UserID": str(uuid.uuid4()), "Reason": "spam"})
+        if response.status_code == 429:
+            limited = response
+            break
+        assert response.status_code == 201
+        report_ids.append(response.json()["ReportID"])
+    assert limited is not None
+    response = requests.post(BASE_URL + "/reports", json=body, headers={"Idempotency-Key": key})
+    assert response.status_code == 201 and response.headers.get("Idempotent-Replayed") == "true"
+    assert response.json()["ReportID"] == report_ids[0]
+    for report_id in report_ids:
+        test_delete_report(report_id)
+
+def test_rate_limit(snippet_id):
+    # A user posting bug bounties faster than the route allows is turned away with 429 and told when to retry;
+    # on a route of its own, so it starts from nearly full buckets whatever the /reports tests have spent
+    user_id = str(uuid.uuid4())
+    bounty_ids, limited = [], None
+    for _ in range(20):
+        response = requests.post(BASE_URL + "/bugbounties", json={"SnippetID": snippet_id, "UserID": user_id, "Amount": 10})
+        if response.status_code == 429:
+            limited = response
+            break
+        assert response.status_code == 201
+        bounty_ids.append(response.json()["BountyID"])
+    assert bounty_ids, "the first request was already limited"
+    assert limited is not None and int(limited.headers["Retry-After"]) >= 1
+    for bounty_id in bounty_ids:
+        test_delete_bug_bounty(bounty_id)
+
 def test_create_comment(snippet_id, user_id):
     # Create a new comment
     response = requests.post(BASE_URL + "/comments", json={"SnippetID": snippet_id, "UserID": user_id, "Content": "test"})
@@ -195,6 +556,34 @@ def test_get_comment(comment_id):
     assert response.status_code == 200
     assert response.json()["Content"] == "test"
 
+def test_list_snippet_comments(snippet_id, comment_id):
+    # The comment is listed on its snippet
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/comments")
+    assert response.status_code == 200
+    assert comment_id in [c["CommentID"] for c in response.json()["Comments"]]
+
+def test_snippet_full(snippet_id, user_id, comment_id):
+    # The whole snippet page comes back from one request: author, tag names, stats, comments and bounties
+    tag_id = test_create_tag()
+    test_create_snippet_tag(snippet_id, tag_id)
+    bounty_id = test_create_snippet_bounty(snippet_id, user_id)
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/full")
+    assert response.status_code == 200
+    page = response.json()
+    assert page["Snippet"]["SnippetID"] == snippet_id and "Content" in page["Snippet"]
+    assert page["Author"]["UserID"] == user_id
+    assert {"TagID": tag_id, "Name": "test"} in page["Tags"]
+    assert page["Interactions"].get("like", 0) == 0
+    assert comment_id in [c["CommentID"] for c in page["Comments"]]
+    assert bounty_id in [b["BountyID"] for b in page["Bounties"]]
+    response = requests.get(BASE_URL + "/snippets/" + snippet_id + "/full", params={"view": "preview"})
+    assert "Content" not in response.json()["Snippet"]
+    response = requests.get(BASE_URL + "/snippets/" + str(uuid.uuid4()) + "/full")
+    assert response.status_code == 404
+    test_delete_snippet_bounty(bounty_id)
+    test_delete_snippet_tag(snippet_id, tag_id)
+    test_delete_tag(tag_id)
+
 def test_delete_comment(comment_id):
     # Delete the comment
     response = requests.delete(BASE_URL + "/comments/" + comment_id)
@@ -206,37 +595,64 @@ def test_delete_comment(comment_id):
 
 user_id = test_create_user()
 test_get_user(user_id)
+test_metrics(user_id)
 test_update_user(user_id)
 
 snippet_id = test_create_snippet(user_id)
+test_list_user_snippets(user_id, snippet_id)
+test_page_user_snippets(user_id, snippet_id)
 test_get_snippet(snippet_id)
+test_get_snippet_bad_id()
+test_cache_stats(snippet_id)
+test_snippet_content(user_id)
+test_snippet_moderation(snippet_id)
+test_snippet_conditional_get(user_id)
 test_update_snippet(snippet_id, user_id)
 
+test_idempotent_create()
 tag_id = test_create_tag()
 test_get_tag(tag_id)
 test_update_tag(tag_id)
 
 test_create_snippet_tag(snippet_id, tag_id)
+test_list_snippet_tags(snippet_id, tag_id)
+test_search_snippets(snippet_id)
+test_similar_snippets(snippet_id, user_id)
 test_delete_snippet_tag(snippet_id, tag_id)
+test_bulk_snippet_tags(snippet_id)
+test_bulk_get_snippets(snippet_id)
 
+test_write_behind_spill()
+test_transfer_round_trip()
 interaction_id = test_create_interaction(snippet_id, user_id)
 test_get_interaction(interaction_id)
+test_list_snippet_interactions(snippet_id, interaction_id)
+test_range_snippet_interactions(snippet_id, interaction_id)
+test_snippet_stats(snippet_id, 1)
+test_trending_feed(snippet_id)
 test_delete_interaction(interaction_id)
+test_snippet_stats(snippet_id, 0)
 
 bounty_id = test_create_snippet_bounty(snippet_id, user_id)
 test_get_snippet_bounty(bounty_id)
+test_list_snippet_bounties(snippet_id, bounty_id)
 test_delete_snippet_bounty(bounty_id)
 
 bounty_id = test_create_bug_bounty(snippet_id, user_id)
 test_get_bug_bounty(bounty_id)
 test_delete_bug_bounty(bounty_id)
+test_rate_limit(snippet_id)
 
 report_id = test_create_report(snippet_id, user_id)
 test_get_report(report_id)
+test_list_reports(report_id)
 test_delete_report(report_id)
+test_rate_limit_by_address(snippet_id)
 
 comment_id = test_create_comment(snippet_id, user_id)
 test_get_comment(comment_id)
+test_list_snippet_comments(snippet_id, comment_id)
+test_snippet_full(snippet_id, user_id, comment_id)
 test_delete_comment(comment_id)
 
 test_delete_snippet(snippet_id)
@@ -0,0 +1,306 @@
+import argparse
+import base64
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from cassandra.concurrent import execute_concurrent_with_args
+import db
+import responses
+
+# bulk export and import of the Devspace keyspace, for backups, migrations and load-test data
+#   python transfer.py export --out backup --tables users,snippets --format jsonl
+#   python transfer.py import --in backup --concurrency 256
+# export splits each table's token ring into --splits ranges; --processes worker processes each scan one
+# range at a time, page by page, into its own part file, so memory stays at about a page per worker.
+# import hands the part files to the workers, each keeping --concurrency prepared inserts in flight.
+# Rows keep their TTL: export reads what is left of it, and import writes each row with that, less the
+# time since the export, so a restored row expires when the original would have; one that would already
+# have expired is skipped. Counter tables are imported as increments, so importing one twice doubles it
+
+KEYSPACE = 'devspace'
+# Murmur3 tokens; the minimum is never assigned to a key, so ranges are (start, end]
+MIN_TOKEN, MAX_TOKEN = -2 ** 63, 2 ** 63 - 1
+# the extra column of a row's remaining TTL in the part files; CQL names can't start with an underscore
+TTL_COLUMN = '_ttl'
+
+def token_ranges(splits):
+    step = (MAX_TOKEN - MIN_TOKEN) // splits
+    bounds = [MIN_TOKEN + step * i for i in range(splits)] + [MAX_TOKEN]
+    return list(zip(bounds, bounds[1:]))
+
+def describe(session, names=None):
+    # {name: manifest} for the keyspace's tables, from the driver's schema metadata
+    tables = session.cluster.metadata.keyspaces[KEYSPACE].tables
+    names = [name.lower() for name in names] if names else sorted(tables)
+    manifests = {}
+    for name in names:
+        if name not in tables:
+            raise SystemExit('No table %s.%s, pick from %s' % (KEYSPACE, name, ', '.join(sorted(tables))))
+        table = tables[name]
+        keys = [column.name for column in table.primary_key]
+        manifests[name] = {
+            'table': name,
+            'columns': [[column.name, column.cql_type] for column in table.columns.values()],
+            'partition_key': [column.name for column in table.partition_key],
+            'primary_key': keys,
+            # TTL() reads regular columns that aren't counters or collections
+            'ttl': [column.name for column in table.columns.values()
+                if column.name not in keys and column.cql_type != 'counter' and not column.cql_type.startswith(('set<', 'list<', 'map<'))],
+        }
+    return manifests
+
+def file_columns(manifest):
+    # the columns of the part files: the table's, then the remaining TTL if the export read it
+    return manifest['columns'] + ([[TTL_COLUMN, 'int']] if manifest.get('ttl') else [])
+
+# values are written as JSON with UUIDs and timestamps as strings (see responses.dumps), blobs as base64
+# and sets as lists, and turned back into driver types on import by the column's CQL type
+def _timestamp(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def _blob(value):
+    return value if isinstance(value, bytes) else base64.b64decode(value)
+
+DECODERS = {
+    'uuid': uuid.UUID, 'timeuuid': uuid.UUID, 'timestamp': _timestamp, 'date': date.fromisoformat, 'decimal': Decimal,
+    'int': int, 'bigint': int, 'smallint': int, 'tinyint': int, 'varint': int, 'counter': int,
+    'float': float, 'double': float, 'boolean': bool, 'blob': _blob,
+}
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return value
+
+def decoders(manifest):
+    return [DECODERS.get(cql_type) for _, cql_type in manifest['columns']]
+
+class JSONLinesFormat():
+    extension = 'jsonl'
+
+    def __init__(self, path, columns):
+        self.names = [name for name, _ in columns]
+        self.file = open(path, 'wb')
+
+    def write(self, rows):
+        self.file.write(b''.join(responses.dumps(dict((name, _encode(value)) for name, value in zip(self.names, row))) + b'\n' for row in rows))
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path, columns):
+        names = [name for name, _ in columns]
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    item = responses.loads(line)
+                    yield [item.get(name) for name in names]
+
+class ParquetFormat():
+    # needs pyarrow; every CQL type without an obvious Arrow one is stored as a string
+    extension = 'parquet'
+    TYPES = {'int': 'int32', 'smallint': 'int16', 'tinyint': 'int8', 'bigint': 'int64', 'counter': 'int64',
+        'float': 'float32', 'double': 'float64', 'boolean': 'bool_', 'blob': 'binary'}
+
+    def __init__(self, path, columns):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, self.arrow_type(cql_type)) for name, cql_type in columns])
+        self.strings = [self.schema.field(name).type == pyarrow.string() for name, _ in columns]
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def arrow_type(self, cql_type):
+        if cql_type == 'timestamp':
+            return self.pyarrow.timestamp('ms', tz='UTC')
+        return getattr(self.pyarrow, self.TYPES.get(cql_type, 'string'))()
+
+    def write(self, rows):
+        columns = [list(values) for values in zip(*rows)]
+        for index, string in enumerate(self.strings):
+            if string:
+                columns[index] = [None if value is None else str(value) for value in columns[index]]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+    @staticmethod
+    def read(path, columns):
+        import pyarrow.parquet
+        names = [name for name, _ in columns]
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=5000, columns=names):
+            yield from zip(*[batch.column(name).to_pylist() for name in names])
+
+FORMATS = {'jsonl': JSONLinesFormat, 'parquet': ParquetFormat}
+
+def export_range(task):
+    # runs in a worker: streams one token range of a table to one part file, returns the row count
+    manifest, start, end, path, fmt, fetch_size = task
+    session = db.session()
+    names = [name for name, _ in manifest['columns']]
+    ttls = ['TTL(%s)' % name for name in manifest.get('ttl', [])]
+    key = ', '.join(manifest['partition_key'])
+    statement = session.prepare("SELECT %s FROM %s.%s WHERE token(%s) > ? AND token(%s) <= ?" % (', '.join(names + ttls), KEYSPACE, manifest['table'], key, key))
+    statement.fetch_size = fetch_size
+    result = session.execute(statement, (start, end))
+    writer, count = None, 0
+    while True:
+        rows = result.current_rows
+        if rows and ttls:
+            # columns written together share a TTL; the longest left is the row's, None for none
+            rows = [tuple(row[:len(names)]) + (max((ttl for ttl in row[len(names):] if ttl is not None), default=None),) for row in rows]
+        if rows:
+            if writer is None:
+                writer = FORMATS[fmt](path, file_columns(manifest))
+            writer.write(rows)
+            count += len(rows)
+        if not result.has_more_pages:
+            break
+        result.fetch_next_page()
+    if writer is not None:
+        writer.close()
+    return count
+
+def insert_statement(session, manifest):
+    # (prepared statement, column order of its parameters)
+    names = [name for name, _ in manifest['columns']]
+    counters = [name for name, cql_type in manifest['columns'] if cql_type == 'counter']
+    table = '%s.%s' % (KEYSPACE, manifest['table'])
+    if counters:
+        keys = manifest['primary_key']
+        query = "UPDATE %s SET %s WHERE %s" % (table, ', '.join('%s = %s + ?' % (name, name) for name in counters), ' AND '.join('%s = ?' % name for name in keys))
+        order = counters + keys
+    elif manifest.get('ttl'):
+        # TTL 0 is none, as it was for a row exported without one
+        query = "INSERT INTO %s (%s) VALUES (%s) USING TTL ?" % (table, ', '.join(names), ', '.join('?' * len(names)))
+        order = names + [TTL_COLUMN]
+    else:
+        query = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(names), ', '.join('?' * len(names)))
+        order = names
+    statement = session.prepare(query)
+    statement.is_idempotent = not counters
+    columns = [name for name, _ in file_columns(manifest)]
+    return statement, [columns.index(name) for name in order]
+
+def import_part(task):
+    # runs in a worker: loads one part file, returns (rows, failed, expired, first error)
+    manifest, path, fmt, concurrency = task
+    session = db.session()
+    statement, order = insert_statement(session, manifest)
+    convert = decoders(manifest)
+    ttl = len(manifest['columns']) if manifest.get('ttl') else None
+    # whole seconds since the export read the TTLs
+    elapsed = int((datetime.now(timezone.utc) - datetime.fromisoformat(manifest['exported_at'])).total_seconds()) if ttl is not None else 0
+    expired = 0
+
+    def parameters():
+        nonlocal expired
+        for row in FORMATS[fmt].read(path, file_columns(manifest)):
+            row = list(row)
+            if ttl is not None:
+                if row[ttl] is not None and int(row[ttl]) <= elapsed:
+                    expired += 1
+                    continue
+                row[ttl] = int(row[ttl]) - elapsed if row[ttl] is not None else 0
+            yield [row[i] if row[i] is None or i >= len(convert) or convert[i] is None else convert[i](row[i]) for i in order]
+
+    count, failed, error = 0, 0, None
+    for success, result in execute_concurrent_with_args(session, statement, parameters(), concurrency=concurrency, raise_on_first_error=False, results_generator=True):
+        count += 1
+        if not success:
+            failed += 1
+            error = error or repr(result)
+    return count, failed, expired, error
+
+def workers(processes):
+    # spawned rather than forked: the parent already holds a connected session.
+    # With processes=1 everything runs in this process
+    if processes == 1:
+        return contextlib.nullcontext()
+    return multiprocessing.get_context('spawn').Pool(processes)
+
+def run(pool, work, tasks):
+    return map(work, tasks) if pool is None else pool.imap_unordered(work, tasks)
+
+def export(args):
+    manifests = describe(db.session(), args.tables)
+    with workers(args.processes) as pool:
+        for name, manifest in manifests.items():
+            export_table(pool, manifest, args)
+
+def export_table(pool, manifest, args):
+    name = manifest['table']
+    directory = os.path.join(args.out, name)
+    os.makedirs(directory, exist_ok=True)
+    for stale in glob.glob(os.path.join(directory, 'part-*')):
+        os.remove(stale)
+    extension = FORMATS[args.format].extension
+    tasks = [(manifest, start, end, os.path.join(directory, 'part-%05d.%s' % (index, extension)), args.format, args.fetch_size)
+        for index, (start, end) in enumerate(token_ranges(args.splits))]
+    # the TTLs are read after this, so import counts the time since from here
+    exported_at = datetime.now(timezone.utc).isoformat()
+    started = time.perf_counter()
+    rows = sum(run(pool, export_range, tasks))
+    elapsed = time.perf_counter() - started
+    # the manifest is written last, so a directory without one is an export that didn't finish
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(dict(manifest, format=args.format, rows=rows, exported_at=exported_at), f, indent=4)
+    print('Exported %s: %d rows in %.1fs (%d rows/s)' % (name, rows, elapsed, rows / elapsed if elapsed else 0))
+
+def load(args):
+    # returns how many rows failed to import
+    wanted = set(name.lower() for name in args.tables) if args.tables else None
+    failures = 0
+    with workers(args.processes) as pool:
+        for path in sorted(glob.glob(os.path.join(args.input, '*', 'manifest.json'))):
+            with open(path) as f:
+                manifest = json.load(f)
+            if wanted is None or manifest['table'] in wanted:
+                failures += import_table(pool, manifest, os.path.dirname(path), args)
+    return failures
+
+def import_table(pool, manifest, directory, args):
+    parts = sorted(glob.glob(os.path.join(directory, 'part-*.%s' % FORMATS[manifest['format']].extension)))
+    tasks = [(manifest, part, manifest['format'], args.concurrency) for part in parts]
+    started = time.perf_counter()
+    rows = failed = expired = 0
+    for count, part_failed, part_expired, error in run(pool, import_part, tasks):
+        rows += count
+        failed += part_failed
+        expired += part_expired
+        if error:
+            print('Failed to import some rows of %s: %s' % (manifest['table'], error))
+    elapsed = time.perf_counter() - started
+    print('Imported %s: %d rows, %d failed, %d expired since the export, in %.1fs (%d rows/s)' % (
+        manifest['table'], rows - failed, failed, expired, elapsed, rows / elapsed if elapsed else 0))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the Devspace keyspace to files or import it back')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='Stream tables to newline-delimited JSON or Parquet files')
+    export_parser.add_argument('--out', required=True, help='directory to write one sub-directory per table to')
+    export_parser.add_argument('--format', choices=sorted(FORMATS), default='jsonl')
+    export_parser.add_argument('--splits', type=int, default=256, help='token ranges per table, one part file each')
+    export_parser.add_argument('--fetch-size', type=int, default=5000, help='rows per page')
+    import_parser = commands.add_parser('import', help='Load files written by export')
+    import_parser.add_argument('--in', dest='input', required=True, help='directory export wrote to')
+    import_parser.add_argument('--concurrency', type=int, default=256, help='inserts in flight per process')
+    for command in (export_parser, import_parser):
+        command.add_argument('--tables', type=lambda text: [name for name in text.split(',') if name], help='comma separated, all tables by default')
+        command.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes, 1 to run in this one')
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args)
+    elif load(args):
+        raise SystemExit(1)
@@ -0,0 +1,230 @@
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+import responses
+from search import Store
+
+log = logging.getLogger(__name__)
+
+# snippets ranked by recent activity, overall and per language and tag. Every interaction, approved comment
+# and bounty adds its weight to the snippet's score in each scope the snippet belongs to, and scores halve
+# every half_life seconds. Each scope keeps at most capacity snippets, the highest scoring ones.
+#
+# The scores live in a SQLite database shared by the worker processes on the host, like the search index.
+# A worker only adds up the events it sees in memory; a background thread merges them into the shared
+# scores every interval seconds and turns those into ranked snapshots, which GET /feed/trending serves as
+# they are. So every worker serves the same ranking, and a restarted one loses at most interval seconds.
+#
+# Scores use forward decay: an event at time t adds weight * 2 ** ((t - landmark) / half_life), so a stored
+# score never has to be touched again as time passes and what the workers add up is simply summed;
+# dividing by 2 ** ((now - landmark) / half_life) gives its value now. The landmark is moved forward before
+# the exponent gets large: the shared one with all the scores in one transaction, a worker's own whenever
+# it has nothing pending.
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS scores (scope TEXT NOT NULL, snippet_id TEXT NOT NULL, score REAL NOT NULL, PRIMARY KEY (scope, snippet_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS scores_rank ON scores (scope, score)",
+    "CREATE INDEX IF NOT EXISTS scores_snippet ON scores (snippet_id)",
+    "CREATE TABLE IF NOT EXISTS landmark (id INTEGER PRIMARY KEY CHECK (id = 0), at REAL NOT NULL)",
+]
+
+WEIGHTS = {'view': 1.0, 'like': 3.0, 'comment': 4.0, 'bounty': 2.0}
+GLOBAL = ''
+REBASE_AFTER = 32
+CHUNK = 500
+
+def scope(language=None, tag=None):
+    if language:
+        return 'lang:' + language.lower()
+    if tag:
+        return 'tag:' + tag.lower()
+    return GLOBAL
+
+class ScoreStore(Store):
+    schema = SCHEMA
+
+class Trending():
+    # describe(snippet_id) returns (language, tags) for a snippet that may trend, None otherwise;
+    # titles(snippet_ids) returns {snippet_id: (title, language)} for those still listed
+    def __init__(self, describe, titles, half_life=6 * 3600, top=50, capacity=200, max_scopes=1000, interval=10, path=':memory:', weights=WEIGHTS, clock=time.time):
+        self.describe = describe
+        self.titles = titles
+        self.half_life = half_life
+        self.top = top
+        self.capacity = capacity
+        self.max_scopes = max_scopes
+        self.interval = interval
+        self.store = ScoreStore(path)
+        self.weights = weights
+        self.clock = clock
+        self.landmark = clock()
+        # {scope: {snippet_id: score}} recorded here since the last merge, against self.landmark
+        self.pending = {}
+        self.snapshots = {}
+        self.counters = {'events': 0, 'ignored': 0, 'evicted': 0, 'snapshots': 0}
+        self.sizes = {'scopes': 0, 'tracked': 0}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.pending = {}
+            self.thread = threading.Thread(target=self.run, name='trending', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.snapshot()
+            except Exception as e:
+                log.warning('Trending snapshot failed: %s', e)
+            time.sleep(self.interval)
+
+    def record(self, snippet_id, event, amount=1.0, at=None):
+        # amount=-1 with the original time takes an event back out
+        facets = self.describe(snippet_id)
+        if facets is None:
+            self.counters['ignored'] += 1
+            return
+        self.start()
+        language, tags = facets
+        scopes = [GLOBAL] + ([scope(language=language)] if language else []) + [scope(tag=tag) for tag in tags]
+        with self.lock:
+            value = self.weights.get(event, 1.0) * amount * 2 ** (((at or self.clock()) - self.landmark) / self.half_life)
+            self.counters['events'] += 1
+            for name in scopes:
+                self.add(name, str(snippet_id), value)
+
+    def add(self, name, key, value):
+        scores = self.pending.get(name)
+        if scores is None:
+            if len(self.pending) >= self.max_scopes:
+                return
+            scores = self.pending[name] = {}
+        scores[key] = scores.get(key, 0.0) + value
+
+    def remove(self, snippet_id):
+        key = str(snippet_id)
+        with self.lock:
+            for scores in self.pending.values():
+                scores.pop(key, None)
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM scores WHERE snippet_id=?", (key,))
+
+    def merge(self, conn, pending, base, now):
+        # adds what this worker recorded against base to the shared scores; the shared landmark
+        landmark = conn.execute("SELECT at FROM landmark").fetchone()
+        if landmark is None:
+            landmark = now
+            conn.execute("INSERT INTO landmark (id, at) VALUES (0, ?)", (now,))
+        else:
+            landmark = landmark[0]
+        if (now - landmark) / self.half_life > REBASE_AFTER:
+            conn.execute("UPDATE scores SET score = score * ?", (2 ** (-(now - landmark) / self.half_life),))
+            conn.execute("UPDATE landmark SET at=?", (now,))
+            landmark = now
+        factor = 2 ** ((base - landmark) / self.half_life)
+        known = set(name for (name,) in conn.execute("SELECT DISTINCT scope FROM scores"))
+        for name, scores in pending.items():
+            if name not in known:
+                if len(known) >= self.max_scopes or max(scores.values()) <= 0:
+                    continue
+                known.add(name)
+            conn.executemany(
+                "INSERT INTO scores (scope, snippet_id, score) VALUES (?, ?, ?) ON CONFLICT (scope, snippet_id) DO UPDATE SET score = score + excluded.score",
+                [(name, key, value * factor) for key, value in scores.items()])
+            self.counters['evicted'] += conn.execute(
+                "DELETE FROM scores WHERE scope=? AND snippet_id IN (SELECT snippet_id FROM scores WHERE scope=? ORDER BY score DESC LIMIT -1 OFFSET ?)",
+                (name, name, self.capacity)).rowcount
+        # anything that has decayed below a hundredth of a view is forgotten, as is what was taken back out
+        conn.execute("DELETE FROM scores WHERE score < ?", (0.01 * 2 ** ((now - landmark) / self.half_life),))
+        return landmark
+
+    def snapshot(self):
+        now = self.clock()
+        with self.lock:
+            pending, base = self.pending, self.landmark
+            self.pending = {}
+            if (now - self.landmark) / self.half_life > REBASE_AFTER:
+                self.landmark = now
+        try:
+            with self.store.transaction() as conn:
+                landmark = self.merge(conn, pending, base, now)
+        except Exception:
+            # kept for the next merge
+            with self.lock:
+                for name, scores in pending.items():
+                    for key, value in scores.items():
+                        self.add(name, key, value * 2 ** ((base - self.landmark) / self.half_life))
+            raise
+        decay = 2 ** (-(now - landmark) / self.half_life)
+        ranked = {}
+        for name, key, value in self.store.connection().execute(
+                "SELECT scope, snippet_id, score FROM (SELECT scope, snippet_id, score, row_number() OVER (PARTITION BY scope ORDER BY score DESC) AS position FROM scores) "
+                "WHERE position <= ? ORDER BY scope, position", (self.top,)):
+            ranked.setdefault(name, []).append((key, value))
+        scopes, tracked = self.store.connection().execute("SELECT count(DISTINCT scope), count(*) FROM scores").fetchone()
+
+        keys = list(set(key for items in ranked.values() for key, _ in items))
+        listed = {}
+        for start in range(0, len(keys), CHUNK):
+            listed.update(self.titles(keys[start:start + CHUNK]))
+        generated = datetime.fromtimestamp(now, timezone.utc)
+        snapshots = {}
+        for name, items in ranked.items():
+            snippets = [{'SnippetID': key, 'Title': listed[key][0], 'Language': listed[key][1], 'Score': round(value * decay, 3)}
+                for key, value in items if key in listed]
+            body = {'Snippets': snippets, 'GeneratedAt': generated}
+            snapshots[name] = (body, responses.etag(responses.dumps(body)))
+        self.snapshots = snapshots
+        self.sizes = {'scopes': scopes, 'tracked': tracked}
+        self.counters['snapshots'] += 1
+
+    def feed(self, name):
+        # (body, etag) of the last snapshot for the scope
+        self.start()
+        snapshot = self.snapshots.get(name)
+        if snapshot is None:
+            snapshot = ({'Snippets': [], 'GeneratedAt': None}, None)
+        return snapshot
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = sum(len(scores) for scores in self.pending.values())
+        stats.update(self.sizes)
+        return stats
+
+def bounty_amount(amount):
+    # bounties count by order of magnitude, so one large bounty doesn't bury every other signal
+    try:
+        return math.log1p(max(float(amount), 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def parse_weights(text):
+    # "like=3,view=1" on top of WEIGHTS
+    weights = dict(WEIGHTS)
+    for pair in text.split(','):
+        if '=' in pair:
+            name, weight = pair.split('=', 1)
+            weights[name.strip()] = float(weight)
+    return weights
+
+def from_env(env, describe, titles):
+    # TRENDING_HALF_LIFE_H: hours for a score to halve; TRENDING_TOP: snippets per feed;
+    # TRENDING_CAPACITY: snippets tracked per scope; TRENDING_SNAPSHOT_S: seconds between snapshots;
+    # TRENDING_STATE: the SQLite file the scores are shared in by the workers on this host ("" to keep them
+    # in this process only); TRENDING_WEIGHTS: e.g. "like=5,share=8" to change or add event weights
+    return Trending(describe, titles, float(env.get('TRENDING_HALF_LIFE_H', 6)) * 3600,
+        int(env.get('TRENDING_TOP', 50)), int(env.get('TRENDING_CAPACITY', 200)), int(env.get('TRENDING_MAX_SCOPES', 1000)),
+        float(env.get('TRENDING_SNAPSHOT_S', 10)), env.get('TRENDING_STATE', 'trending.db') or ':memory:',
+        parse_weights(env.get('TRENDING_WEIGHTS', '')))
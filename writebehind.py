@@ -0,0 +1,234 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class BufferFull(Exception):
+    pass
+
+class WriteBehindBuffer():
+    # events (JSON-serialisable dicts) are appended to a local spill segment before they are acknowledged,
+    # then written in groups by flush(events) every flush_interval seconds or max_events events.
+    # Events are flushed in the order they were logged, so after each flush the lines of a segment up to the
+    # last event flushed are done: that count is kept next to the segment in a .done file, and a segment
+    # is deleted once the flushes have moved past it. A segment grows to at most segment_bytes before the
+    # next one is started. Segments left behind by a crashed process are replayed on start from their
+    # .done count on, so delivery is at-least-once. discard() logs a tombstone, which replay honours too
+    def __init__(self, flush, spill_dir, name='events', max_events=500, flush_interval=0.05, capacity=10000, put_timeout=0.1, fsync=False, segment_bytes=8 * 1024 * 1024):
+        self.flush_events = flush
+        self.spill_dir = spill_dir
+        self.name = name
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.put_timeout = put_timeout
+        self.fsync = fsync
+        self.segment_bytes = segment_bytes
+        # (segment, line, event) in the order they were logged
+        self.pending = []
+        self.inflight = 0
+        self.segments = []
+        self.spill = None
+        # lines written to the current segment
+        self.lines = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.wake = threading.Event()
+        self.counters = {'accepted': 0, 'flushed': 0, 'flushes': 0, 'failures': 0, 'rejected': 0, 'replayed': 0, 'discarded': 0}
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            # a forked worker inherits the parent's buffer object but not its thread or its events
+            self.pid = os.getpid()
+            self.pending, self.segments, self.spill = [], [], None
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.replay()
+            self.open_segment()
+            self.thread = threading.Thread(target=self.run, name='write-behind-%s' % self.name, daemon=True)
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def segment_path(self, pid, sequence):
+        return os.path.join(self.spill_dir, '%s-%d-%d.jsonl' % (self.name, pid, sequence))
+
+    def replay(self):
+        # claim segments of processes that are gone by renaming them into this process's namespace
+        tombstones = []
+        for path in sorted(glob.glob(os.path.join(self.spill_dir, '%s-*-*.jsonl' % self.name))):
+            pid = int(os.path.basename(path).split('-')[-2])
+            if pid == self.pid or _alive(pid):
+                continue
+            self.sequence += 1
+            claimed = self.segment_path(self.pid, self.sequence)
+            done = _read_done(path)
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            _remove(path + '.done')
+            _write_done(claimed, done)
+            with open(claimed) as f:
+                for line, text in enumerate(f):
+                    try:
+                        record = json.loads(text)
+                    except ValueError:
+                        # torn last line from the crash
+                        continue
+                    if '_discard' in record:
+                        tombstones.append(record['_discard'])
+                    elif line >= done:
+                        self.pending.append((claimed, line, record))
+            self.segments.append(claimed)
+        for field, value in tombstones:
+            self.pending = [entry for entry in self.pending if entry[2].get(field) != value]
+        self.counters['replayed'] += len(self.pending)
+
+    def open_segment(self):
+        self.sequence += 1
+        path = self.segment_path(self.pid, self.sequence)
+        self.spill = open(path, 'a')
+        self.lines = 0
+        self.segments.append(path)
+
+    def log(self, record):
+        # appends to the current segment, starting a new one past segment_bytes; returns (segment, line)
+        if self.spill.tell() >= self.segment_bytes:
+            self.spill.close()
+            self.open_segment()
+        self.spill.write(json.dumps(record) + '\n')
+        self.spill.flush()
+        if self.fsync:
+            os.fsync(self.spill.fileno())
+        self.lines += 1
+        return self.segments[-1], self.lines - 1
+
+    def add(self, event):
+        self.start()
+        with self.not_full:
+            # events being flushed still count, a failed flush puts them back
+            if len(self.pending) + self.inflight >= self.capacity:
+                self.wake.set()
+                self.not_full.wait(self.put_timeout)
+            if len(self.pending) + self.inflight >= self.capacity:
+                self.counters['rejected'] += 1
+                raise BufferFull()
+            segment, line = self.log(event)
+            self.pending.append((segment, line, event))
+            self.counters['accepted'] += 1
+            if len(self.pending) >= self.max_events:
+                self.wake.set()
+
+    def discard(self, field, value):
+        # drops buffered events whose field is value, e.g. an interaction deleted before it was flushed.
+        # An event already taken by a running flush is still written
+        self.start()
+        with self.lock:
+            self.log({'_discard': [field, value]})
+            kept = [entry for entry in self.pending if entry[2].get(field) != value]
+            self.counters['discarded'] += len(self.pending) - len(kept)
+            self.pending = kept
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            entries, self.pending = self.pending[:self.max_events], self.pending[self.max_events:]
+            self.inflight = len(entries)
+        try:
+            self.flush_events([event for _, _, event in entries])
+        except Exception as e:
+            log.warning('Write-behind flush of %d %s failed, will retry: %s', len(entries), self.name, e)
+            with self.lock:
+                self.counters['failures'] += 1
+                self.pending = entries + self.pending
+                self.inflight = 0
+            time.sleep(self.flush_interval)
+            return
+        with self.lock:
+            self.counters['flushes'] += 1
+            self.counters['flushed'] += len(entries)
+            self.inflight = 0
+            self.not_full.notify_all()
+            segment, line = entries[-1][:2]
+            if not self.pending:
+                # everything logged is done, rotating the current segment away too if anything is in it
+                if self.lines:
+                    self.spill.close()
+                    self.open_segment()
+                retired, self.segments = self.segments[:-1], self.segments[-1:]
+            elif segment in self.segments:
+                # the segments before the one the last event came from are done, and that one up to its line
+                position = self.segments.index(segment)
+                retired, self.segments = self.segments[:position], self.segments[position:]
+                _write_done(segment, line + 1)
+            else:
+                retired = []
+        for path in retired:
+            _remove(path)
+            _remove(path + '.done')
+        if len(self.pending) >= self.max_events:
+            self.wake.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self.pending) + self.inflight
+            stats['segments'] = len(self.segments)
+        stats['capacity'] = self.capacity
+        return stats
+
+def _read_done(path):
+    # lines of the segment already flushed, 0 if none are recorded
+    try:
+        with open(path + '.done') as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _write_done(path, lines):
+    # replaced whole, so a crash leaves the old count or the new one
+    with open(path + '.done.tmp', 'w') as f:
+        f.write(str(lines))
+    os.replace(path + '.done.tmp', path + '.done')
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def from_env(env, flush, name):
+    # INTERACTION_WRITE_BEHIND=1 turns the buffer on, otherwise writes stay synchronous and this returns None
+    if env.get('INTERACTION_WRITE_BEHIND', '0') in ('0', '', 'false'):
+        return None
+    return WriteBehindBuffer(flush, env.get('INTERACTION_SPILL_DIR', 'spill'), name,
+        int(env.get('INTERACTION_FLUSH_EVENTS', 500)), float(env.get('INTERACTION_FLUSH_MS', 50)) / 1000,
+        int(env.get('INTERACTION_BUFFER_CAPACITY', 10000)), float(env.get('INTERACTION_BUFFER_TIMEOUT_MS', 100)) / 1000,
+        env.get('INTERACTION_SPILL_FSYNC', '0') not in ('0', '', 'false'), int(float(env.get('INTERACTION_SPILL_SEGMENT_MB', 8)) * 1024 * 1024))